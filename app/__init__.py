@@ -1,4 +1,5 @@
-from flask import Flask, flash, redirect, url_for, render_template
+from flask import Flask, flash, redirect, url_for, render_template, request
+from sqlalchemy.orm.exc import StaleDataError
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, current_user
 from flask_mail import Mail
@@ -42,6 +43,27 @@ def create_app(config_name):
 
     app.jinja_env.filters['localtime'] = format_to_local_time
 
+    from .services import metrics_service, search_service, schema_service, stats_service, outbox_service, import_job_service, \
+        analytics_export_service, image_service, http_cache, overdue_service, \
+        archive_service, rollup_service, utilization_service, profiler_service, seed_service, benchmark_service
+    metrics_service.init_app(app)
+    profiler_service.init_app(app)
+    search_service.init_app(app)
+    schema_service.init_app(app)
+    stats_service.init_app(app)
+    outbox_service.init_app(app)
+    import_job_service.init_app(app)
+    analytics_export_service.init_app(app)
+    image_service.init_app(app)
+    http_cache.init_app(app)
+    overdue_service.init_app(app)
+    archive_service.init_app(app)
+    rollup_service.init_app(app)
+    utilization_service.init_app(app)
+    seed_service.init_app(app)
+    benchmark_service.init_app(app)
+
+    from .services.state_machine import InvalidTransition
     from .routes.main_routes import main_bp
     app.register_blueprint(main_bp)
     from .routes.device_routes import device_bp
@@ -54,4 +76,16 @@ def create_app(config_name):
     @app.errorhandler(403)
     def forbidden(e): return render_template('errors/403.html'), 403
 
+    # --- Xung đột ghi đồng thời (khóa lạc quan) và chuyển trạng thái sai ---
+    @app.errorhandler(StaleDataError)
+    def concurrent_update(e):
+        db.session.rollback()
+        flash('Dữ liệu vừa được người khác cập nhật. Thao tác của bạn chưa được lưu, vui lòng thử lại.', 'warning')
+        return redirect(request.referrer or url_for('main.index'))
+    @app.errorhandler(InvalidTransition)
+    def invalid_transition(e):
+        db.session.rollback()
+        flash(f'Thao tác không hợp lệ: {e}', 'error')
+        return redirect(request.referrer or url_for('main.index'))
+
     return app
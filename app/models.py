@@ -3,9 +3,11 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 # --- THÊM IMPORT ---
 # --- SỬA LẠI: Import Date từ datetime ---
-from datetime import datetime, timedelta, timezone, date
+from datetime import datetime, timedelta, timezone
 from flask import current_app
 from itsdangerous import URLSafeTimedSerializer as Serializer
+from sqlalchemy.orm import validates
+from .services.state_machine import check_transition
 # --- (Kết thúc thêm import) ---
 
 class User(UserMixin, db.Model):
@@ -21,6 +23,7 @@ class User(UserMixin, db.Model):
 
     # Quan hệ
     transactions = db.relationship('Transaction', backref='user', lazy=True)
+    archived_transactions = db.relationship('TransactionArchive', backref='user', lazy='dynamic')
     borrow_lists = db.relationship('BorrowList', backref='user', lazy=True)
 
 
@@ -75,6 +78,23 @@ class Device(db.Model):
     borrower_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     borrower = db.relationship('User', foreign_keys=[borrower_id])
     transactions = db.relationship('Transaction', backref='device', lazy=True, cascade='all, delete-orphan')
+    archived_transactions = db.relationship('TransactionArchive', backref='device', lazy='dynamic', cascade='all, delete-orphan')
+    history_summary = db.relationship('DeviceHistorySummary', uselist=False, cascade='all, delete-orphan')
+    # Khóa lạc quan: mỗi UPDATE kèm "WHERE version = <cũ>", lệch phiên bản thì ném StaleDataError
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
+
+    @validates('status')
+    def validate_status(self, key, value):
+        return check_transition('Device', self.status, value)
+
+    # Chỉ mục cho phân trang keyset của trang danh mục (sắp xếp theo name, id)
+    # ix_device_category_name_id cũng phục vụ các truy vấn lọc riêng theo category
+    __table_args__ = (
+        db.Index('ix_device_name_id', 'name', 'id'),
+        db.Index('ix_device_category_name_id', 'category', 'name', 'id'),
+        db.Index('ix_device_status', 'status'),
+    )
 
 class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -84,6 +104,48 @@ class Transaction(db.Model):
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # (…, created_at, id): khớp khóa phân trang keyset của các dòng thời gian giao dịch
+        db.Index('ix_transaction_device_created_id', 'device_id', 'created_at', 'id'),
+        db.Index('ix_transaction_user_created_id', 'user_id', 'created_at', 'id'),
+        db.Index('ix_transaction_created_id', 'created_at', 'id'),
+    )
+
+    archived = False
+
+
+class TransactionArchive(db.Model):
+    """Giao dịch cũ hơn ARCHIVE_AFTER_DAYS được archive_service chuyển sang đây (giữ nguyên id),
+    để bảng transaction và các chỉ mục của nó chỉ chứa phần dữ liệu nóng."""
+    __tablename__ = 'transaction_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    transaction_type = db.Column(db.String(20), nullable=False)
+    notes = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_transaction_archive_device_created_id', 'device_id', 'created_at', 'id'),
+        db.Index('ix_transaction_archive_user_created_id', 'user_id', 'created_at', 'id'),
+        db.Index('ix_transaction_archive_created_id', 'created_at', 'id'),
+    )
+
+    archived = True
+
+
+class DeviceHistorySummary(db.Model):
+    """Tóm tắt lịch sử của một thiết bị (phần đã lưu trữ, và số lần/người mượn gần nhất tính cả phần nóng),
+    để trang chi tiết không phải đếm bảng giao dịch hay đọc bảng lưu trữ khi hiển thị."""
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id'), primary_key=True)
+    archived_count = db.Column(db.Integer, nullable=False, default=0)
+    archived_borrow_count = db.Column(db.Integer, nullable=False, default=0)
+    borrow_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Cả nóng lẫn lưu trữ, cộng khi ghi
+    last_borrower_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    last_borrower = db.relationship('User')
+    last_borrowed_at = db.Column(db.DateTime, nullable=True)
+    archived_until = db.Column(db.DateTime, nullable=True) # created_at lớn nhất đã lưu trữ
+
 class BorrowList(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -96,20 +158,135 @@ class BorrowList(db.Model):
     return_deadline = db.Column(db.Date, nullable=True) # Hạn trả = borrowed_at + 30 days
     returned_at = db.Column(db.DateTime, nullable=True) # Thời điểm trả thực tế (null nếu chưa trả)
 
+    # Số món trong phiếu (phi chuẩn hóa, cập nhật khi thêm/xóa món) để khỏi COUNT mỗi lần render
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
+
+    # Trạng thái quá hạn do bộ quét định kỳ (overdue_service) tính sẵn, trang admin chỉ đọc lại
+    overdue = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    overdue_at = db.Column(db.DateTime, nullable=True) # Thời điểm bộ quét đánh dấu quá hạn
+    due_soon_notified_at = db.Column(db.DateTime, nullable=True) # Đã nhắc "sắp đến hạn" lúc nào
+
     items = db.relationship('ListItem', backref='borrow_list', lazy='dynamic', cascade="all, delete-orphan")
 
+    __table_args__ = (
+        db.Index('ix_borrow_list_user_status', 'user_id', 'status'),
+        db.Index('ix_borrow_list_status_returned_deadline', 'status', 'returned_at', 'return_deadline'),
+        # Cửa sổ thời gian mà rollup_service đọc tăng dần
+        db.Index('ix_borrow_list_borrowed_at', 'borrowed_at'),
+        db.Index('ix_borrow_list_overdue_at', 'overdue_at'),
+    )
+
+    @validates('status')
+    def validate_status(self, key, value):
+        return check_transition('BorrowList', self.status, value)
+
     # --- THÊM MỚI: Property để kiểm tra quá hạn ---
     @property
     def is_overdue(self):
-        """Kiểm tra xem phiếu mượn này có bị quá hạn không."""
-        # Chỉ kiểm tra nếu phiếu đã hoàn tất, chưa trả, và có hạn trả
-        if self.status == 'Completed' and self.returned_at is None and self.return_deadline:
-            return date.today() > self.return_deadline
-        return False
+        """Phiếu đang quá hạn: đã hoàn tất, chưa trả và đã được bộ quét đánh dấu quá hạn."""
+        return self.status == 'Completed' and self.returned_at is None and self.overdue
 
 
 class ListItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    list_id = db.Column(db.Integer, db.ForeignKey('borrow_list.id'), nullable=False)
-    device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False)
-    device = db.relationship('Device')
\ No newline at end of file
+    list_id = db.Column(db.Integer, db.ForeignKey('borrow_list.id'), nullable=False, index=True)
+    device_id = db.Column(db.Integer, db.ForeignKey('device.id'), nullable=False, index=True)
+    device = db.relationship('Device')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow) # Thời điểm đưa vào giỏ (NULL với dữ liệu cũ)
+
+class CacheVersion(db.Model):
+    """Bộ đếm phiên bản dùng chung giữa các worker: tăng mỗi khi dữ liệu được cache thay đổi."""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class EmailOutbox(db.Model):
+    """Hàng đợi email bền vững: route ghi vào đây trong cùng giao dịch, bộ gửi nền sẽ gửi sau."""
+    id = db.Column(db.Integer, primary_key=True)
+    to_email = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html_content = db.Column(db.Text, nullable=False)
+    # Khóa chống gửi trùng (vd. 'request-ready:12'); NULL nếu không cần
+    dedup_key = db.Column(db.String(120), unique=True, nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='Pending') # Pending, Sending, Sent, Dead
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime, nullable=True) # Hạn giữ khi đang gửi, quá hạn thì worker khác nhận lại
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+class ImportJob(db.Model):
+    """Một lần nhập thiết bị từ file: file được lưu tạm ra đĩa, worker nền xử lý và ghi tiến độ vào đây."""
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), nullable=False) # Tên file gốc (quyết định cách đọc .xlsx/.csv)
+    stored_path = db.Column(db.String(500), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='Queued') # Queued, Running, Completed, Failed
+    created_by_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    total_rows = db.Column(db.Integer, nullable=True) # Ước lượng, để hiển thị phần trăm
+    rows_processed = db.Column(db.Integer, nullable=False, default=0)
+    added_count = db.Column(db.Integer, nullable=False, default=0)
+    duplicate_count = db.Column(db.Integer, nullable=False, default=0)
+    invalid_count = db.Column(db.Integer, nullable=False, default=0)
+    result_json = db.Column(db.Text) # ImportResult.to_dict(), cập nhật sau mỗi lô
+    error = db.Column(db.Text)
+    locked_until = db.Column(db.DateTime, nullable=True) # Hạn giữ của worker đang chạy, gia hạn sau mỗi lô
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    created_by = db.relationship('User')
+
+    __table_args__ = (
+        db.Index('ix_import_job_status_created', 'status', 'created_at'),
+    )
+
+    @property
+    def percent(self):
+        if self.status == 'Completed':
+            return 100
+        if not self.total_rows:
+            return 0
+        return min(99, int(self.rows_processed * 100 / self.total_rows))
+
+class ImageAsset(db.Model):
+    """Ảnh thiết bị lưu theo mã băm nội dung (SHA-256): ảnh trùng chỉ lưu một lần, refcount = số thiết bị đang dùng."""
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), unique=True, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class DailyRollup(db.Model):
+    """Số liệu cộng dồn theo ngày (giờ Việt Nam) x danh mục x vị trí, do rollup_service cập nhật tăng dần."""
+    __tablename__ = 'daily_rollup'
+    day = db.Column(db.Date, primary_key=True)
+    category = db.Column(db.String(50), primary_key=True)
+    location = db.Column(db.String(100), primary_key=True)
+    borrows = db.Column(db.Integer, nullable=False, default=0)
+    returns = db.Column(db.Integer, nullable=False, default=0)
+    reservations = db.Column(db.Integer, nullable=False, default=0) # Số thiết bị được đưa vào giỏ mượn
+    overdue = db.Column(db.Integer, nullable=False, default=0)      # Số thiết bị thuộc phiếu bị đánh dấu quá hạn
+    # Tổng và số mẫu của thời gian chờ (giây) từ lúc tạo phiếu đến lúc nhận đồ; trung bình = tổng / số mẫu
+    lead_time_seconds = db.Column(db.Float, nullable=False, default=0)
+    lead_time_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class RollupState(db.Model):
+    """Watermark của từng nguồn dữ liệu cho rollup. Khóa lạc quan để hai tiến trình chạy cùng lúc không cộng trùng."""
+    __tablename__ = 'rollup_state'
+    name = db.Column(db.String(50), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=True)
+    last_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    __mapper_args__ = {'version_id_col': version}
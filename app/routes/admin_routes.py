@@ -1,33 +1,38 @@
-import pandas as pd
 # --- THÊM MỚI: Import datetime ---
 from datetime import datetime, timedelta, date
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, send_file, abort, current_app, Response
 from flask_login import login_required, current_user
 from .. import admin_required
 # Import tất cả model và db
-from ..models import db, User, Device, Transaction, BorrowList, ListItem
+from ..models import db, User, Device, Transaction, BorrowList, ListItem, ImportJob
 # --- THÊM MỚI: Import hàm gửi email thông báo sẵn sàng ---
 from ..services.email_service import send_request_ready_email # Đảm bảo import dòng này
-from sqlalchemy import desc
+from ..services import stats_service, import_service, import_job_service, analytics_export_service, pdf_service, overdue_service, \
+    archive_service, rollup_service, utilization_service, metrics_service, profiler_service
+from ..services.state_machine import DEVICE_TRANSITIONS, check_version
+from sqlalchemy import desc, func
+from sqlalchemy.orm import joinedload
 
 admin_bp = Blueprint('admin', __name__)
 
+def list_item_counts(borrow_lists):
+    """Đếm số món của nhiều phiếu bằng MỘT câu GROUP BY thay vì items.count() cho từng phiếu."""
+    list_ids = [bl.id for bl in borrow_lists]
+    if not list_ids:
+        return {}
+    rows = db.session.query(ListItem.list_id, func.count(ListItem.id)) \
+        .filter(ListItem.list_id.in_(list_ids)).group_by(ListItem.list_id).all()
+    return dict(rows)
+
 @admin_bp.route('/dashboard')
 @login_required
 @admin_required
 def dashboard():
-    stats = {
-        'users': User.query.count(),
-        'devices': Device.query.count(),
-        'transactions': Transaction.query.count(),
-        'pending_requests': BorrowList.query.filter_by(status='Submitted').count(),
-        'overdue_count': BorrowList.query.filter(
-            BorrowList.status == 'Completed',
-            BorrowList.returned_at == None,
-            BorrowList.return_deadline < date.today()
-        ).count()
-    }
-    return render_template('admin/dashboard.html', stats=stats)
+    stats = stats_service.dashboard_stats()
+    # Biểu đồ đọc bảng daily_rollup đã tính sẵn, không quét bảng giao dịch
+    days = min(max(request.args.get('days', 30, type=int), 7), 365)
+    return render_template('admin/dashboard.html', stats=stats, trends=rollup_service.trends(days), days=days,
+                           rollup_updated_at=rollup_service.last_updated_at())
 
 @admin_bp.route('/users')
 @login_required
@@ -42,24 +47,28 @@ def users():
 @admin_required
 def devices():
     page = request.args.get('page', 1, type=int)
-    devices_list = Device.query.order_by(Device.created_at.desc()).paginate(page=page, per_page=15)
-    return render_template('admin/devices.html', devices=devices_list)
+    devices_list = Device.query.options(joinedload(Device.created_by)).order_by(Device.created_at.desc()).paginate(page=page, per_page=15)
+    return render_template('admin/devices.html', devices=devices_list, statuses=list(DEVICE_TRANSITIONS))
 
 @admin_bp.route('/transactions')
 @login_required
 @admin_required
 def transactions():
-    page = request.args.get('page', 1, type=int)
-    transactions_list = Transaction.query.order_by(Transaction.created_at.desc()).paginate(page=page, per_page=20)
-    return render_template('admin/transactions.html', transactions=transactions_list)
+    # Keyset theo (created_at, id) thay cho OFFSET + COUNT(*): trang sâu nhanh như trang đầu
+    page = archive_service.timeline(current_app.config['TRANSACTIONS_PER_PAGE'], after=request.args.get('after'),
+                                    before=request.args.get('before'))
+    return render_template('admin/transactions.html', transactions=page.items, page=page,
+                           transaction_total=stats_service.transaction_count())
 
 @admin_bp.route('/user/<int:user_id>')
 @login_required
 @admin_required
 def user_detail(user_id):
     user = User.query.get_or_404(user_id)
-    transactions = Transaction.query.filter_by(user_id=user.id).order_by(Transaction.created_at.desc()).all()
-    return render_template('admin/user_detail.html', user=user, transactions=transactions)
+    page = archive_service.timeline(current_app.config['TRANSACTIONS_PER_PAGE'], after=request.args.get('after'),
+                                    before=request.args.get('before'), user_id=user.id)
+    return render_template('admin/user_detail.html', user=user, transactions=page.items, page=page,
+                           transaction_total=stats_service.transaction_count(user_id=user.id))
 
 
 # --- CÁC ROUTE QUẢN LÝ YÊU CẦU ---
@@ -68,43 +77,41 @@ def user_detail(user_id):
 @login_required
 @admin_required
 def requests_list():
-    submitted_lists = BorrowList.query.filter_by(status='Submitted').order_by(BorrowList.created_at.asc()).all()
-    ready_lists = BorrowList.query.filter_by(status='Ready').order_by(BorrowList.created_at.asc()).all()
+    with_user = joinedload(BorrowList.user)
+    submitted_lists = BorrowList.query.options(with_user).filter_by(status='Submitted').order_by(BorrowList.created_at.asc()).all()
+    ready_lists = BorrowList.query.options(with_user).filter_by(status='Ready').order_by(BorrowList.created_at.asc()).all()
     return render_template('admin_requests.html',
                            submitted_lists=submitted_lists,
-                           ready_lists=ready_lists)
+                           ready_lists=ready_lists,
+                           item_counts=list_item_counts(submitted_lists + ready_lists))
 
 @admin_bp.route('/request/<int:list_id>')
 @login_required
 @admin_required
 def request_detail(list_id):
-    borrow_list = BorrowList.query.get_or_404(list_id)
-    return render_template('admin_request_detail.html', borrow_list=borrow_list)
+    borrow_list = BorrowList.query.options(joinedload(BorrowList.user)).filter_by(id=list_id).first_or_404()
+    items = borrow_list.items.options(joinedload(ListItem.device)).all()
+    return render_template('admin_request_detail.html', borrow_list=borrow_list, items=items)
 
 @admin_bp.route('/request/<int:list_id>/ready', methods=['POST'])
 @login_required
 @admin_required
 def mark_as_ready(list_id):
     borrow_list = BorrowList.query.get_or_404(list_id)
+    check_version(borrow_list, request.form.get('version'))
     if borrow_list.status == 'Submitted':
         borrow_list.status = 'Ready'
         try:
-            db.session.commit() # Lưu thay đổi trạng thái trước
+            # Email được ghi vào hàng đợi trong CÙNG giao dịch với việc đổi trạng thái,
+            # bộ gửi nền sẽ gửi (và thử lại nếu lỗi) mà không chặn request này
+            email_queued = send_request_ready_email(borrow_list)
+            db.session.commit()
             flash(f'Đã đánh dấu phiếu #{list_id} là Sẵn sàng.', 'success')
-
-            # --- Gửi email thông báo ---
-            # Gọi hàm gửi email SAU KHI commit thành công
-            email_sent = send_request_ready_email(borrow_list) # Gọi hàm đã import
-            if email_sent:
-                flash(f'Đã gửi email thông báo cho sinh viên {borrow_list.user.email}.', 'info')
-            else:
-                # Lỗi gửi email không làm ảnh hưởng đến việc đổi status
-                flash(f'LỖI khi gửi email thông báo cho sinh viên {borrow_list.user.email}. Vui lòng kiểm tra log hoặc cấu hình SendGrid.', 'danger')
-            # --- (Kết thúc gửi email) ---
-
+            if email_queued:
+                flash(f'Email thông báo cho sinh viên {borrow_list.user.email} đã được đưa vào hàng đợi gửi.', 'info')
         except Exception as e:
             db.session.rollback() # Hoàn tác nếu có lỗi commit
-            flash(f'Lỗi khi cập nhật trạng thái hoặc gửi email: {e}', 'danger')
+            flash(f'Lỗi khi cập nhật trạng thái: {e}', 'danger')
 
     else:
         flash('Yêu cầu này không ở trạng thái "Submitted".', 'warning')
@@ -118,6 +125,7 @@ def mark_as_ready(list_id):
 @admin_required
 def mark_as_completed(list_id):
     borrow_list = BorrowList.query.get_or_404(list_id)
+    check_version(borrow_list, request.form.get('version'))
     if borrow_list.status != 'Ready':
         flash('Yêu cầu này không ở trạng thái "Ready".', 'error')
         return redirect(url_for('admin.request_detail', list_id=list_id))
@@ -142,6 +150,7 @@ def mark_as_completed(list_id):
 @admin_required
 def cancel_request(list_id):
     borrow_list = BorrowList.query.get_or_404(list_id)
+    check_version(borrow_list, request.form.get('version'))
     if borrow_list.status not in ['Submitted', 'Ready']:
         flash('Không thể hủy yêu cầu này.', 'error'); return redirect(url_for('admin.request_detail', list_id=list_id))
     items_released = 0
@@ -161,14 +170,29 @@ def cancel_request(list_id):
 @admin_required
 def overdue_list():
     today = date.today()
-    overdue_borrow_lists = BorrowList.query.filter(BorrowList.status == 'Completed', BorrowList.returned_at == None, BorrowList.return_deadline < today).order_by(BorrowList.return_deadline.asc()).all()
-    return render_template('admin_overdue.html', overdue_lists=overdue_borrow_lists, today=today)
+    # Cờ quá hạn do bộ quét định kỳ (overdue_service) tính sẵn
+    overdue_borrow_lists = BorrowList.query.options(joinedload(BorrowList.user)).filter(BorrowList.status == 'Completed', BorrowList.returned_at == None, BorrowList.overdue == True).order_by(BorrowList.return_deadline.asc()).all()
+    return render_template('admin_overdue.html', overdue_lists=overdue_borrow_lists, today=today,
+                           item_counts=list_item_counts(overdue_borrow_lists), last_scan_at=overdue_service.last_scan_at())
+
+@admin_bp.route('/overdue/scan', methods=['POST'])
+@login_required
+@admin_required
+def overdue_scan():
+    try:
+        overdue, due_soon = overdue_service.scan()
+        flash(f'Đã quét: {overdue} phiếu mới quá hạn, {due_soon} phiếu sắp đến hạn đã được nhắc.', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Lỗi khi quét quá hạn: {e}', 'danger')
+    return redirect(url_for('admin.overdue_list'))
 
 @admin_bp.route('/mark_returned/<int:list_id>', methods=['POST'])
 @login_required
 @admin_required
 def mark_as_returned(list_id):
     borrow_list = BorrowList.query.get_or_404(list_id)
+    check_version(borrow_list, request.form.get('version'))
     if borrow_list.status != 'Completed':
         flash('Phiếu này chưa hoàn tất giao đồ.', 'error'); return redirect(request.referrer or url_for('admin.overdue_list'))
     if borrow_list.returned_at is not None:
@@ -206,56 +230,199 @@ def upload_devices():
         if 'file' not in request.files: flash('Không tìm thấy file.', 'error'); return redirect(request.url)
         file = request.files['file'];
         if file.filename == '': flash('Không có file nào được chọn.', 'info'); return redirect(request.url)
-        if file and (file.filename.endswith('.xlsx') or file.filename.endswith('.xls')):
-            try:
-                # Đọc file và kiểm tra cột bắt buộc
-                df = pd.read_excel(file, engine='openpyxl')
-                required_columns = ['name', 'serial']
-                df_columns_lower = [str(c).lower() for c in df.columns]
-                if not all(col.lower() in df_columns_lower for col in required_columns):
-                    flash(f'File Excel phải có các cột bắt buộc: {", ".join(required_columns)}', 'error'); return redirect(request.url)
-                df.columns = df_columns_lower # Chuẩn hóa tên cột
-
-                added_count, error_serials, missing_data_rows = 0, [], 0
-                processed_serials_in_file = set() # Kiểm tra trùng trong file
-
-                for index, row in df.iterrows():
-                    # Lấy và làm sạch dữ liệu
-                    name = str(row.get('name', '')).strip()
-                    serial_raw = row.get('serial')
-                    serial = str(serial_raw).strip().upper() if not pd.isna(serial_raw) else None
-
-                    if not name or not serial: missing_data_rows += 1; continue # Bỏ qua nếu thiếu
-
-                    # Kiểm tra trùng lặp
-                    if serial in processed_serials_in_file:
-                        error_serials.append(f"{serial} (trùng trong file)"); continue
-                    processed_serials_in_file.add(serial)
-                    if Device.query.filter_by(serial=serial).first():
-                        error_serials.append(f"{serial} (đã có trong CSDL)"); continue
-
-                    # Lấy và chuẩn hóa dữ liệu tùy chọn
-                    category = str(row.get('category', 'Other')).strip(); description = str(row.get('description', '')).strip(); location = str(row.get('location', 'Kho chính')).strip(); unit = str(row.get('unit', 'Cái')).strip()
-                    category = 'Other' if pd.isna(row.get('category')) or not category else category
-                    description = '' if pd.isna(row.get('description')) else description
-                    location = 'Kho chính' if pd.isna(row.get('location')) or not location else location
-                    unit = 'Cái' if pd.isna(row.get('unit')) or not unit else unit
-
-                    # Tạo đối tượng Device
-                    new_device = Device(name=name, serial=serial, category=category, description=description, location=location, unit=unit, created_by_id=current_user.id, status='Available')
-                    db.session.add(new_device); added_count += 1
-
-                # Lưu vào CSDL
-                db.session.commit()
-
-                # Flash thông báo kết quả
-                if added_count > 0: flash(f'Đã thêm thành công {added_count} thiết bị mới.', 'success')
-                if not error_serials and not missing_data_rows and added_count == 0: flash('Không có thiết bị nào được thêm (file rỗng hoặc chỉ chứa serial đã tồn tại/trùng lặp).', 'info')
-                if error_serials: flash(f'Các serial sau bị lỗi hoặc đã tồn tại và bị bỏ qua: {", ".join(error_serials)}', 'warning')
-                if missing_data_rows > 0: flash(f'Đã bỏ qua {missing_data_rows} dòng do thiếu Tên hoặc Serial.', 'info')
-
-                return redirect(url_for('admin.upload_devices'))
-            except Exception as e:
-                db.session.rollback(); flash(f'Đã xảy ra lỗi nghiêm trọng khi xử lý file: {e}. Đã hoàn tác mọi thay đổi.', 'danger'); return redirect(request.url)
-        else: flash('Định dạng file không hợp lệ. Vui lòng chỉ upload file .xlsx hoặc .xls.', 'error'); return redirect(request.url)
-    return render_template('admin_upload.html')
\ No newline at end of file
+        try:
+            # Chỉ lưu file và tạo job; worker nền xử lý để request không bị timeout với file lớn
+            job = import_job_service.enqueue(file, current_user.id)
+            db.session.commit()
+        except import_service.ImportFileError as e:
+            db.session.rollback(); flash(str(e), 'error'); return redirect(request.url)
+        except Exception as e:
+            db.session.rollback(); flash(f'Không thể lưu file tải lên: {e}', 'danger'); return redirect(request.url)
+        flash(f'Đã nhận file "{job.filename}", đang xử lý nền.', 'info')
+        return redirect(url_for('admin.upload_devices', job=job.id))
+    job = ImportJob.query.get(request.args.get('job', type=int)) if request.args.get('job') else None
+    recent_jobs = ImportJob.query.order_by(ImportJob.id.desc()).limit(10).all()
+    return render_template('admin_upload.html', job=job, recent_jobs=recent_jobs)
+
+
+@admin_bp.route('/import-jobs/<int:job_id>/status')
+@login_required
+@admin_required
+def import_job_status(job_id):
+    """Endpoint JSON mà trang upload thăm dò định kỳ."""
+    job = ImportJob.query.get_or_404(job_id)
+    return jsonify(import_job_service.job_status(job))
+
+
+@admin_bp.route('/import-jobs/<int:job_id>')
+@login_required
+@admin_required
+def import_job_result(job_id):
+    job = ImportJob.query.get_or_404(job_id)
+    return render_template('admin_import_job.html', job=job, result=import_job_service.job_result(job))
+
+
+# --- TỈ LỆ SỬ DỤNG THIẾT BỊ ---
+
+@admin_bp.route('/utilization')
+@login_required
+@admin_required
+def utilization():
+    days = min(max(request.args.get('days', 90, type=int), 1), 730)
+    category, device_class = request.args.get('category') or None, request.args.get('class') or None
+    result = utilization_service.report(days)
+    devices = result['devices']
+    if category:
+        devices = devices[devices['category'] == category]
+    if device_class:
+        devices = devices[devices['class'] == device_class]
+    if request.args.get('format') == 'csv':
+        return Response(devices.to_csv(index=False, float_format='%.3f'), mimetype='text/csv',
+                        headers={"Content-disposition": f"attachment; filename=utilization_{days}d.csv"})
+    limit = 200 # Bảng HTML chỉ hiện phần đầu, bản đầy đủ tải bằng CSV
+    return render_template('admin/utilization.html', result=result, days=days, category=category,
+                           device_class=device_class, devices=devices.head(limit).to_dict('records'),
+                           device_total=len(devices), categories=result['categories'].to_dict('records'),
+                           classes=(utilization_service.IDLE, utilization_service.NORMAL, utilization_service.OVERSUBSCRIBED))
+
+
+# --- SỐ LIỆU HIỆU NĂNG REQUEST ---
+
+@admin_bp.route('/metrics')
+def metrics():
+    # Prometheus đọc bằng Bearer token (METRICS_TOKEN); người dùng thì phải là admin
+    if not metrics_service.token_authorized() and not (current_user.is_authenticated and current_user.is_admin):
+        abort(403)
+    return Response(metrics_service.prometheus_text(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@admin_bp.route('/metrics/summary')
+@login_required
+@admin_required
+def metrics_summary():
+    data = metrics_service.aggregate()
+    return render_template('admin/metrics.html', rows=metrics_service.summary_rows(data), data=data,
+                           slow=data['slow'][:current_app.config.get('SLOW_REQUEST_LOG_SIZE', 100)],
+                           threshold=current_app.config.get('SLOW_REQUEST_THRESHOLD_MS', 500))
+
+
+# --- PROFILE THEO YÊU CẦU ---
+
+@admin_bp.route('/profiles', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def profiles():
+    profile_url = None
+    if request.method == 'POST':
+        # Link có token ký sẵn để profile một request (dùng được từ trình duyệt khác hoặc curl)
+        path = request.form.get('path') or '/'
+        if not path.startswith('/'):
+            flash('Đường dẫn phải bắt đầu bằng "/".', 'error'); return redirect(url_for('admin.profiles'))
+        args = {profiler_service.QUERY_FLAG: profiler_service.make_token(current_user.id),
+                profiler_service.MODE_FLAG: request.form.get('mode', 'cprofile')}
+        profile_url = request.host_url.rstrip('/') + path + ('&' if '?' in path else '?') + \
+            '&'.join(f'{k}={v}' for k, v in args.items())
+    return render_template('admin/profiles.html', profiles=profiler_service.list_profiles(), profile_url=profile_url,
+                           modes=profiler_service.MODES, max_age=current_app.config.get('PROFILE_TOKEN_MAX_AGE', 3600))
+
+@admin_bp.route('/profiles/<profile_id>')
+@login_required
+@admin_required
+def profile_detail(profile_id):
+    loaded = profiler_service.load(profile_id)
+    if loaded is None:
+        abort(404)
+    meta, statements = loaded
+    stacks = profiler_service.collapsed_stacks(profile_id)
+    return render_template('admin/profile_detail.html', meta=meta, statements=statements,
+                           flame=profiler_service.flame_rows(stacks), flame_total=sum(stacks.values()),
+                           stats=profiler_service.stats_text(profile_id) if meta['mode'] == 'cprofile' else None)
+
+@admin_bp.route('/profiles/<profile_id>/<kind>')
+@login_required
+@admin_required
+def profile_download(profile_id, kind):
+    if kind not in ('cprofile', 'sample', 'sql'):
+        abort(404)
+    filename = profiler_service.FILES[kind]
+    return send_from_directory(current_app.config['PROFILE_DIR'], f'{profile_id}/{filename}', as_attachment=True,
+                               download_name=f'{profile_id}-{filename}')
+
+
+# --- XUẤT DỮ LIỆU PHÂN TÍCH (PARQUET/FEATHER) ---
+
+@admin_bp.route('/analytics-export', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def analytics_export():
+    fmt = request.values.get('format', current_app.config.get('ANALYTICS_EXPORT_FORMAT', 'parquet'))
+    if fmt not in analytics_export_service.FORMATS:
+        abort(400)
+    if request.method == 'POST':
+        try:
+            written = analytics_export_service.export_all(fmt, full=bool(request.form.get('full')))
+            flash('Đã xuất: ' + ', '.join(f'{name} {count} dòng' for name, count in written.items()), 'success')
+        except Exception as e:
+            flash(f'Lỗi khi xuất dữ liệu: {e}', 'danger')
+        return redirect(url_for('admin.analytics_export', format=fmt))
+    files, manifest = analytics_export_service.list_files(fmt)
+    return render_template('admin/analytics_export.html', fmt=fmt, formats=list(analytics_export_service.FORMATS),
+                           files=files, manifest=manifest)
+
+
+@admin_bp.route('/analytics-export/<fmt>/<path:filename>')
+@login_required
+@admin_required
+def analytics_export_download(fmt, filename):
+    if fmt not in analytics_export_service.FORMATS:
+        abort(404)
+    # send_from_directory từ chối đường dẫn thoát ra ngoài thư mục
+    return send_from_directory(analytics_export_service.export_dir(fmt), filename, as_attachment=True)
+
+
+# --- PHIẾU IN PDF ---
+
+def _send_pdf(render, download_name):
+    """Gửi file PDF từ cache; nếu process pool chưa render xong thì trả 202 với trang tự tải lại."""
+    try:
+        path = render()
+    except pdf_service.PdfPending:
+        return render_template('pdf_pending.html', retry_after=2), 202, {'Retry-After': '2'}
+    except pdf_service.PdfFailed:
+        flash('Không tạo được file PDF, vui lòng thử lại sau.', 'error')
+        return redirect(request.referrer or url_for('admin.requests_list'))
+    return send_file(path, mimetype='application/pdf', download_name=download_name)
+
+
+@admin_bp.route('/request/<int:list_id>/slip.pdf')
+@login_required
+@admin_required
+def request_slip_pdf(list_id):
+    borrow_list = BorrowList.query.options(joinedload(BorrowList.user)).filter_by(id=list_id).first_or_404()
+    if borrow_list.status not in pdf_service.PRINTABLE_STATUSES:
+        abort(404)
+    return _send_pdf(lambda: pdf_service.borrow_list_pdf(borrow_list), f'phieu-muon-{borrow_list.id}.pdf')
+
+
+@admin_bp.route('/requests/slips.pdf')
+@login_required
+@admin_required
+def daily_slips_pdf():
+    """Gộp mọi phiếu mượn của một ngày (?date=YYYY-MM-DD, mặc định hôm nay) thành một file để in một lần."""
+    try:
+        day = datetime.strptime(request.args['date'], '%Y-%m-%d').date() if request.args.get('date') else date.today()
+    except ValueError:
+        abort(400)
+    lists = pdf_service.lists_for_day(day)
+    if not lists:
+        flash(f'Không có phiếu mượn nào trong ngày {day.strftime("%d-%m-%Y")}.', 'info')
+        return redirect(url_for('admin.requests_list'))
+    return _send_pdf(lambda: pdf_service.daily_pdf(day, lists), f'phieu-muon-{day.isoformat()}.pdf')
+
+
+@admin_bp.route('/transactions/<int:transaction_id>/slip.pdf')
+@login_required
+@admin_required
+def transaction_slip_pdf(transaction_id):
+    """Phiếu mượn/trả cho cả lô giao dịch hàng loạt chứa giao dịch này."""
+    transaction = Transaction.query.options(joinedload(Transaction.user)).filter_by(id=transaction_id).first_or_404()
+    return _send_pdf(lambda: pdf_service.transaction_batch_pdf(transaction), f'phieu-giao-dich-{transaction.id}.pdf')
@@ -1,13 +1,13 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, Response
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, Response, stream_with_context, abort
 from flask_login import login_required, current_user
 # --- SỬA LẠI: Bỏ BorrowSlip, import đủ model mới nhất ---
 from ..models import db, Device, Transaction, User, BorrowList, ListItem
 from ..services.email_service import send_transaction_email, send_batch_transaction_email
-from sqlalchemy import or_, desc
-from werkzeug.utils import secure_filename
-import os, uuid, csv
-from io import StringIO
 from .. import admin_required
+from ..services.pagination import keyset_paginate
+from ..services.search_service import search_filter
+from ..services import cart_service, inventory_service, export_service, image_service, http_cache, stats_service, archive_service
+from ..services.state_machine import allowed_targets, check_version
 
 # --- KHỞI TẠO BLUEPRINT ---
 device_bp = Blueprint('device', __name__)
@@ -19,26 +19,16 @@ def allowed_file(filename):
 
 # --- CÁC ROUTE CHÍNH VỀ THIẾT BỊ ---
 
-@device_bp.route('/devices')
-@login_required
-def devices():
-    """Hiển thị danh sách thiết bị VỚI LỌC THEO TAB DANH MỤC."""
-
-    # --- Lấy danh mục và query string từ URL ---
-    query_string = request.args.get('query', '').strip()
-    category = request.args.get('category') # Lấy danh mục từ URL
-
-    # Danh sách các tab chính bạn muốn hiển thị
-    main_categories = ["Dụng cụ", "Thiết bị điện", "Vật tư"]
+# Danh sách các tab chính bạn muốn hiển thị
+MAIN_CATEGORIES = ["Dụng cụ", "Thiết bị điện", "Vật tư"]
 
+def filtered_devices_query(query_string, category):
+    """Dựng query thiết bị theo tab danh mục và ô tìm kiếm (dùng chung cho trang danh sách và thao tác hàng loạt)."""
     devices_query = Device.query
 
     # --- 1. Lọc theo Danh mục (Category) trước ---
-    if category and category in main_categories:
+    if category and category in MAIN_CATEGORIES:
         devices_query = devices_query.filter_by(category=category)
-    # (Bạn có thể thêm một tab 'Khác' nếu muốn)
-    # elif category == 'Khác':
-    #    devices_query = devices_query.filter(Device.category.notin_(main_categories))
 
     # --- 2. Lọc theo Tìm kiếm (Search) sau ---
     if query_string:
@@ -47,36 +37,50 @@ def devices():
 
         if search_terms:
             if len(search_terms) == 1:
-                search_term_single = f"%{search_terms[0]}%"
-                devices_query = devices_query.filter(or_(Device.name.ilike(search_term_single), Device.serial.ilike(search_term_single)))
+                # Tìm theo chỉ mục (không dấu) thay vì ILIKE '%x%' quét toàn bảng
+                devices_query = devices_query.filter(search_filter(search_terms[0]))
             else:
                 devices_query = devices_query.filter(Device.serial.in_(search_terms))
+    return devices_query
 
-    devices_list = devices_query.order_by(Device.name).all()
+@device_bp.route('/devices')
+@login_required
+@http_cache.conditional
+def devices():
+    """Hiển thị danh sách thiết bị VỚI LỌC THEO TAB DANH MỤC, phân trang keyset theo (name, id)."""
 
-    # (Logic "giỏ hàng" của học sinh vẫn như cũ)
-    pending_list_count = 0
-    if not current_user.is_admin:
-        pending_list = BorrowList.query.filter_by(user_id=current_user.id, status='Pending').first()
-        if pending_list:
-            pending_list_count = pending_list.items.count()
+    # --- Lấy danh mục và query string từ URL ---
+    query_string = request.args.get('query', '').strip()
+    category = request.args.get('category') # Lấy danh mục từ URL
 
+    devices_query = filtered_devices_query(query_string, category)
+    page = keyset_paginate(devices_query, [Device.name, Device.id],
+                           per_page=current_app.config['DEVICES_PER_PAGE'],
+                           after=request.args.get('after'), before=request.args.get('before'))
+
+    # (Số món trong "giỏ hàng" được context processor inject_pending_list_count cung cấp)
     # --- Gửi thêm thông tin tab ra template ---
     return render_template('devices.html',
-                           devices=devices_list,
+                           devices=page.items,
+                           page=page,
                            query=query_string,
-                           pending_list_count=pending_list_count,
-                           main_categories=main_categories,
+                           main_categories=MAIN_CATEGORIES,
                            current_category=category) # Gửi danh mục hiện tại
 
 
 @device_bp.route('/device/<int:device_id>')
 @login_required
+@http_cache.conditional
 def device_detail(device_id):
     """Hiển thị trang chi tiết của một thiết bị."""
     device = Device.query.get_or_404(device_id)
-    transactions = Transaction.query.filter_by(device_id=device_id).order_by(desc(Transaction.created_at)).all()
-    return render_template('device_detail.html', device=device, transactions=transactions)
+    # Keyset theo (created_at, id) trên chỉ mục (device_id, created_at, id): trang nào cũng chỉ đọc per_page dòng;
+    # lật quá phần nóng thì đọc tiếp bảng lưu trữ
+    page = archive_service.timeline(current_app.config['TRANSACTIONS_PER_PAGE'], after=request.args.get('after'),
+                                    before=request.args.get('before'), device_id=device_id)
+    return render_template('device_detail.html', device=device, transactions=page.items, page=page,
+                           transaction_total=stats_service.transaction_count(device_id=device_id),
+                           usage=archive_service.device_usage(device_id))
 
 # --- CÁC ROUTE QUẢN LÝ (YÊU CẦU ADMIN) ---
 
@@ -97,31 +101,28 @@ def add_device():
             flash('Tên thiết bị và Serial không được để trống!', 'error'); return render_template('add_device.html', form=request.form)
 
         serials = [s.strip().upper() for s in serials_input.splitlines() if s.strip()]
-        image_filename = None
+        image_hash = None
         if 'image' in request.files:
             file = request.files['image']
             if file and file.filename and allowed_file(file.filename):
-                unique_filename = str(uuid.uuid4()) + "_" + secure_filename(file.filename)
-                file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)); image_filename = unique_filename
-
-        added_count, error_serials = 0, []
-        for serial in serials:
-            if Device.query.filter_by(serial=serial).first(): error_serials.append(serial); continue
-            new_device = Device(name=name, serial=serial,
-                                category=request.form.get('category', 'Other'),
-                                # --- THÊM MỚI: Thêm unit vào ---
-                                unit=unit,
-                                description=request.form.get('description'),
-                                location=request.form.get('location'),
-                                image_url=image_filename,
-                                created_by_id=current_user.id,
-                                status='Available'
-                                )
-            db.session.add(new_device); added_count += 1
-
-        if error_serials: flash(f'Các serial sau đã tồn tại: {", ".join(error_serials)}', 'warning')
+                try:
+                    # Mọi thiết bị trong lần thêm hàng loạt dùng chung một ảnh (refcount = số thiết bị)
+                    image_hash = image_service.store(file)
+                except image_service.InvalidImage as e:
+                    flash(str(e), 'error'); return render_template('add_device.html', form=request.form)
+
+        fields = {'name': name, 'category': request.form.get('category', 'Other'), 'unit': unit,
+                  'description': request.form.get('description'), 'location': request.form.get('location'),
+                  'image_url': image_hash}
+        # Một lệnh INSERT ... ON CONFLICT DO NOTHING cho mỗi lô serial thay vì một SELECT cho từng serial
+        added_count, existing_serials, repeated_serials = inventory_service.bulk_create_devices(serials, fields, current_user.id)
+
+        if existing_serials: flash(f'Các serial sau đã tồn tại: {", ".join(existing_serials)}', 'warning')
+        if repeated_serials: flash(f'Các serial sau bị lặp trong danh sách nhập (chỉ thêm một lần): {", ".join(sorted(set(repeated_serials)))}', 'warning')
         if added_count > 0:
+            if image_hash: image_service.acquire(image_hash, added_count)
             db.session.commit(); flash(f'Đã thêm thành công {added_count} thiết bị!', 'success'); return redirect(url_for('device.devices'))
+        db.session.rollback()
         flash('Không có thiết bị nào được thêm.', 'info')
     return render_template('add_device.html')
 
@@ -132,6 +133,7 @@ def edit_device(device_id):
     """Chỉnh sửa thông tin một thiết bị."""
     device = Device.query.get_or_404(device_id)
     if request.method == 'POST':
+        check_version(device, request.form.get('version')) # Admin khác đã lưu sau khi form này được mở
         # --- CẬP NHẬT: Thêm 'unit' vào ---
         device.name = request.form['name']
         device.serial = request.form['serial']
@@ -139,19 +141,29 @@ def edit_device(device_id):
         device.unit = request.form.get('unit', 'Cái') # Thêm dòng này
         device.description = request.form['description']
         device.location = request.form['location']
-        device.status = request.form['status']
+        new_status = request.form['status']
+        if new_status not in allowed_targets('Device', device.status):
+            db.session.rollback()
+            flash(f'Không thể chuyển trạng thái từ "{device.status}" sang "{new_status}".', 'error')
+            return render_template('edit_device.html', device=device, allowed_statuses=allowed_targets('Device', device.status))
+        device.status = new_status
         
         if 'image' in request.files:
             file = request.files['image']
             if file and file.filename and allowed_file(file.filename):
-                if device.image_url:
-                    old_path = os.path.join(current_app.config['UPLOAD_FOLDER'], device.image_url)
-                    if os.path.exists(old_path): os.remove(old_path)
-                unique_filename = str(uuid.uuid4()) + "_" + secure_filename(file.filename)
-                file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)); device.image_url = unique_filename
+                try:
+                    image_hash = image_service.store(file)
+                except image_service.InvalidImage as e:
+                    db.session.rollback(); flash(str(e), 'error')
+                    return redirect(url_for('device.edit_device', device_id=device_id))
+                if image_hash != device.image_url:
+                    # Ảnh cũ chỉ bị xóa khi không còn thiết bị nào khác dùng (sau khi commit)
+                    image_service.release(device.image_url)
+                    image_service.acquire(image_hash)
+                    device.image_url = image_hash
         db.session.commit(); flash('Cập nhật thiết bị thành công!', 'success')
         return redirect(url_for('device.device_detail', device_id=device.id))
-    return render_template('edit_device.html', device=device)
+    return render_template('edit_device.html', device=device, allowed_statuses=allowed_targets('Device', device.status))
 
 @device_bp.route('/delete-device/<int:device_id>', methods=['POST'])
 @login_required
@@ -159,9 +171,7 @@ def edit_device(device_id):
 def delete_device(device_id):
     """Xóa một thiết bị."""
     device = Device.query.get_or_404(device_id)
-    if device.image_url:
-        image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], device.image_url)
-        if os.path.exists(image_path): os.remove(image_path)
+    image_service.release(device.image_url)
     db.session.delete(device); db.session.commit()
     flash('Đã xóa thiết bị thành công!', 'success')
     return redirect(url_for('device.devices'))
@@ -199,28 +209,35 @@ def return_device(device_id):
     else: flash('Thiết bị này không ở trạng thái đang được mượn.', 'error')
     return redirect(url_for('device.device_detail', device_id=device_id))
 
+def bulk_selection():
+    """Trả về (danh sách ID, câu SELECT id). Nếu admin chọn "tất cả kết quả lọc" thì dùng bộ lọc thay vì checkbox."""
+    if request.form.get('select_all'):
+        matching = filtered_devices_query(request.form.get('query', '').strip(), request.form.get('category'))
+        return None, matching.with_entities(Device.id)
+    device_ids = []
+    for value in request.form.getlist('device_ids'):
+        try: device_ids.append(int(value))
+        except ValueError: continue
+    return device_ids, None
+
 @device_bp.route('/borrow-multiple', methods=['POST'])
 @login_required
 @admin_required
 def borrow_multiple():
     """(Admin) Mượn nhiều thiết bị cùng lúc."""
-    device_ids = request.form.getlist('device_ids')
-    if not device_ids: flash('Bạn chưa chọn thiết bị nào để mượn.', 'info'); return redirect(url_for('device.devices'))
-    successful_transactions, error_devices = [], []
-    for device_id in device_ids:
-        device = Device.query.get(device_id)
-        if device and device.status == 'Available':
-            device.status = 'Borrowed'
-            device.borrower_id = current_user.id
-            transaction = Transaction(device_id=device.id, user_id=current_user.id, transaction_type='Mượn', notes=f'Mượn nhiều mục')
-            db.session.add(transaction); successful_transactions.append(transaction)
-        elif device: error_devices.append(device.name)
-    if successful_transactions:
+    device_ids, id_query = bulk_selection()
+    if not device_ids and id_query is None: flash('Bạn chưa chọn thiết bị nào để mượn.', 'info'); return redirect(url_for('device.devices'))
+    borrowed = inventory_service.bulk_transition('Available', 'Borrowed', user_id=current_user.id,
+                                                 transaction_type='Mượn', notes='Mượn nhiều mục',
+                                                 device_ids=device_ids, id_query=id_query,
+                                                 borrower_id=current_user.id)
+    if borrowed:
         db.session.commit()
-        flash(f'Đã mượn thành công {len(successful_transactions)} thiết bị.', 'success')
+        flash(f'Đã mượn thành công {len(borrowed)} thiết bị.', 'success')
     else:
         db.session.rollback()
         flash('Không có thiết bị nào được mượn.', 'error')
+    error_devices = inventory_service.device_names(set(device_ids or []) - set(borrowed))
     if error_devices: flash(f'Không thể mượn các thiết bị sau (không có sẵn): {", ".join(error_devices)}', 'error')
     return redirect(url_for('device.devices'))
 
@@ -229,21 +246,16 @@ def borrow_multiple():
 @admin_required
 def return_multiple():
     """(Admin) Trả nhiều thiết bị được chọn tự do."""
-    device_ids = request.form.getlist('device_ids')
-    if not device_ids: flash('Bạn chưa chọn thiết bị nào để trả.', 'info'); return redirect(url_for('device.devices'))
-    successful_transactions, error_devices = [], []
-    for device_id in device_ids:
-        device = Device.query.get(device_id)
-        if device and device.status == 'Borrowed':
-            device.status = 'Available'
-            device.borrower_id = None
-            transaction = Transaction(device_id=device.id, user_id=current_user.id, transaction_type='Trả', notes='Trả nhiều mục')
-            db.session.add(transaction); successful_transactions.append(transaction)
-        elif device: error_devices.append(f"{device.name} (trạng thái không hợp lệ)")
-    if successful_transactions:
+    device_ids, id_query = bulk_selection()
+    if not device_ids and id_query is None: flash('Bạn chưa chọn thiết bị nào để trả.', 'info'); return redirect(url_for('device.devices'))
+    returned = inventory_service.bulk_transition('Borrowed', 'Available', user_id=current_user.id,
+                                                 transaction_type='Trả', notes='Trả nhiều mục',
+                                                 device_ids=device_ids, id_query=id_query)
+    if returned:
         db.session.commit()
-        flash(f'Đã trả thành công {len(successful_transactions)} thiết bị.', 'success')
-    if error_devices: flash(f'Không thể trả các thiết bị sau: {", ".join(error_devices)}', 'error')
+        flash(f'Đã trả thành công {len(returned)} thiết bị.', 'success')
+    error_devices = inventory_service.device_names(set(device_ids or []) - set(returned))
+    if error_devices: flash(f'Không thể trả các thiết bị sau: {", ".join(f"{name} (trạng thái không hợp lệ)" for name in error_devices)}', 'error')
     return redirect(url_for('device.devices'))
 
 # --- ROUTE MỚI DÀNH CHO HỌC SINH (GIỎ HÀNG) ---
@@ -270,8 +282,10 @@ def add_to_list(device_id):
         return redirect(url_for('device.devices'))
     new_item = ListItem(list_id=pending_list.id, device_id=device.id)
     db.session.add(new_item)
+    pending_list.item_count = BorrowList.item_count + 1
     device.status = 'Reserved'
     db.session.commit()
+    cart_service.remember(pending_list.item_count)
     flash(f'Đã thêm "{device.name}" vào danh sách mượn của bạn.', 'success')
     # --- CHUYỂN HƯỚNG VỀ TAB HIỆN TẠI ---
     current_category = request.referrer.split('category=')[-1].split('&')[0] if 'category=' in request.referrer else None
@@ -280,16 +294,36 @@ def add_to_list(device_id):
 
 # --- EXPORT ---
 
+def _csv_download(basename, headers, stmt):
+    """Trả CSV dạng stream (generator); thêm ?gzip=1 để nhận file .csv.gz."""
+    chunks = export_service.iter_csv(headers, stmt)
+    filename, mimetype = f'{basename}.csv', 'text/csv'
+    if request.args.get('gzip', type=int):
+        chunks = export_service.gzip_stream(chunks)
+        filename, mimetype = f'{basename}.csv.gz', 'application/gzip'
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={"Content-disposition": f"attachment; filename={filename}"})
+
+def _export_filters():
+    try:
+        return export_service.parse_filters(request.args)
+    except ValueError as e:
+        abort(400, description=str(e))
+
 @device_bp.route('/export/devices.csv')
 @login_required
 @admin_required
+@http_cache.conditional
 def export_devices_csv():
-    """Xuất danh sách thiết bị ra file CSV."""
-    si = StringIO(); cw = csv.writer(si)
-    # --- CẬP NHẬT: Thêm cột 'Unit' ---
-    headers = ['ID', 'Name', 'Serial', 'Category', 'Unit', 'Status', 'Location', 'Created At']
-    cw.writerow(headers)
-    for device in Device.query.all():
-        # --- CẬP NHẬT: Thêm device.unit ---
-        cw.writerow([device.id, device.name, device.serial, device.category, device.unit, device.status, device.location, device.created_at.strftime('%Y-%m-%d')])
-    return Response(si.getvalue(), mimetype="text/csv", headers={"Content-disposition": "attachment; filename=devices_export.csv"})
\ No newline at end of file
+    """Xuất danh sách thiết bị ra file CSV (stream, lọc theo category/status/ngày tạo/người mượn/từ khóa)."""
+    stmt = export_service.device_export_select(**_export_filters())
+    return _csv_download('devices_export', export_service.DEVICE_HEADERS, stmt)
+
+@device_bp.route('/export/transactions.csv')
+@login_required
+@admin_required
+@http_cache.conditional
+def export_transactions_csv():
+    """Xuất toàn bộ lịch sử giao dịch ra file CSV (stream, lọc theo category/loại/ngày/người dùng)."""
+    stmt = export_service.transaction_export_select(**_export_filters())
+    return _csv_download('transactions_export', export_service.TRANSACTION_HEADERS, stmt)
\ No newline at end of file
@@ -3,10 +3,13 @@ import re # --- THÊM MỚI: Import thư viện Regular Expression ---
 from datetime import datetime 
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_user, logout_user, login_required, current_user
+from sqlalchemy.orm import joinedload
 # --- THAY ĐỔI: Thêm BorrowList, ListItem ---
 from ..models import db, User, Device, Transaction, BorrowList, ListItem
 # --- THÊM MỚI: Import hàm gửi email reset ---
 from ..services.email_service import send_password_reset_email
+from ..services import stats_service, cart_service
+from ..services.state_machine import check_version
 
 main_bp = Blueprint('main', __name__)
 
@@ -14,24 +17,17 @@ main_bp = Blueprint('main', __name__)
 @main_bp.app_context_processor
 def inject_pending_list_count():
     """Injects pending list item count for the current user into all templates."""
-    if current_user.is_authenticated and not current_user.is_admin:
-        pending_list = BorrowList.query.filter_by(user_id=current_user.id, status='Pending').first()
-        if pending_list:
-            return dict(pending_list_count=pending_list.items.count())
-    return dict(pending_list_count=0)
+    # Lấy từ session; chỉ truy vấn (một lần) khi session chưa có giá trị
+    return dict(pending_list_count=cart_service.pending_count())
 
 
 @main_bp.route('/')
 @login_required
 def index():
-    # --- THAY ĐỔI: Thêm trạng thái 'Reserved' vào thống kê ---
-    stats = {
-        'total_devices': Device.query.count(),
-        'available_devices': Device.query.filter_by(status='Available').count(),
-        'borrowed_devices': Device.query.filter_by(status='Borrowed').count(),
-        'reserved_devices': Device.query.filter_by(status='Reserved').count() # Mới
-    }
-    recent_transactions = Transaction.query.order_by(Transaction.created_at.desc()).limit(20).all()
+    # --- THAY ĐỔI: Một câu GROUP BY status, có cache dùng chung giữa các worker ---
+    stats = stats_service.inventory_stats()
+    recent_transactions = Transaction.query.options(joinedload(Transaction.device), joinedload(Transaction.user)) \
+        .order_by(Transaction.created_at.desc()).limit(20).all()
     return render_template('index.html', stats=stats, recent_transactions=recent_transactions)
 
 @main_bp.route('/login', methods=['GET', 'POST'])
@@ -41,6 +37,7 @@ def login():
         user = User.query.filter_by(username=request.form['username']).first()
         if user and user.check_password(request.form['password']):
             login_user(user, remember=request.form.get('remember'))
+            cart_service.forget()
             return redirect(url_for('main.index'))
         flash('Đăng nhập không thành công. Vui lòng kiểm tra lại thông tin.', 'error')
     return render_template('login.html')
@@ -78,6 +75,7 @@ def register():
 @login_required
 def logout():
     logout_user()
+    cart_service.forget()
     return redirect(url_for('main.login'))
 
 @main_bp.route('/profile', methods=['GET', 'POST'])
@@ -114,7 +112,7 @@ def my_list():
     borrow_list = BorrowList.query.filter_by(user_id=current_user.id, status='Pending').first()
     list_items = []
     if borrow_list:
-        list_items = borrow_list.items.order_by(ListItem.id.desc()).all()
+        list_items = borrow_list.items.options(joinedload(ListItem.device)).order_by(ListItem.id.desc()).all()
     return render_template('my_list.html', list_items=list_items, borrow_list=borrow_list)
 
 @main_bp.route('/remove-from-list/<int:item_id>', methods=['POST'])
@@ -129,8 +127,11 @@ def remove_from_list(item_id):
         return redirect(url_for('main.my_list'))
     device = item.device
     device.status = 'Available'
+    borrow_list = item.borrow_list
+    borrow_list.item_count = BorrowList.item_count - 1
     db.session.delete(item)
     db.session.commit()
+    cart_service.remember(borrow_list.item_count)
     flash(f'Đã xóa "{device.name}" khỏi danh sách.', 'success')
     return redirect(url_for('main.my_list'))
 
@@ -141,9 +142,10 @@ def submit_list():
     if current_user.is_admin:
         return redirect(url_for('main.index'))
     borrow_list = BorrowList.query.filter_by(user_id=current_user.id, status='Pending').first()
-    if not borrow_list or not borrow_list.items.count():
+    if not borrow_list or not borrow_list.item_count:
         flash('Danh sách mượn của bạn đang trống.', 'error')
         return redirect(url_for('main.my_list'))
+    check_version(borrow_list, request.form.get('version')) # Giỏ đã đổi (tab khác) sau khi trang được mở
 
     # --- THÊM MỚI: Lấy và lưu ngày dự kiến ---
     expected_date_str = request.form.get('expected_borrow_date')
@@ -163,6 +165,7 @@ def submit_list():
 
     borrow_list.status = 'Submitted'
     db.session.commit()
+    cart_service.remember(0)
     # (TODO: Gửi email cho admin báo có yêu cầu mới)
     flash('Đã gửi yêu cầu mượn thành công! Admin sẽ sớm soạn đồ cho bạn.', 'success')
     return redirect(url_for('main.index'))
@@ -180,6 +183,7 @@ def reset_password_request():
         if user:
             token = user.get_reset_token()
             send_password_reset_email(user, token)
+            db.session.commit() # Lưu email vào hàng đợi gửi
             flash('Một email hướng dẫn đặt lại mật khẩu đã được gửi đến địa chỉ email của bạn.', 'info')
             return redirect(url_for('main.login'))
         else:
@@ -0,0 +1,179 @@
+# app/services/analytics_export_service.py
+
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from sqlalchemy import select, union_all, Integer, DateTime, Date, Boolean
+from .. import db
+from ..models import Device, Transaction, TransactionArchive, BorrowList
+from .pagination import lagged_upper_id
+
+FORMATS = {'parquet': '.parquet', 'feather': '.feather'}
+COMPRESSION = 'zstd'
+CHUNK_SIZE = 50000
+MANIFEST = '_manifest.json'
+
+# Transaction là nhật ký chỉ thêm -> xuất nối tiếp theo id (watermark có độ trễ ANALYTICS_EXPORT_LAG_SECONDS),
+# đọc cả bảng nóng lẫn bảng lưu trữ
+# (cùng cột, giữ nguyên id) để giao dịch đã lưu trữ trước lần xuất đầu tiên vẫn có trong file.
+# Device và BorrowList bị cập nhật tại chỗ (trạng thái, ngày trả) và không có cột updated_at,
+# nên xuất lại toàn bộ mỗi lần (bảng nhỏ) để không giữ trạng thái cũ.
+INCREMENTAL_TABLES = {'transaction': (Transaction, TransactionArchive)}
+SNAPSHOT_TABLES = {'device': Device, 'borrow_list': BorrowList}
+
+
+def _arrow_schema(table):
+    """Schema Arrow có kiểu tương ứng với kiểu cột SQLAlchemy."""
+    import pyarrow as pa
+    fields = []
+    for column in table.columns:
+        if isinstance(column.type, Boolean):
+            arrow_type = pa.bool_()
+        elif isinstance(column.type, Integer):
+            arrow_type = pa.int64()
+        elif isinstance(column.type, DateTime):
+            arrow_type = pa.timestamp('us')
+        elif isinstance(column.type, Date):
+            arrow_type = pa.date32()
+        else:
+            arrow_type = pa.string() # String, Text và các kiểu khác
+        fields.append(pa.field(column.name, arrow_type, nullable=column.nullable))
+    return pa.schema(fields)
+
+
+class _Writer:
+    """Ghi từng lô RecordBatch vào một file Parquet hoặc Feather (Arrow IPC), nén zstd."""
+
+    def __init__(self, path, schema, fmt):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.fmt = fmt
+        if fmt == 'parquet':
+            self.writer = pq.ParquetWriter(path, schema, compression=COMPRESSION)
+        else:
+            self.sink = pa.OSFile(path, 'wb')
+            self.writer = pa.ipc.new_file(self.sink, schema, options=pa.ipc.IpcWriteOptions(compression=COMPRESSION))
+
+    def write(self, batch):
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+        if self.fmt == 'feather':
+            self.sink.close()
+
+
+def _write_rows(path, table, stmt, fmt):
+    """Đọc kết quả theo lô CHUNK_SIZE dòng (yield_per) và ghi mỗi lô thành một row group; trả về số dòng."""
+    import pyarrow as pa
+    schema = _arrow_schema(table)
+    tmp_path = path + '.tmp'
+    writer, count = _Writer(tmp_path, schema, fmt), 0
+    try:
+        result = db.session.execute(stmt.execution_options(yield_per=CHUNK_SIZE))
+        for rows in result.partitions():
+            columns = list(zip(*rows))
+            writer.write(pa.RecordBatch.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+            count += len(rows)
+    finally:
+        writer.close()
+    os.replace(tmp_path, path) # Đổi tên nguyên tử: người đọc không thấy file ghi dở
+    return count
+
+
+def _load_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {'tables': {}}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def export_dir(fmt):
+    return os.path.join(current_app.config['ANALYTICS_EXPORT_DIR'], fmt)
+
+
+def export_all(fmt='parquet', full=False):
+    """Xuất các bảng ra file cột. Transaction chỉ nối thêm các dòng có id > watermark (một file part mới mỗi lần);
+    Device và BorrowList được ghi lại toàn bộ. Watermark lưu trong _manifest.json cạnh các file,
+    nên xóa thư mục là tự động xuất lại từ đầu. Trả về {bảng: số dòng đã ghi}.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Định dạng không hỗ trợ: {fmt}')
+    directory = export_dir(fmt)
+    if full and os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory, exist_ok=True)
+    manifest = _load_manifest(directory)
+    extension, now, written = FORMATS[fmt], datetime.utcnow().isoformat(timespec='seconds'), {}
+    upper_at = datetime.utcnow() - timedelta(seconds=current_app.config.get('ANALYTICS_EXPORT_LAG_SECONDS', 60))
+
+    for name, models in INCREMENTAL_TABLES.items():
+        tables = [model.__table__ for model in models]
+        table = tables[0]
+        state = manifest['tables'].setdefault(name, {'watermark': 0, 'parts': []})
+        # Chốt mốc id lúc bắt đầu để lần xuất có phạm vi xác định, dòng mới hơn (hoặc còn trong cửa sổ trễ,
+        # có thể còn id nhỏ hơn chưa commit) để lần sau
+        upper = lagged_upper_id(state['watermark'], upper_at, *models)
+        if upper <= state['watermark']:
+            written[name] = 0
+            continue
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+        part = os.path.join(name, f"part-{state['watermark'] + 1:012d}-{upper:012d}{extension}")
+        stmt = union_all(*(select(t).where(t.c.id > state['watermark'], t.c.id <= upper) for t in tables))
+        stmt = stmt.order_by(stmt.selected_columns.id)
+        count = _write_rows(os.path.join(directory, part), table, stmt, fmt)
+        if count:
+            state['parts'].append(part)
+        else:
+            os.remove(os.path.join(directory, part)) # Các dòng trong khoảng đã bị xóa
+        state.update(watermark=upper, exported_at=now)
+        written[name] = count
+        _save_manifest(directory, manifest)
+
+    for name, model in SNAPSHOT_TABLES.items():
+        table = model.__table__
+        count = _write_rows(os.path.join(directory, f'{name}{extension}'), table,
+                            select(table).order_by(table.c.id), fmt)
+        manifest['tables'][name] = {'rows': count, 'exported_at': now}
+        written[name] = count
+    _save_manifest(directory, manifest)
+    return written
+
+
+def list_files(fmt):
+    """Các file đã xuất (đường dẫn tương đối, kích thước) để trang admin cho tải về."""
+    directory = export_dir(fmt)
+    files = []
+    for root, _, names in os.walk(directory):
+        for filename in sorted(names):
+            if filename.endswith(FORMATS[fmt]):
+                path = os.path.join(root, filename)
+                files.append((os.path.relpath(path, directory).replace(os.sep, '/'), os.path.getsize(path)))
+    return sorted(files), _load_manifest(directory) if os.path.isdir(directory) else {'tables': {}}
+
+
+@click.command('analytics-export')
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default=None, help='Mặc định: ANALYTICS_EXPORT_FORMAT.')
+@click.option('--full', is_flag=True, help='Xóa các file cũ và xuất lại từ đầu.')
+def analytics_export_command(fmt, full):
+    """Xuất transaction/borrow_list/device ra Parquet hoặc Feather (nối tiếp theo watermark)."""
+    fmt = fmt or current_app.config.get('ANALYTICS_EXPORT_FORMAT', 'parquet')
+    for name, count in export_all(fmt, full=full).items():
+        click.echo(f'{name}: {count} dòng')
+    click.echo(f'Đã ghi vào {export_dir(fmt)}')
+
+
+def init_app(app):
+    app.cli.add_command(analytics_export_command)
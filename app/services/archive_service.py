@@ -0,0 +1,168 @@
+# app/services/archive_service.py
+
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from sqlalchemy import select, insert, update, delete, func, case, or_, event
+from sqlalchemy.orm import joinedload
+from .. import db
+from ..models import Transaction, TransactionArchive, DeviceHistorySummary
+from . import stats_service, inventory_service
+from .pagination import keyset_paginate_chain
+
+TRANSFER_COLUMNS = ('id', 'device_id', 'user_id', 'transaction_type', 'notes', 'created_at')
+BORROW_TYPE = 'Mượn'
+
+
+def _cutoff(days=None):
+    days = current_app.config.get('ARCHIVE_AFTER_DAYS', 365) if days is None else days
+    return datetime.utcnow() - timedelta(days=days)
+
+
+def _merge_summaries(rows):
+    """Cộng dồn tóm tắt theo thiết bị cho một lô giao dịch vừa lưu trữ (một SELECT IN cho các tóm tắt sẵn có)."""
+    batch = {}
+    for row in rows:
+        entry = batch.setdefault(row.device_id, {'count': 0, 'borrows': 0, 'last': None, 'until': None})
+        entry['count'] += 1
+        entry['until'] = max(entry['until'] or row.created_at, row.created_at)
+        if row.transaction_type == BORROW_TYPE:
+            entry['borrows'] += 1
+            if entry['last'] is None or (row.created_at, row.id) > (entry['last'].created_at, entry['last'].id):
+                entry['last'] = row
+    existing = {s.device_id: s for s in DeviceHistorySummary.query.filter(DeviceHistorySummary.device_id.in_(list(batch)))}
+    for device_id, entry in batch.items():
+        summary = existing.get(device_id)
+        if summary is None:
+            summary = DeviceHistorySummary(device_id=device_id, archived_count=0, archived_borrow_count=0,
+                                           borrow_count=entry['borrows'])
+            db.session.add(summary)
+        summary.archived_count += entry['count']
+        summary.archived_borrow_count += entry['borrows']
+        last = entry['last']
+        if last is not None and (summary.last_borrowed_at is None or last.created_at >= summary.last_borrowed_at):
+            summary.last_borrower_id, summary.last_borrowed_at = last.user_id, last.created_at
+        if summary.archived_until is None or entry['until'] > summary.archived_until:
+            summary.archived_until = entry['until']
+
+
+def archive_batch(cutoff, batch_size):
+    """Chuyển tối đa `batch_size` giao dịch cũ hơn `cutoff` sang transaction_archive trong MỘT giao dịch CSDL
+    (chép, cập nhật tóm tắt, xóa khỏi bảng nóng) rồi commit. Trả về số dòng đã chuyển."""
+    # Luôn giữ giao dịch mới nhất ở bảng nóng: SQLite cấp id = MAX(id)+1, bảng rỗng sẽ cấp lại id đã lưu trữ
+    newest_id = db.session.execute(select(func.max(Transaction.id))).scalar()
+    rows = db.session.execute(
+        select(*(getattr(Transaction, c) for c in TRANSFER_COLUMNS))
+        .where(Transaction.created_at < cutoff, Transaction.id < newest_id)
+        .order_by(Transaction.id).limit(batch_size)).all() if newest_id else []
+    if not rows:
+        return 0
+    ids = [row.id for row in rows]
+    db.session.execute(insert(TransactionArchive), [row._asdict() for row in rows])
+    _merge_summaries(rows)
+    db.session.execute(delete(Transaction).where(Transaction.id.in_(ids)), execution_options={'synchronize_session': False})
+    stats_service.bump_version() # Số liệu và trang lịch sử phải đọc lại
+    db.session.commit()
+    return len(rows)
+
+
+def archive(days=None, batch_size=None):
+    """Lưu trữ toàn bộ giao dịch cũ hơn `days` ngày (mặc định ARCHIVE_AFTER_DAYS), theo từng lô. Trả về số dòng."""
+    cutoff, total = _cutoff(days), 0
+    batch_size = batch_size or current_app.config.get('ARCHIVE_BATCH_SIZE', 5000)
+    while True:
+        moved = archive_batch(cutoff, batch_size)
+        total += moved
+        if moved < batch_size:
+            return total
+
+
+def timeline(per_page, after=None, before=None, device_id=None, user_id=None):
+    """Trang lịch sử giao dịch (mới nhất trước) đọc bảng nóng trước, lật quá phần nóng thì đọc tiếp bảng lưu trữ.
+
+    Dòng lưu trữ luôn cũ hơn mọi dòng nóng nên hai bảng nối tiếp nhau theo (created_at, id).
+    """
+    sources = []
+    for model in (Transaction, TransactionArchive):
+        query = model.query.options(joinedload(model.device), joinedload(model.user))
+        if device_id is not None:
+            query = query.filter(model.device_id == device_id)
+        if user_id is not None:
+            query = query.filter(model.user_id == user_id)
+        sources.append((query, [model.created_at, model.id]))
+    return keyset_paginate_chain(sources, per_page, after=after, before=before, descending=True)
+
+
+def record_borrows(conn, borrows):
+    """Cộng các giao dịch Mượn vừa ghi, dạng (device_id, user_id, created_at), vào device_history_summary
+    (borrow_count, người mượn gần nhất) trong cùng giao dịch CSDL với chính các giao dịch đó."""
+    batch = {}
+    for device_id, user_id, created_at in borrows:
+        entry = batch.get(device_id)
+        if entry is None:
+            batch[device_id] = {'device_id': device_id, 'archived_count': 0, 'archived_borrow_count': 0,
+                                'borrow_count': 1, 'last_borrower_id': user_id, 'last_borrowed_at': created_at}
+            continue
+        entry['borrow_count'] += 1
+        if created_at >= entry['last_borrowed_at']:
+            entry.update(last_borrower_id=user_id, last_borrowed_at=created_at)
+    if not batch:
+        return
+    table = DeviceHistorySummary.__table__
+    newer = lambda borrowed_at: or_(table.c.last_borrowed_at.is_(None), table.c.last_borrowed_at <= borrowed_at)
+    dialect_insert = inventory_service.ON_CONFLICT_INSERTS.get(conn.dialect.name)
+    if dialect_insert is not None:
+        stmt = dialect_insert(table)
+        new = stmt.excluded
+        conn.execute(stmt.on_conflict_do_update(index_elements=['device_id'], set_={
+            'borrow_count': table.c.borrow_count + new.borrow_count,
+            'last_borrower_id': case((newer(new.last_borrowed_at), new.last_borrower_id), else_=table.c.last_borrower_id),
+            'last_borrowed_at': case((newer(new.last_borrowed_at), new.last_borrowed_at), else_=table.c.last_borrowed_at),
+        }), list(batch.values()))
+        return
+    # CSDL không có UPSERT: cộng dồn bằng UPDATE, thiết bị chưa có dòng tóm tắt thì chèn mới
+    for row in batch.values():
+        changed = conn.execute(update(table).where(table.c.device_id == row['device_id']).values(
+            borrow_count=table.c.borrow_count + row['borrow_count'],
+            last_borrower_id=case((newer(row['last_borrowed_at']), row['last_borrower_id']), else_=table.c.last_borrower_id),
+            last_borrowed_at=case((newer(row['last_borrowed_at']), row['last_borrowed_at']), else_=table.c.last_borrowed_at),
+        )).rowcount
+        if not changed:
+            conn.execute(insert(table), row)
+
+
+def _record_after_flush(session, flush_context):
+    """Cập nhật tóm tắt cho các giao dịch Mượn tạo qua ORM (INSERT bằng Core thì người gọi tự gọi record_borrows)."""
+    borrows = [(obj.device_id, obj.user_id, obj.created_at or datetime.utcnow()) for obj in session.new
+               if isinstance(obj, Transaction) and obj.transaction_type == BORROW_TYPE]
+    if borrows:
+        record_borrows(session.connection(), borrows)
+
+
+def device_usage(device_id):
+    """Số lần mượn và người mượn gần nhất: đọc một dòng tóm tắt (được cập nhật khi ghi giao dịch Mượn)."""
+    summary = DeviceHistorySummary.query.options(joinedload(DeviceHistorySummary.last_borrower)) \
+        .filter_by(device_id=device_id).first()
+    if summary is None:
+        return {'borrow_count': 0, 'last_borrower': None, 'last_borrowed_at': None}
+    return {'borrow_count': summary.borrow_count, 'last_borrower': summary.last_borrower,
+            'last_borrowed_at': summary.last_borrowed_at}
+
+
+@click.command('archive-transactions')
+@click.option('--days', type=int, default=None, help='Lưu trữ giao dịch cũ hơn số ngày này (mặc định ARCHIVE_AFTER_DAYS).')
+@click.option('--batch-size', type=int, default=None, help='Số dòng mỗi lô (mặc định ARCHIVE_BATCH_SIZE).')
+@click.option('--dry-run', is_flag=True, help='Chỉ đếm số giao dịch sẽ được lưu trữ.')
+def archive_transactions_command(days, batch_size, dry_run):
+    """Chuyển giao dịch cũ sang bảng transaction_archive (chạy định kỳ bằng cron)."""
+    cutoff = _cutoff(days)
+    if dry_run:
+        count = db.session.execute(select(func.count()).select_from(Transaction).where(Transaction.created_at < cutoff)).scalar()
+        click.echo(f'{count} giao dịch trước {cutoff:%Y-%m-%d} sẽ được lưu trữ.')
+        return
+    click.echo(f'Đã lưu trữ {archive(days, batch_size)} giao dịch trước {cutoff:%Y-%m-%d}.')
+
+
+def init_app(app):
+    event.listen(db.session, 'after_flush', _record_after_flush)
+    app.cli.add_command(archive_transactions_command)
@@ -0,0 +1,354 @@
+# app/services/benchmark_service.py
+
+import contextvars
+import http.cookiejar
+import io
+import json
+import math
+import os
+import platform
+import re
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from sqlalchemy import event, select, func
+from .. import db
+from ..models import User, Device, Transaction, BorrowList
+from . import import_job_service, metrics_service
+
+SCENARIOS = ('index', 'catalog', 'catalog_category', 'catalog_search', 'admin_requests', 'admin_overdue',
+             'bulk_borrow_return', 'excel_import', 'export_csv')
+BENCH_PREFIX = 'BENCH-'
+IMPORT_TIMEOUT = 300
+
+
+def percentile(values, p):
+    """Percentile kiểu nearest-rank (giá trị thật có trong mẫu, không nội suy)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+# --- CÁCH GỬI REQUEST ---
+
+class ClientDriver:
+    """Gọi thẳng ứng dụng qua Flask test client trong cùng tiến trình; đếm câu SQL bằng sự kiện của Engine
+    (tính cả truy vấn chạy trong lúc stream body, ví dụ xuất CSV)."""
+
+    mode = 'client'
+
+    def __init__(self, app):
+        self.client = app.test_client()
+        self.engine = db.engine
+        self.queries = 0
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.queries += 1
+
+    def close(self):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+    def request(self, method, path, data=None, files=None):
+        if files:
+            data = dict(data or {}, **{name: (io.BytesIO(body), filename) for name, (filename, body) in files.items()})
+        self.queries = 0
+        # Chạy trong contextvars trống: nếu không, test client dùng lại app context của lệnh CLI
+        # (chung session SQLAlchemy và g giữa các request) và số câu SQL thấp hơn thực tế
+        return contextvars.Context().run(self._send, method, path, data)
+
+    def _send(self, method, path, data):
+        started = time.perf_counter()
+        response = self.client.open(path, method=method, data=data)
+        body = response.get_data() # Đọc hết body: response dạng stream chỉ chạy khi được đọc
+        response.close()
+        elapsed = time.perf_counter() - started
+        return {'status': response.status_code, 'seconds': elapsed, 'bytes': len(body), 'queries': self.queries,
+                'location': response.headers.get('Location', ''), 'body': body}
+
+    def peak_rss(self):
+        return metrics_service.max_rss_bytes()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None # Giữ nguyên 302 như test client: chỉ đo request được gọi, không đo trang được chuyển tới
+
+
+class HttpDriver:
+    """Gọi một server đang chạy (ví dụ gunicorn cục bộ). Số câu SQL đọc từ header Server-Timing,
+    nên server cần bật METRICS_ENABLED và SERVER_TIMING_HEADER; với response dạng stream chỉ tính đến lúc tạo response."""
+
+    mode = 'http'
+    _sql = re.compile(r'sql;[^,]*desc="(\d+)"')
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect)
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _encode(data, files):
+        if not files:
+            return urllib.parse.urlencode(data or {}, doseq=True).encode(), 'application/x-www-form-urlencoded'
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in (data or {}).items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        for name, (filename, body) in files.items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                         f'Content-Type: application/octet-stream\r\n\r\n'.encode() + body + b'\r\n')
+        parts.append(f'--{boundary}--\r\n'.encode())
+        return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+    def request(self, method, path, data=None, files=None):
+        body, headers = None, {}
+        if method == 'POST':
+            body, headers['Content-Type'] = self._encode(data, files)
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers)
+        started = time.perf_counter()
+        try:
+            response = self.opener.open(req)
+        except urllib.error.HTTPError as e:
+            response = e # 3xx/4xx/5xx: vẫn là một response cần đo
+        with response:
+            content = response.read()
+        elapsed = time.perf_counter() - started
+        match = self._sql.search(response.headers.get('Server-Timing', ''))
+        return {'status': response.status, 'seconds': elapsed, 'bytes': len(content),
+                'queries': int(match.group(1)) if match else None,
+                'location': response.headers.get('Location', ''), 'body': content}
+
+    def peak_rss(self):
+        """RSS cao nhất trong các worker, lấy từ /admin/metrics (cần đăng nhập admin)."""
+        result = self.request('GET', '/admin/metrics')
+        values = re.findall(rb'^app_process_max_rss_bytes\{[^}]*\} (\d+)', result['body'], re.MULTILINE)
+        return max(int(v) for v in values) if values else None
+
+
+# --- KỊCH BẢN ---
+
+class Recorder:
+    def __init__(self, driver):
+        self.driver = driver
+        self.samples = {}
+        self.recording = True
+
+    def call(self, label, method, path, data=None, files=None, expect=(200, 302)):
+        result = self.driver.request(method, path, data=data, files=files)
+        if self.recording:
+            entry = self.samples.setdefault(label, {'seconds': [], 'queries': [], 'bytes': 0, 'errors': 0})
+            entry['seconds'].append(result['seconds'])
+            if result['queries'] is not None:
+                entry['queries'].append(result['queries'])
+            entry['bytes'] += result['bytes']
+            entry['errors'] += result['status'] not in expect
+        return result
+
+    def add(self, label, seconds, queries=None):
+        """Ghi một bước không phải request HTTP (ví dụ thời gian worker xử lý file nhập)."""
+        if self.recording:
+            entry = self.samples.setdefault(label, {'seconds': [], 'queries': [], 'bytes': 0, 'errors': 0})
+            entry['seconds'].append(seconds)
+            if queries is not None:
+                entry['queries'].append(queries)
+
+
+def _available_ids(limit):
+    return list(db.session.execute(select(Device.id).where(Device.status == 'Available', Device.borrower_id.is_(None))
+                                   .order_by(Device.id).limit(limit)).scalars())
+
+
+def _workbook(rows, tag):
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(['name', 'serial', 'category', 'location', 'unit', 'description'])
+    for i in range(rows):
+        sheet.append([f'Thiết bị thử tải {i}', f'{BENCH_PREFIX}{tag}-{i:06}', 'Dụng cụ', 'Kho chính', 'Cái', 'benchmark'])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def _wait_for_import(recorder, job_id):
+    """Đo thời gian từ lúc tải file lên đến khi job nhập hoàn tất (worker nền hoặc chạy ngay trong tiến trình)."""
+    started = time.perf_counter()
+    while time.perf_counter() - started < IMPORT_TIMEOUT:
+        if recorder.driver.mode == 'client' and not current_app.config.get('IMPORT_BACKGROUND'):
+            import_job_service.run_pending()
+        status = recorder.driver.request('GET', f'/admin/import-jobs/{job_id}/status')
+        if status['status'] == 200 and json.loads(status['body']).get('finished'):
+            recorder.add('excel_import_job', time.perf_counter() - started)
+            return
+        time.sleep(0.05)
+    raise click.ClickException(f'Job nhập #{job_id} chưa xong sau {IMPORT_TIMEOUT}s '
+                               "(server cần bật IMPORT_BACKGROUND hoặc chạy 'flask import-worker --loop').")
+
+
+def run_scenario(name, recorder, options, iteration):
+    call = recorder.call
+    if name == 'index':
+        call('index', 'GET', '/')
+    elif name == 'catalog':
+        call('catalog', 'GET', '/devices')
+    elif name == 'catalog_category':
+        call('catalog_category', 'GET', '/devices?' + urllib.parse.urlencode({'category': options['category']}))
+    elif name == 'catalog_search':
+        call('catalog_search', 'GET', '/devices?' + urllib.parse.urlencode({'query': options['search']}))
+    elif name == 'admin_requests':
+        call('admin_requests', 'GET', '/admin/requests')
+    elif name == 'admin_overdue':
+        call('admin_overdue', 'GET', '/admin/overdue')
+    elif name == 'bulk_borrow_return':
+        device_ids = _available_ids(options['bulk_size'])
+        db.session.remove() # Không giữ giao dịch đọc mở trong lúc server/test client ghi
+        if not device_ids:
+            raise click.ClickException('Không còn thiết bị Available cho kịch bản mượn/trả hàng loạt.')
+        call('bulk_borrow', 'POST', '/borrow-multiple', data={'device_ids': device_ids}, expect=(302,))
+        call('bulk_return', 'POST', '/return-multiple', data={'device_ids': device_ids}, expect=(302,))
+    elif name == 'excel_import':
+        content = _workbook(options['import_rows'], f"{options['tag']}-{iteration}")
+        result = call('excel_upload', 'POST', '/admin/upload-devices', files={'file': ('bench.xlsx', content)}, expect=(302,))
+        match = re.search(r'job=(\d+)', result['location'])
+        if match:
+            _wait_for_import(recorder, match.group(1))
+    elif name == 'export_csv':
+        call('export_devices', 'GET', '/export/devices.csv')
+        since = (datetime.utcnow() - timedelta(days=options['export_days'])).strftime('%Y-%m-%d')
+        call('export_transactions', 'GET', '/export/transactions.csv?date_from=' + since)
+
+
+def _cleanup_bench_devices():
+    """Xóa thiết bị do kịch bản nhập Excel tạo ra (qua ORM để chỉ mục tìm kiếm và cache được cập nhật)."""
+    devices = Device.query.filter(Device.serial.like(f'{BENCH_PREFIX}%')).all()
+    for device in devices:
+        db.session.delete(device)
+    db.session.commit()
+    return len(devices)
+
+
+def summarize(samples):
+    rows = {}
+    for label, entry in samples.items():
+        ms = [s * 1000 for s in entry['seconds']]
+        rows[label] = {
+            'count': len(ms), 'errors': entry['errors'], 'bytes': entry['bytes'],
+            'mean_ms': round(sum(ms) / len(ms), 2), 'p50_ms': round(percentile(ms, 50), 2),
+            'p95_ms': round(percentile(ms, 95), 2), 'max_ms': round(max(ms), 2),
+            'queries_p50': percentile(entry['queries'], 50), 'queries_max': max(entry['queries'], default=None),
+            'samples_ms': [round(v, 3) for v in ms],
+        }
+    return rows
+
+
+def dataset_size():
+    count = lambda model: db.session.execute(select(func.count()).select_from(model)).scalar()
+    return {'users': count(User), 'devices': count(Device), 'borrow_lists': count(BorrowList),
+            'transactions': count(Transaction)}
+
+
+def run(driver, scenarios, iterations=20, warmup=2, username='admin', password='admin123', **options):
+    """Đăng nhập rồi chạy mỗi kịch bản `warmup` lần (bỏ qua) và `iterations` lần (đo). Trả về kết quả dạng dict JSON được."""
+    options.setdefault('tag', datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+    login = driver.request('POST', '/login', data={'username': username, 'password': password})
+    if login['status'] != 302:
+        raise click.ClickException(f'Đăng nhập "{username}" thất bại (HTTP {login["status"]}).')
+    recorder = Recorder(driver)
+    memory = {}
+    for name in scenarios:
+        recorder.recording = False
+        for i in range(warmup):
+            run_scenario(name, recorder, options, f'w{i}')
+        recorder.recording = True
+        for i in range(iterations):
+            run_scenario(name, recorder, options, i)
+        memory[name] = driver.peak_rss() # RSS cao nhất tính đến hết kịch bản này (tăng dần theo thứ tự chạy)
+    return {
+        'meta': {'started_at': options['tag'], 'mode': driver.mode, 'url': getattr(driver, 'base_url', None),
+                 'iterations': iterations, 'warmup': warmup, 'python': platform.python_version(),
+                 'database': db.engine.url.render_as_string(hide_password=True), 'dataset': dataset_size(),
+                 'options': {k: v for k, v in options.items() if k != 'tag'}},
+        'peak_rss_bytes': max((v for v in memory.values() if v), default=None),
+        'peak_rss_after_scenario': memory,
+        'results': summarize(recorder.samples),
+    }
+
+
+# --- IN KẾT QUẢ ---
+
+def _mb(value):
+    return f'{value / 1024 / 1024:.0f} MB' if value else '—'
+
+
+def format_table(report, baseline=None):
+    previous = (baseline or {}).get('results', {})
+    lines = [f"{'Bước':<22}{'n':>5}{'p50 ms':>10}{'p95 ms':>10}{'SQL p50':>9}{'SQL max':>9}{'lỗi':>6}"
+             + ('  so với bản trước (p50 / p95)' if baseline else '')]
+    for label, row in report['results'].items():
+        line = (f"{label:<22}{row['count']:>5}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+                f"{row['queries_p50'] if row['queries_p50'] is not None else '—':>9}"
+                f"{row['queries_max'] if row['queries_max'] is not None else '—':>9}{row['errors']:>6}")
+        old = previous.get(label)
+        if old:
+            line += '  ' + ' / '.join(f"{(row[key] - old[key]) / old[key]:+.0%}" if old[key] else '—'
+                                      for key in ('p50_ms', 'p95_ms'))
+        lines.append(line)
+    lines.append(f"RSS cao nhất: {_mb(report['peak_rss_bytes'])}"
+                 + (f" (bản trước {_mb(baseline.get('peak_rss_bytes'))})" if baseline else ''))
+    return '\n'.join(lines)
+
+
+@click.command('benchmark')
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(SCENARIOS),
+              help='Chỉ chạy các kịch bản này (lặp lại tùy chọn); mặc định chạy tất cả.')
+@click.option('--iterations', type=int, default=20, show_default=True)
+@click.option('--warmup', type=int, default=2, show_default=True, help='Số lần chạy bỏ qua trước khi đo (làm nóng cache).')
+@click.option('--url', help='Gọi server đang chạy (ví dụ http://127.0.0.1:8000) thay vì test client. '
+                            'Server phải dùng cùng CSDL và bật SERVER_TIMING_HEADER.')
+@click.option('--username', default='admin', show_default=True)
+@click.option('--password', default='admin123', show_default=True)
+@click.option('--search', default='may', show_default=True, help='Từ khóa cho kịch bản tìm kiếm.')
+@click.option('--category', default='Dụng cụ', show_default=True)
+@click.option('--bulk-size', type=int, default=50, show_default=True, help='Số thiết bị mỗi lượt mượn/trả hàng loạt.')
+@click.option('--import-rows', type=int, default=500, show_default=True, help='Số dòng file Excel tải lên.')
+@click.option('--export-days', type=int, default=30, show_default=True, help='Xuất giao dịch trong bấy nhiêu ngày gần nhất.')
+@click.option('--output', type=click.Path(dir_okay=False), help='File JSON kết quả (mặc định benchmarks/bench-<thời điểm>.json).')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), help='File JSON của lần chạy trước để so sánh.')
+def benchmark_command(scenarios, iterations, warmup, url, username, password, search, category, bulk_size,
+                      import_rows, export_days, output, compare):
+    """Đo p50/p95 độ trễ, số câu SQL mỗi request và bộ nhớ đỉnh của các route nóng; lưu kết quả JSON để so sánh.
+
+    Nên chạy trên dữ liệu từ 'flask seed-data'. Kịch bản mượn/trả và nhập Excel GHI vào CSDL
+    (thêm giao dịch; thiết bị BENCH-* được xóa khi kết thúc).
+    """
+    driver = HttpDriver(url) if url else ClientDriver(current_app._get_current_object())
+    tag = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    try:
+        report = run(driver, scenarios or SCENARIOS, iterations, warmup, username, password, tag=tag, search=search,
+                     category=category, bulk_size=bulk_size, import_rows=import_rows, export_days=export_days)
+    finally:
+        driver.close()
+        removed = _cleanup_bench_devices()
+    output = output or os.path.join('benchmarks', f'bench-{tag}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    baseline = None
+    if compare:
+        with open(compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    click.echo(format_table(report, baseline))
+    click.echo(f'Đã ghi {output}' + (f'; đã xóa {removed} thiết bị {BENCH_PREFIX}*.' if removed else '.'))
+
+
+def init_app(app):
+    app.cli.add_command(benchmark_command)
@@ -0,0 +1,38 @@
+# app/services/cart_service.py
+
+from flask import session
+from flask_login import current_user
+from sqlalchemy import select
+from .. import db
+from ..models import BorrowList
+
+# Khóa lưu số món trong "giỏ hàng" trong cookie session: (user_id, số món)
+SESSION_KEY = 'pending_list_count'
+
+
+def _query_count(user_id):
+    """Đọc bộ đếm đã phi chuẩn hóa BorrowList.item_count (một lần tra chỉ mục, không COUNT)."""
+    count = db.session.execute(
+        select(BorrowList.item_count).where(BorrowList.user_id == user_id, BorrowList.status == 'Pending')
+    ).scalar()
+    return count or 0
+
+
+def pending_count():
+    """Số món trong giỏ của sinh viên hiện tại; lấy từ session nếu có, chỉ hỏi CSDL khi session chưa có."""
+    if not current_user.is_authenticated or current_user.is_admin:
+        return 0
+    cached = session.get(SESSION_KEY)
+    if cached and cached[0] == current_user.id:
+        return cached[1]
+    return remember(_query_count(current_user.id))
+
+
+def remember(count):
+    """Ghi lại số món sau khi giỏ thay đổi (gọi từ add_to_list, remove_from_list, submit_list)."""
+    session[SESSION_KEY] = (current_user.id, count)
+    return count
+
+
+def forget():
+    session.pop(SESSION_KEY, None)
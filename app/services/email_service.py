@@ -1,39 +1,77 @@
 # app/services/email_service.py
 
+import hashlib
 import os
+from datetime import datetime
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
+from flask_mail import Message as MailMessage
+from werkzeug.utils import secure_filename
 # --- THÊM IMPORT ---
-from flask import url_for, render_template
+from flask import url_for, render_template, current_app
 # --- THÊM MỚI: Import model Transaction để lấy thời gian ---
-from ..models import Transaction 
+from ..models import Transaction, EmailOutbox
+from .. import db, mail
+from .metrics_service import track_email
 
-def send_email(to_email, subject, html_content):
-    """Hàm gửi mail chung sử dụng SendGrid."""
+# --- CÁC KÊNH GỬI (TRANSPORT) ---
+# Mỗi kênh ném exception khi gửi lỗi để bộ gửi nền biết mà thử lại.
 
+def _sendgrid_transport(to_email, subject, html_content):
     sendgrid_api_key = os.environ.get('SENDGRID_API_KEY')
     from_email = os.environ.get('EMAIL_USER') # Vẫn dùng email của bạn làm email người gửi
-
     if not sendgrid_api_key or not from_email:
-        print("Lỗi: SENDGRID_API_KEY hoặc EMAIL_USER chưa được thiết lập.")
-        return False # Trả về False nếu lỗi cấu hình
-
+        raise RuntimeError("SENDGRID_API_KEY hoặc EMAIL_USER chưa được thiết lập.")
     message = Mail(
         from_email=from_email,
         to_emails=to_email,
         subject=subject,
         html_content=html_content
     )
-    try:
-        sg = SendGridAPIClient(sendgrid_api_key)
-        response = sg.send(message)
-        print(f"Email đã được gửi tới {to_email}, status code: {response.status_code}")
-        return response.status_code in [200, 202] # Trả về True nếu gửi thành công (status 200 hoặc 202)
-    except Exception as e:
-        print(f"Lỗi khi gửi email tới {to_email}: {e}")
-        return False # Trả về False nếu có lỗi xảy ra
-
-# Các hàm cụ thể vẫn giữ nguyên, chỉ gọi hàm send_email mới
+    response = SendGridAPIClient(sendgrid_api_key).send(message)
+    if response.status_code not in [200, 202]:
+        raise RuntimeError(f"SendGrid trả về status code {response.status_code}")
+
+
+def _smtp_transport(to_email, subject, html_content):
+    """Gửi qua SMTP (Flask-Mail). Dùng với 'python -m aiosmtpd -n' hoặc MailHog để thử offline."""
+    mail.send(MailMessage(subject=subject, recipients=[to_email], html=html_content,
+                          sender=current_app.config.get('MAIL_DEFAULT_SENDER') or 'noreply@localhost'))
+
+
+def _file_transport(to_email, subject, html_content):
+    """Ghi email ra thư mục MAIL_FILE_DIR thay vì gửi thật (phát triển/kiểm thử offline)."""
+    folder = current_app.config['MAIL_FILE_DIR']
+    os.makedirs(folder, exist_ok=True)
+    filename = f"{datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')}_{secure_filename(to_email)}.html"
+    with open(os.path.join(folder, filename), 'w', encoding='utf-8') as f:
+        f.write(f"<!-- To: {to_email} -->\n<!-- Subject: {subject} -->\n{html_content}")
+
+
+TRANSPORTS = {'sendgrid': _sendgrid_transport, 'smtp': _smtp_transport, 'file': _file_transport}
+
+
+def deliver_email(to_email, subject, html_content):
+    """Gửi NGAY qua kênh MAIL_TRANSPORT; ném exception nếu lỗi. Chỉ bộ gửi nền nên gọi hàm này."""
+    transport = current_app.config.get('MAIL_TRANSPORT', 'sendgrid')
+    with track_email(transport):
+        TRANSPORTS[transport](to_email, subject, html_content)
+    current_app.logger.debug(f"Email đã được gửi tới {to_email} qua {transport}")
+
+
+def send_email(to_email, subject, html_content, dedup_key=None):
+    """Đưa email vào hàng đợi email_outbox (trong giao dịch hiện tại, người gọi commit).
+
+    Trả về False nếu email có cùng dedup_key đã được xếp hàng trước đó.
+    """
+    if dedup_key and db.session.query(EmailOutbox.id).filter_by(dedup_key=dedup_key).first():
+        return False
+    db.session.add(EmailOutbox(to_email=to_email, subject=subject, html_content=html_content, dedup_key=dedup_key))
+    # Đánh thức bộ gửi nền sau khi giao dịch commit
+    db.session.info['outbox_queued'] = True
+    return True
+
+# Các hàm cụ thể vẫn giữ nguyên, send_email giờ chỉ xếp hàng email
 def send_transaction_email(user, device, transaction_type):
     last_transaction = Transaction.query.filter_by(device_id=device.id).order_by(Transaction.created_at.desc()).first()
     transaction_time_str = last_transaction.created_at.strftime('%H:%M %d-%m-%Y') if last_transaction else "N/A"
@@ -83,7 +121,7 @@ def send_password_reset_email(user, token):
 def send_request_ready_email(borrow_list):
     """Gửi email thông báo yêu cầu đã sẵn sàng cho sinh viên."""
     if not borrow_list or not borrow_list.user:
-        print("Lỗi: Không thể gửi email 'Sẵn sàng' do thiếu thông tin.")
+        current_app.logger.warning("Không thể gửi email 'Sẵn sàng' do thiếu thông tin.")
         return False
 
     user = borrow_list.user
@@ -95,5 +133,30 @@ def send_request_ready_email(borrow_list):
                                    borrow_list=borrow_list,
                                    items=borrow_list.items.all()) # Truyền danh sách items vào template
 
-    print(f"Đang chuẩn bị gửi email 'Sẵn sàng' cho {user.email}...")
-    return send_email(user.email, subject, html_content)
\ No newline at end of file
+    current_app.logger.debug(f"Đang xếp hàng email 'Sẵn sàng' cho {user.email}")
+    return send_email(user.email, subject, html_content, dedup_key=f'request-ready:{borrow_list.id}')
+
+# --- NHẮC HẠN TRẢ (do overdue_service gọi) ---
+def _render_background(template, **context):
+    """Render template email ngoài request (thread quét nền, CLI): bỏ qua context processor cần current_user/session."""
+    return current_app.jinja_env.get_template(template).render(**context)
+
+
+def send_due_reminder_email(user, overdue_lists, due_soon_lists, today):
+    """Một email cho mỗi sinh viên, gộp mọi phiếu vừa quá hạn và sắp đến hạn trong lần quét."""
+    ids = ','.join(str(bl.id) for bl in overdue_lists + due_soon_lists)
+    subject = "[Kho VAA] Phiếu mượn đã quá hạn trả" if overdue_lists else "[Kho VAA] Sắp đến hạn trả thiết bị"
+    html_content = _render_background('email/due_reminder.html', user=user, overdue_lists=overdue_lists,
+                                      due_soon_lists=due_soon_lists, today=today)
+    # Khóa theo tập phiếu: lần quét sau có phiếu khác thì vẫn gửi email mới
+    return send_email(user.email, subject, html_content,
+                      dedup_key=f"due-reminder:{user.id}:{hashlib.sha1(ids.encode()).hexdigest()[:16]}")
+
+
+def send_overdue_digest_email(entries, today):
+    """Một email tổng hợp cho admin (HOST_EMAIL) liệt kê các phiếu vừa quá hạn; entries là [(user, phiếu)]."""
+    admin_email = current_app.config.get('HOST_EMAIL')
+    if not admin_email or not entries:
+        return False
+    html_content = _render_background('email/overdue_digest.html', entries=entries, today=today)
+    return send_email(admin_email, f"[Kho VAA] {len(entries)} phiếu mượn mới quá hạn", html_content)
@@ -0,0 +1,132 @@
+# app/services/export_service.py
+
+import csv
+import io
+import zlib
+from datetime import datetime, timedelta
+from sqlalchemy import select, union_all
+from .. import db
+from ..models import Device, Transaction, TransactionArchive, User
+from .search_service import search_filter
+
+# Số dòng mỗi lần lấy từ CSDL (yield_per) và mỗi lần đẩy ra response
+BATCH_SIZE = 1000
+
+DEVICE_HEADERS = ['ID', 'Name', 'Serial', 'Category', 'Unit', 'Status', 'Location', 'Created At']
+TRANSACTION_HEADERS = ['ID', 'Created At', 'Type', 'Device ID', 'Device Name', 'Serial', 'Category',
+                       'User ID', 'Username', 'Notes']
+
+
+def _parse_date(value):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError('Ngày phải có dạng YYYY-MM-DD.') from None
+
+
+def _resolve_user(value):
+    """Ô người dùng nhận ID hoặc tên đăng nhập; tra một dòng theo chỉ mục unique thay vì nạp cả bảng user vào form."""
+    value = (value or '').strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+    user_id = db.session.execute(select(User.id).where(User.username == value)).scalar()
+    if user_id is None:
+        raise ValueError(f'Không tìm thấy người dùng "{value}".')
+    return user_id
+
+
+def parse_filters(args):
+    """Đọc bộ lọc chung từ query string: category, status, type, date_from, date_to (YYYY-MM-DD), user_id,
+    user (ID hoặc tên đăng nhập), query.
+
+    Ném ValueError (kèm thông báo) nếu ngày sai định dạng hoặc không có người dùng đó.
+    """
+    return {
+        'category': args.get('category') or None,
+        'status': args.get('status') or None,
+        'transaction_type': args.get('type') or None,
+        'date_from': _parse_date(args.get('date_from')),
+        'date_to': _parse_date(args.get('date_to')),
+        'user_id': args.get('user_id', type=int) or _resolve_user(args.get('user')),
+        'query': (args.get('query') or '').strip() or None,
+    }
+
+
+def _date_range(column, date_from, date_to):
+    conditions = []
+    if date_from:
+        conditions.append(column >= date_from)
+    if date_to:
+        conditions.append(column < date_to + timedelta(days=1)) # date_to tính trọn ngày
+    return conditions
+
+
+def device_export_select(category=None, status=None, date_from=None, date_to=None, user_id=None, query=None, **_):
+    """SELECT các cột cần xuất (không dựng đối tượng ORM). `user_id` lọc theo người đang mượn."""
+    stmt = select(Device.id, Device.name, Device.serial, Device.category, Device.unit, Device.status,
+                  Device.location, Device.created_at).order_by(Device.id)
+    if category:
+        stmt = stmt.where(Device.category == category)
+    if status:
+        stmt = stmt.where(Device.status == status)
+    if user_id:
+        stmt = stmt.where(Device.borrower_id == user_id)
+    if query:
+        stmt = stmt.where(search_filter(query.upper()))
+    return stmt.where(*_date_range(Device.created_at, date_from, date_to))
+
+
+def _transaction_select(model, category, transaction_type, date_from, date_to, user_id):
+    stmt = select(model.id.label('transaction_id'), model.created_at, model.transaction_type, Device.id, Device.name,
+                  Device.serial, Device.category, User.id, User.username, model.notes) \
+        .join(Device, model.device_id == Device.id).join(User, model.user_id == User.id)
+    if category:
+        stmt = stmt.where(Device.category == category)
+    if transaction_type:
+        stmt = stmt.where(model.transaction_type == transaction_type)
+    if user_id:
+        stmt = stmt.where(model.user_id == user_id)
+    return stmt.where(*_date_range(model.created_at, date_from, date_to))
+
+
+def transaction_export_select(category=None, transaction_type=None, date_from=None, date_to=None, user_id=None, **_):
+    """SELECT toàn bộ lịch sử giao dịch (bảng nóng UNION ALL bảng lưu trữ) kèm tên thiết bị và người dùng bằng JOIN, không N+1."""
+    filters = (category, transaction_type, date_from, date_to, user_id)
+    stmt = union_all(_transaction_select(Transaction, *filters), _transaction_select(TransactionArchive, *filters))
+    return stmt.order_by('transaction_id')
+
+
+def _format(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S') if isinstance(value, datetime) else value
+
+
+def iter_csv(headers, stmt, batch_size=BATCH_SIZE):
+    """Sinh nội dung CSV theo từng khối; chỉ giữ một lô `batch_size` dòng trong bộ nhớ.
+
+    yield_per bật stream_results, nên PostgreSQL dùng server-side cursor thay vì tải hết kết quả.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    result = db.session.execute(stmt.execution_options(yield_per=batch_size))
+    for rows in result.partitions():
+        writer.writerows([_format(v) for v in row] for row in rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_stream(chunks, level=6):
+    """Nén gzip từng khối (zlib với wbits=31 sinh đúng định dạng .gz) mà không gom cả file."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,83 @@
+# app/services/http_cache.py
+
+import hashlib
+from functools import wraps
+from flask import request, session, current_app, make_response
+from flask_login import current_user
+from . import stats_service, cart_service
+from .export_service import gzip_stream
+
+COMPRESSIBLE_TYPES = {'text/html', 'text/csv', 'text/plain', 'application/json', 'text/css', 'application/javascript'}
+
+
+def catalog_etag():
+    """ETag rẻ: phiên bản CATALOG (một lần tra khóa chính) + người xem + số món trong giỏ + URL.
+
+    Trang có nội dung riêng theo người dùng (nút admin, giỏ hàng trên navbar) nên ETag gồm cả user.
+    """
+    user_key = f'{current_user.id}:{int(current_user.is_admin)}:{cart_service.pending_count()}' \
+        if current_user.is_authenticated else 'anon'
+    raw = f'{stats_service.current_version(stats_service.CATALOG)}|{user_key}|{request.full_path}'
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def conditional(view):
+    """Gắn ETag (weak, vì có thể nén gzip) và trả 304 nếu trình duyệt đã có bản mới nhất.
+
+    Bỏ qua khi còn flash message chờ hiển thị, vì trang đó khác với bản trình duyệt đã lưu.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if session.get('_flashes'):
+            return view(*args, **kwargs)
+        etag = catalog_etag()
+        if request.if_none_match.contains_weak(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        # private: trang theo từng người dùng; no-cache: luôn hỏi lại server nhưng được dùng bản đã lưu khi nhận 304
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+
+def _compress(response):
+    """Nén gzip HTML/CSV/JSON lớn; response dạng stream (export CSV) được nén từng khối."""
+    if (response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES
+            or 'gzip' not in request.accept_encodings):
+        return response
+    response.vary.add('Accept-Encoding')
+    level = current_app.config.get('HTTP_GZIP_LEVEL', 6)
+    if response.is_streamed:
+        response.response = gzip_stream(response.response, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config.get('HTTP_GZIP_MIN_SIZE', 1024):
+            return response
+        response.set_data(b''.join(gzip_stream([data], level)))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _cache_uploads(response):
+    """Ảnh trong static/uploads có tên duy nhất (mã băm nội dung hoặc uuid), không bao giờ bị ghi đè: cache vĩnh viễn."""
+    if request.endpoint == 'static' and (request.view_args or {}).get('filename', '').startswith('uploads/') \
+            and response.status_code in (200, 304):
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config.get('UPLOAD_CACHE_MAX_AGE', 31536000)
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
+
+def init_app(app):
+    @app.after_request
+    def apply_http_cache(response):
+        return _compress(_cache_uploads(response))
@@ -0,0 +1,265 @@
+# app/services/image_service.py
+
+import hashlib
+import io
+import os
+import re
+import shutil
+import tempfile
+import click
+from flask import current_app, url_for
+from sqlalchemy import event, select, update, delete, func
+from .. import db
+from ..models import ImageAsset
+
+# Giá trị EXIF Orientation làm ảnh xoay 90°: sau exif_transpose rộng và cao đổi chỗ
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+# Kích thước cạnh dài tối đa (px) của từng bản render; ảnh nhỏ hơn không bị phóng to
+RENDITIONS = {'thumb': 160, 'medium': 480, 'large': 1200}
+FORMATS = {'webp': ('WEBP', {'quality': 80, 'method': 4}),
+           'jpg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True})}
+ASSET_DIR = 'img'
+_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class InvalidImage(ValueError):
+    """File tải lên không phải ảnh đọc được."""
+
+
+def is_asset(image_url):
+    """Device.image_url mới lưu mã băm nội dung; giá trị cũ là tên file gốc trong static/uploads."""
+    return bool(image_url) and bool(_HASH_RE.match(image_url))
+
+
+def _asset_path(content_hash):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], ASSET_DIR, content_hash[:2], content_hash)
+
+
+def _render(data, directory):
+    """Tạo các bản WebP/JPEG theo từng kích thước vào `directory`; trả về (rộng, cao) ảnh gốc."""
+    from PIL import Image, ImageOps
+    try:
+        image = Image.open(io.BytesIO(data))
+        # Kích thước gốc phải đọc trước draft(): sau đó image.size là kích thước giải mã đã thu nhỏ
+        width, height = image.size
+        if image.getexif().get(0x0112) in TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        # JPEG: giải mã thẳng ở độ phân giải gần kích thước lớn nhất cần dùng, nhanh và ít RAM hơn nhiều
+        image.draft('RGB', (max(RENDITIONS.values()),) * 2)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    except Exception as e:
+        raise InvalidImage(f'Không đọc được ảnh: {e}') from e
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    base = image.convert('RGBA' if has_alpha else 'RGB')
+
+    # Thư mục tạm riêng cho mỗi lần render (cùng thư mục cha để đổi tên là nguyên tử):
+    # hai request cùng tải một ảnh không ghi đè hay xóa nhầm file của nhau
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+    try:
+        for name, max_side in sorted(RENDITIONS.items(), key=lambda item: -item[1]):
+            base.thumbnail((max_side, max_side), Image.LANCZOS) # Giảm dần từ lớn đến nhỏ
+            for extension, (pil_format, options) in FORMATS.items():
+                rendition = base if pil_format != 'JPEG' or not has_alpha else _flatten(base)
+                rendition.save(os.path.join(tmp_dir, f'{name}.{extension}'), pil_format, **options)
+        os.chmod(tmp_dir, 0o755) # mkdtemp tạo với quyền 0700, web server cần đọc được
+        # Bản nào đổi tên trước thì thắng (nội dung như nhau); thư mục đích đã có thì bỏ bản của mình
+        os.rename(tmp_dir, directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True) # Không còn gì nếu đổi tên thành công
+    return width, height
+
+
+def _flatten(image):
+    from PIL import Image
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+
+def store(file_storage):
+    """Xử lý ảnh tải lên thành các bản render và trả về mã băm để ghi vào Device.image_url.
+
+    Ảnh trùng nội dung (cùng SHA-256) chỉ được lưu và render một lần. Chưa tăng refcount:
+    gọi acquire() với số thiết bị dùng ảnh. Ném InvalidImage nếu không đọc được ảnh.
+    """
+    data = file_storage.read()
+    content_hash = hashlib.sha256(data).hexdigest()
+    directory = _asset_path(content_hash)
+    if not os.path.isdir(directory):
+        width, height = _render(data, directory)
+        db.session.info.setdefault('images_pending', {})[content_hash] = (width, height)
+    db.session.info.setdefault('images_acquired', set()).add(content_hash)
+    # Giữ nội dung đến hết giao dịch: file có thể bị dọn (ảnh vừa hết tham chiếu) trước khi acquire() giữ được dòng
+    db.session.info.setdefault('images_data', {})[content_hash] = data
+    return content_hash
+
+
+def _ensure_rendered(session, content_hash):
+    """Render lại từ nội dung đã giữ nếu thư mục ảnh đã bị dọn mất."""
+    data = session.info.get('images_data', {}).get(content_hash)
+    if data is not None and not os.path.isdir(_asset_path(content_hash)):
+        size = _render(data, _asset_path(content_hash))
+        session.info.setdefault('images_pending', {})[content_hash] = size
+
+
+def acquire(content_hash, references=1):
+    """Tăng refcount thêm `references` (tạo dòng image_asset nếu chưa có) bằng một UPDATE nguyên tử. Không commit.
+
+    UPDATE giữ khóa dòng đến hết giao dịch, nên bộ dọn ảnh (xóa dòng có refcount = 0 rồi mới xóa file, trong
+    cùng một giao dịch) không thể xóa file của ảnh sau thời điểm này; trước đó đã xóa thì render lại ở đây.
+    """
+    if not references:
+        return
+    result = db.session.execute(update(ImageAsset).where(ImageAsset.content_hash == content_hash)
+                                .values(refcount=ImageAsset.refcount + references))
+    _ensure_rendered(db.session, content_hash)
+    if not result.rowcount:
+        width, height = db.session.info.get('images_pending', {}).get(content_hash, (None, None))
+        db.session.add(ImageAsset(content_hash=content_hash, refcount=references, width=width, height=height))
+        db.session.flush()
+
+
+def release(image_url, references=1):
+    """Giảm refcount khi thiết bị bỏ/xóa ảnh; về 0 thì dòng và file được dọn sau khi commit. Không commit.
+
+    Ảnh kiểu cũ (tên file riêng cho từng thiết bị, trước khi có image_asset) được xóa như trước.
+    """
+    if not image_url:
+        return
+    if not is_asset(image_url):
+        # Ảnh cũ: thiết bị thêm hàng loạt dùng chung một file, chỉ xóa khi không còn thiết bị nào khác trỏ tới
+        from ..models import Device
+        others = db.session.execute(select(Device.id).where(Device.image_url == image_url).limit(references + 1)).all()
+        if len(others) <= references:
+            db.session.info.setdefault('images_released', set()).add(image_url)
+        return
+    db.session.execute(update(ImageAsset).where(ImageAsset.content_hash == image_url)
+                       .values(refcount=ImageAsset.refcount - references))
+    db.session.info.setdefault('images_released', set()).add(image_url)
+
+
+def _remove_files(image_url):
+    if is_asset(image_url):
+        directory = _asset_path(image_url)
+        shutil.rmtree(directory, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(directory)) # Thư mục tiền tố 2 ký tự, chỉ xóa được khi đã rỗng
+        except OSError:
+            pass
+    else:
+        path = os.path.join(current_app.config['UPLOAD_FOLDER'], image_url)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _delete_unreferenced(hashes):
+    """Xóa dòng image_asset có refcount <= 0 cùng file của chúng trong MỘT giao dịch riêng: file bị xóa khi
+    còn giữ khóa dòng (SQLite: khóa ghi), nên acquire() đồng thời hoặc chờ và thấy dòng đã mất, hoặc đã
+    tăng refcount trước và DELETE bỏ qua dòng đó."""
+    condition = (ImageAsset.content_hash.in_(hashes), ImageAsset.refcount <= 0)
+    with db.engine.begin() as conn:
+        if conn.dialect.delete_returning:
+            deleted = conn.execute(delete(ImageAsset).where(*condition).returning(ImageAsset.content_hash)).scalars().all()
+        else:
+            deleted = conn.execute(select(ImageAsset.content_hash).where(*condition).with_for_update()).scalars().all()
+            if deleted:
+                conn.execute(delete(ImageAsset).where(ImageAsset.content_hash.in_(deleted)))
+        for content_hash in deleted:
+            _remove_files(content_hash)
+
+
+def _cleanup_after_commit(session):
+    """Dọn ảnh không còn tham chiếu, chỉ sau khi commit thành công (rollback thì file vẫn còn)."""
+    if session.in_nested_transaction():
+        return # Chỉ là RELEASE SAVEPOINT, giao dịch ngoài chưa commit
+    released = session.info.pop('images_released', set())
+    acquired = session.info.pop('images_acquired', set())
+    session.info.pop('images_pending', None)
+    try:
+        for content_hash in acquired:
+            _ensure_rendered(session, content_hash) # Lưới an toàn: bị bộ dọn khi rollback của request khác xóa
+    finally:
+        session.info.pop('images_data', None)
+    hashes = [h for h in released if is_asset(h)]
+    if hashes:
+        _delete_unreferenced(hashes)
+    for image_url in released - set(hashes):
+        _remove_files(image_url)
+
+
+def _cleanup_after_rollback(session):
+    """Rollback: ảnh vừa tải lên mà không có dòng image_asset nào được commit thì bỏ kèm file."""
+    if session.in_nested_transaction():
+        return
+    session.info.pop('images_released', None)
+    session.info.pop('images_pending', None)
+    session.info.pop('images_data', None)
+    acquired = session.info.pop('images_acquired', set())
+    if not acquired:
+        return
+    with db.engine.connect() as conn:
+        alive = set(conn.execute(select(ImageAsset.content_hash).where(ImageAsset.content_hash.in_(acquired))).scalars())
+    for content_hash in acquired - alive:
+        _remove_files(content_hash)
+
+
+def rendition_url(image_url, size='medium', extension='jpg'):
+    """URL của bản render phù hợp; ảnh kiểu cũ thì trả về file gốc."""
+    if not image_url:
+        return None
+    if not is_asset(image_url):
+        return url_for('static', filename='uploads/' + image_url)
+    return url_for('static', filename=f'uploads/{ASSET_DIR}/{image_url[:2]}/{image_url}/{size}.{extension}')
+
+
+class _LocalFile:
+    """Bọc file trên đĩa cho store() (đọc giống FileStorage)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+@click.command('images-migrate')
+def images_migrate_command():
+    """Chuyển ảnh kiểu cũ (file gốc trong static/uploads) sang ảnh lưu theo mã băm có các bản render."""
+    from ..models import Device
+    legacy = db.session.execute(select(Device.image_url, func.count()).where(Device.image_url.isnot(None))
+                                .group_by(Device.image_url)).all()
+    migrated = 0
+    for image_url, count in legacy:
+        if is_asset(image_url):
+            continue
+        path = os.path.join(current_app.config['UPLOAD_FOLDER'], image_url)
+        if not os.path.exists(path):
+            click.echo(f'Bỏ qua {image_url}: không tìm thấy file.')
+            continue
+        try:
+            content_hash = store(_LocalFile(path))
+        except InvalidImage as e:
+            click.echo(f'Bỏ qua {image_url}: {e}')
+            continue
+        acquire(content_hash, count)
+        db.session.execute(update(Device).where(Device.image_url == image_url)
+                           .values(image_url=content_hash, version=Device.version + 1))
+        db.session.info.setdefault('images_released', set()).add(image_url)
+        db.session.commit()
+        migrated += 1
+    click.echo(f'Đã chuyển {migrated} ảnh.')
+
+
+def init_app(app):
+    app.cli.add_command(images_migrate_command)
+    event.listen(db.session, 'after_commit', _cleanup_after_commit)
+    event.listen(db.session, 'after_rollback', _cleanup_after_rollback)
+    app.jinja_env.globals['rendition_url'] = rendition_url
+    app.jinja_env.globals['is_image_asset'] = is_asset
@@ -0,0 +1,180 @@
+# app/services/import_job_service.py
+
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from sqlalchemy import event, select, update, func, or_, and_
+from .. import db
+from ..models import ImportJob
+from . import import_service
+
+_wakeup = threading.Event()
+_started = False
+_start_lock = threading.Lock()
+
+
+def _lease():
+    return datetime.utcnow() + timedelta(seconds=current_app.config.get('IMPORT_LEASE_SECONDS', 600))
+
+
+def enqueue(file_storage, created_by_id):
+    """Lưu file upload ra thư mục tạm và tạo job 'Queued'. Không commit; worker được đánh thức sau commit."""
+    extension = os.path.splitext(file_storage.filename.lower())[1]
+    if extension not in import_service.ALLOWED_IMPORT_EXTENSIONS:
+        raise import_service.ImportFileError('Định dạng file không hợp lệ. Vui lòng chỉ upload file .xlsx hoặc .csv.')
+    staging_dir = current_app.config['IMPORT_STAGING_DIR']
+    os.makedirs(staging_dir, exist_ok=True)
+    stored_path = os.path.join(staging_dir, f'{uuid.uuid4().hex}{extension}')
+    file_storage.save(stored_path)
+    job = ImportJob(filename=file_storage.filename, stored_path=stored_path, created_by_id=created_by_id)
+    db.session.add(job)
+    db.session.info['import_queued'] = True
+    return job
+
+
+def claim_job():
+    """Nhận một job đang chờ bằng UPDATE có điều kiện (nhiều worker không nhận trùng). Trả về id hoặc None.
+
+    Job 'Running' quá hạn giữ (worker chết giữa chừng) cũng được nhận lại và chạy tiếp từ lô đã commit.
+    """
+    now = datetime.utcnow()
+    due = or_(ImportJob.status == 'Queued', and_(ImportJob.status == 'Running', ImportJob.locked_until < now))
+    candidate = select(ImportJob.id).where(due).order_by(ImportJob.id).limit(1).with_for_update(skip_locked=True)
+    stmt = update(ImportJob).where(ImportJob.id.in_(candidate.scalar_subquery()), due) \
+        .values(status='Running', locked_until=_lease(), started_at=func.coalesce(ImportJob.started_at, now))
+
+    if db.session.get_bind().dialect.update_returning:
+        job_id = db.session.execute(stmt.returning(ImportJob.id), execution_options={'synchronize_session': False}).scalar()
+    else:
+        job_id = db.session.execute(candidate).scalar()
+        if job_id is not None:
+            result = db.session.execute(stmt.where(ImportJob.id == job_id), execution_options={'synchronize_session': False})
+            job_id = job_id if result.rowcount else None
+    db.session.commit()
+    return job_id
+
+
+def _save_progress(job, result):
+    """Ghi tiến độ và commit lô vừa chèn cùng một giao dịch, nên tiến độ luôn khớp với dữ liệu đã lưu."""
+    job.rows_processed = result.rows_processed
+    job.added_count = result.added_count
+    job.duplicate_count = result.duplicate_count
+    job.invalid_count = result.invalid_count
+    job.result_json = json.dumps(result.to_dict(), ensure_ascii=False)
+    job.locked_until = _lease()
+    db.session.commit()
+
+
+def run_job(job_id):
+    """Xử lý một job đã nhận. Mỗi lô được commit riêng để trang tiến độ thấy được và job có thể chạy tiếp nếu bị dừng."""
+    job = db.session.get(ImportJob, job_id)
+    try:
+        if job.total_rows is None:
+            with open(job.stored_path, 'rb') as f:
+                job.total_rows = import_service.count_rows(f, job.filename)
+            db.session.commit()
+        resumed = import_service.ImportResult.from_dict(json.loads(job.result_json)) if job.result_json else None
+        with open(job.stored_path, 'rb') as f:
+            import_service.import_devices(f, job.filename, job.created_by_id,
+                                          chunk_size=current_app.config.get('IMPORT_CHUNK_SIZE', 1000),
+                                          progress=lambda result: _save_progress(job, result),
+                                          result=resumed, skip_rows=job.rows_processed)
+        job.status = 'Completed'
+    except import_service.ImportFileError as e:
+        # Lỗi nội dung file (thiếu cột, sai định dạng): báo cho người dùng, không cần traceback
+        db.session.rollback()
+        job.status = 'Failed'
+        job.error = str(e)
+    except Exception as e:
+        # Các lô đã commit vẫn được giữ; nhập lại cùng file sẽ bỏ qua chúng như serial trùng
+        db.session.rollback()
+        current_app.logger.exception(f"Lỗi khi nhập file (job {job_id}): {e}")
+        job.status = 'Failed'
+        job.error = str(e) or e.__class__.__name__
+    job.locked_until = None
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    if os.path.exists(job.stored_path):
+        os.remove(job.stored_path)
+    return job
+
+
+def run_pending():
+    """Chạy lần lượt mọi job đang chờ. Trả về số job đã xử lý."""
+    count = 0
+    while (job_id := claim_job()) is not None:
+        run_job(job_id)
+        count += 1
+    return count
+
+
+def job_status(job):
+    """Trạng thái job dạng dict cho endpoint JSON mà trang upload thăm dò."""
+    return {
+        'id': job.id, 'status': job.status, 'filename': job.filename,
+        'rows_processed': job.rows_processed, 'total_rows': job.total_rows, 'percent': job.percent,
+        'added_count': job.added_count, 'duplicate_count': job.duplicate_count,
+        'invalid_count': job.invalid_count, 'error': job.error,
+        'finished': job.status in ('Completed', 'Failed'),
+    }
+
+
+def job_result(job):
+    """Báo cáo chi tiết (các dòng đã thêm / trùng / lỗi) của job."""
+    data = json.loads(job.result_json) if job.result_json else {}
+    return import_service.ImportResult.from_dict(data)
+
+
+def _run_forever(app):
+    interval = app.config.get('IMPORT_POLL_INTERVAL', 5)
+    while True:
+        try:
+            with app.app_context():
+                processed = run_pending()
+        except Exception as e:
+            app.logger.exception(f"Lỗi worker nhập file nền: {e}")
+            processed = 0
+        if not processed:
+            _wakeup.wait(interval)
+            _wakeup.clear()
+
+
+def start_background_worker(app):
+    """Khởi động thread xử lý job nhập file (một lần cho mỗi tiến trình worker)."""
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_run_forever, args=(app,), name='import-jobs', daemon=True).start()
+
+
+def _wake_after_commit(session):
+    if session.in_nested_transaction():
+        return # RELEASE SAVEPOINT, chưa phải commit thật
+    if session.info.pop('import_queued', False):
+        _wakeup.set()
+
+
+@click.command('import-worker')
+@click.option('--loop', is_flag=True, help='Chạy liên tục như một worker riêng.')
+def import_worker_command(loop):
+    """Xử lý các job nhập thiết bị đang chờ trong import_job."""
+    if loop:
+        click.echo('Worker nhập file đang chạy (Ctrl+C để dừng)...')
+        _run_forever(current_app._get_current_object())
+    click.echo(f'Đã xử lý {run_pending()} job nhập file.')
+
+
+def init_app(app):
+    event.listen(db.session, 'after_commit', _wake_after_commit)
+    app.cli.add_command(import_worker_command)
+    if app.config.get('IMPORT_BACKGROUND'):
+        @app.before_request
+        def ensure_import_worker_running():
+            # Giống bộ gửi email: khởi động trong đúng tiến trình worker sau khi fork
+            start_background_worker(app)
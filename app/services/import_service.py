@@ -0,0 +1,206 @@
+# app/services/import_service.py
+
+import csv
+import io
+import os
+from contextlib import closing
+from datetime import datetime
+from openpyxl import load_workbook
+from sqlalchemy import select, insert
+from .. import db
+from ..models import Device
+from . import search_service, stats_service
+from .inventory_service import ON_CONFLICT_INSERTS
+
+REQUIRED_COLUMNS = ['name', 'serial']
+# Giá trị mặc định cho các cột tùy chọn
+DEFAULTS = {'category': 'Other', 'description': '', 'location': 'Kho chính', 'unit': 'Cái'}
+ALLOWED_IMPORT_EXTENSIONS = ('.xlsx', '.csv')
+
+
+class ImportFileError(ValueError):
+    """Lỗi làm dừng cả file (sai định dạng, thiếu cột bắt buộc)."""
+
+
+class ImportResult:
+    """Kết quả nhập: số thiết bị đã thêm và báo cáo lỗi theo từng dòng (giới hạn số dòng lưu lại)."""
+
+    def __init__(self, max_errors=1000):
+        self.added_count = 0
+        self.rows_processed = 0
+        self.duplicate_count = 0
+        self.invalid_count = 0
+        self.errors = []          # (số dòng, serial, loại lỗi 'duplicate'/'invalid', thông báo)
+        self.added = []           # (số dòng, serial, tên) của các thiết bị đã thêm
+        self.max_errors = max_errors
+
+    @classmethod
+    def from_dict(cls, data, max_errors=1000):
+        """Dựng lại kết quả đã lưu (dùng khi tiếp tục một job nhập bị dừng giữa chừng)."""
+        result = cls(max_errors=max_errors)
+        for field in ('added_count', 'rows_processed', 'duplicate_count', 'invalid_count'):
+            setattr(result, field, data.get(field, 0))
+        result.errors = [tuple(e) for e in data.get('errors', [])]
+        result.added = [tuple(a) for a in data.get('added', [])]
+        return result
+
+    def add_error(self, row_number, serial, kind, message):
+        if kind == 'duplicate':
+            self.duplicate_count += 1
+        else:
+            self.invalid_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((row_number, serial, kind, message))
+
+    def add_added(self, row_number, serial, name):
+        self.added_count += 1
+        if len(self.added) < self.max_errors:
+            self.added.append((row_number, serial, name))
+
+    @property
+    def errors_truncated(self):
+        return self.duplicate_count + self.invalid_count - len(self.errors)
+
+    @property
+    def added_truncated(self):
+        return self.added_count - len(self.added)
+
+    def to_dict(self):
+        return {
+            'added_count': self.added_count, 'rows_processed': self.rows_processed,
+            'duplicate_count': self.duplicate_count, 'invalid_count': self.invalid_count,
+            'errors': [list(e) for e in self.errors], 'added': [list(a) for a in self.added],
+        }
+
+
+def _cell_text(value):
+    """Chuẩn hóa giá trị ô về chuỗi: 12345.0 -> '12345', None -> ''."""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _iter_xlsx(stream):
+    # read_only: openpyxl đọc từng dòng từ file, không dựng cả workbook trong bộ nhớ
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        for row in workbook.active.iter_rows(values_only=True):
+            yield row
+    finally:
+        workbook.close()
+
+
+def _iter_csv(stream):
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        yield from csv.reader(text_stream)
+    finally:
+        text_stream.detach()
+
+
+def iter_rows(stream, filename):
+    """Đọc lần lượt từng dòng (dòng đầu là tiêu đề) từ file .xlsx hoặc .csv."""
+    extension = os.path.splitext(filename.lower())[1]
+    if extension == '.xlsx':
+        return _iter_xlsx(stream)
+    if extension == '.csv':
+        return _iter_csv(stream)
+    raise ImportFileError('Định dạng file không hợp lệ. Vui lòng chỉ upload file .xlsx hoặc .csv '
+                       '(file .xls cũ hãy lưu lại thành .xlsx).')
+
+
+def _insert_chunk(chunk, created_by_id, result):
+    """Chèn cả lô bằng INSERT ... ON CONFLICT (serial) DO NOTHING RETURNING (bảng ON_CONFLICT_INSERTS của inventory_service):
+    serial đã có (kể cả do admin khác hoặc một lần nhập khác vừa thêm) bị bỏ qua thay vì làm hỏng cả lô.
+    CSDL không hỗ trợ thì kiểm tra tồn tại bằng MỘT câu SELECT ... IN cho cả lô rồi chèn các dòng mới."""
+    now = datetime.utcnow()
+    rows = [dict(record, created_by_id=created_by_id, status='Available', created_at=now) for _, record in chunk]
+    dialect_insert = ON_CONFLICT_INSERTS.get(db.session.get_bind().dialect.name)
+    if dialect_insert is not None:
+        stmt = dialect_insert(Device).on_conflict_do_nothing(index_elements=['serial']).returning(Device.serial, Device.id)
+        inserted = dict(db.session.execute(stmt, rows).all())
+    else:
+        serials = [row['serial'] for row in rows]
+        existing = set(db.session.execute(select(Device.serial).where(Device.serial.in_(serials))).scalars())
+        rows = [row for row in rows if row['serial'] not in existing]
+        inserted = {}
+        if rows:
+            new_ids = db.session.execute(insert(Device).returning(Device.id), rows).scalars().all()
+            inserted = dict(zip((row['serial'] for row in rows), new_ids))
+    for row_number, record in chunk:
+        if record['serial'] in inserted:
+            result.add_added(row_number, record['serial'], record['name'])
+        else:
+            # Serial trùng ở lô trước của chính file này cũng rơi vào đây vì lô trước đã được chèn
+            result.add_error(row_number, record['serial'], 'duplicate', 'đã có trong CSDL hoặc trùng dòng trước trong file')
+    if inserted:
+        search_service.reindex_devices(list(inserted.values()))
+
+
+def count_rows(stream, filename):
+    """Ước lượng số dòng dữ liệu (không kể tiêu đề) để hiển thị tiến độ; None nếu không biết."""
+    if filename.lower().endswith('.xlsx'):
+        workbook = load_workbook(stream, read_only=True)
+        try:
+            max_row = workbook.active.max_row # Đọc từ thẻ <dimension>, không quét cả sheet
+        finally:
+            workbook.close()
+        return max_row - 1 if max_row else None
+    return max(sum(1 for _ in stream) - 1, 0)
+
+
+def import_devices(stream, filename, created_by_id, chunk_size=1000, max_errors=1000, progress=None,
+                   result=None, skip_rows=0):
+    """Nhập thiết bị từ file theo từng lô `chunk_size` dòng; bộ nhớ dùng không phụ thuộc kích thước file.
+
+    Không commit: người gọi commit (hoặc rollback toàn bộ nếu có lỗi nghiêm trọng).
+    `progress(result)` được gọi sau mỗi lô nếu có; job nền commit tại đó. Khi tiếp tục một job dở,
+    truyền `result` đã lưu và `skip_rows` = số dòng đã xử lý để bỏ qua phần đã nhập.
+    """
+    result = result or ImportResult(max_errors=max_errors)
+    # closing(): đóng generator (và workbook) ngay cả khi dừng sớm vì lỗi, trước khi file bị đóng
+    with closing(iter_rows(stream, filename)) as rows:
+        header = next(rows, None)
+        if header is None:
+            raise ImportFileError('File rỗng.')
+        columns = [_cell_text(c).lower() for c in header]
+        missing = [c for c in REQUIRED_COLUMNS if c not in columns]
+        if missing:
+            raise ImportFileError(f'File phải có các cột bắt buộc: {", ".join(REQUIRED_COLUMNS)}')
+        index = {name: columns.index(name) for name in REQUIRED_COLUMNS + list(DEFAULTS) if name in columns}
+
+        chunk, seen_in_chunk = [], set()
+        for row_number, row in enumerate(rows, start=2):
+            if row_number - 2 < skip_rows:
+                continue
+            result.rows_processed += 1
+            values = {name: _cell_text(row[i]) if i < len(row) else '' for name, i in index.items()}
+            if not any(values.values()):
+                continue # Bỏ qua dòng trống
+            name, serial = values.get('name', ''), values.get('serial', '').upper()
+            if not name or not serial:
+                result.add_error(row_number, serial, 'invalid', 'thiếu Tên hoặc Serial')
+                continue
+            if serial in seen_in_chunk:
+                result.add_error(row_number, serial, 'duplicate', 'trùng trong file')
+                continue
+            seen_in_chunk.add(serial)
+            record = {'name': name, 'serial': serial}
+            for field, default in DEFAULTS.items():
+                record[field] = values.get(field) or default
+            chunk.append((row_number, record))
+
+            if len(chunk) >= chunk_size:
+                _insert_chunk(chunk, created_by_id, result)
+                chunk, seen_in_chunk = [], set()
+                if progress:
+                    progress(result)
+        if chunk:
+            _insert_chunk(chunk, created_by_id, result)
+        if result.added_count:
+            stats_service.bump_version()
+        if progress:
+            progress(result)
+        return result
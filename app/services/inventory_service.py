@@ -0,0 +1,118 @@
+# app/services/inventory_service.py
+
+from datetime import datetime
+from sqlalchemy import select, update, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from .. import db
+from ..models import Device, Transaction
+from . import stats_service, search_service, archive_service
+from .state_machine import check_transition
+
+# Số ID tối đa trong một mệnh đề IN (dưới giới hạn tham số của SQLite)
+CHUNK_SIZE = 500
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def bulk_transition(from_status, to_status, user_id, transaction_type, notes,
+                    device_ids=None, id_query=None, borrower_id=None):
+    """Chuyển trạng thái hàng loạt bằng UPDATE có điều kiện và ghi Transaction bằng một lệnh INSERT nhiều dòng.
+
+    Chỉ những thiết bị đang ở `from_status` mới được cập nhật (WHERE status = ...), nên hai admin
+    thao tác cùng lúc không thể mượn trùng một thiết bị. Truyền `device_ids` (danh sách ID) hoặc
+    `id_query` (câu SELECT id, vd. từ bộ lọc của trang danh sách). Trả về danh sách ID đã chuyển.
+    Không commit; người gọi quyết định commit/rollback.
+    """
+    check_transition('Device', from_status, to_status)
+    selections = list(_chunks(device_ids)) if device_ids is not None else [id_query]
+    dialect = db.session.get_bind().dialect
+    moved = []
+    for selection in selections:
+        condition = (Device.id.in_(selection), Device.status == from_status)
+        stmt = update(Device).where(*condition).values(status=to_status, borrower_id=borrower_id,
+                                                       version=Device.version + 1)
+        if dialect.update_returning:
+            result = db.session.execute(stmt.returning(Device.id), execution_options={'synchronize_session': False})
+            moved.extend(result.scalars().all())
+        else:
+            # CSDL không hỗ trợ RETURNING: khóa các dòng trước rồi mới cập nhật
+            ids = db.session.execute(select(Device.id).where(*condition).with_for_update()).scalars().all()
+            if ids:
+                db.session.execute(stmt.where(Device.id.in_(ids)), execution_options={'synchronize_session': False})
+            moved.extend(ids)
+
+    if moved:
+        now = datetime.utcnow()
+        db.session.execute(insert(Transaction), [
+            {'device_id': device_id, 'user_id': user_id, 'transaction_type': transaction_type,
+             'notes': notes, 'created_at': now}
+            for device_id in moved
+        ])
+        if transaction_type == archive_service.BORROW_TYPE:
+            archive_service.record_borrows(db.session.connection(), [(device_id, user_id, now) for device_id in moved])
+        # UPDATE/INSERT ở mức Core không đi qua sự kiện flush của ORM
+        stats_service.bump_version()
+    return moved
+
+
+# Các CSDL có INSERT ... ON CONFLICT DO NOTHING
+ON_CONFLICT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def split_duplicates(serials):
+    """Tách danh sách serial thành (serial duy nhất theo thứ tự gặp, serial lặp lại trong chính danh sách)."""
+    unique, repeated, seen = [], [], set()
+    for serial in serials:
+        if serial in seen:
+            repeated.append(serial)
+        else:
+            seen.add(serial)
+            unique.append(serial)
+    return unique, repeated
+
+
+def bulk_create_devices(serials, fields, created_by_id):
+    """Thêm nhiều thiết bị cùng thông tin `fields` (name, category, ...), mỗi serial một thiết bị.
+
+    Mỗi lô CHUNK_SIZE serial là một lệnh INSERT ... ON CONFLICT (serial) DO NOTHING RETURNING,
+    nên serial đã tồn tại (kể cả do admin khác vừa thêm) bị bỏ qua mà không cần SELECT trước.
+    CSDL không hỗ trợ thì kiểm tra bằng một SELECT ... IN cho mỗi lô. Không commit.
+    Trả về (số thiết bị đã thêm, serial đã tồn tại, serial lặp trong danh sách).
+    """
+    unique, repeated = split_duplicates(serials)
+    dialect = db.session.get_bind().dialect
+    dialect_insert = ON_CONFLICT_INSERTS.get(dialect.name)
+    now, new_ids, existing = datetime.utcnow(), [], []
+    for chunk in _chunks(unique):
+        rows = [dict(fields, serial=serial, created_by_id=created_by_id, status='Available', created_at=now)
+                for serial in chunk]
+        if dialect_insert is not None:
+            stmt = dialect_insert(Device).on_conflict_do_nothing(index_elements=['serial']) \
+                .returning(Device.serial, Device.id)
+            inserted = dict(db.session.execute(stmt, rows).all())
+        else:
+            taken = set(db.session.execute(select(Device.serial).where(Device.serial.in_(chunk))).scalars())
+            rows = [row for row in rows if row['serial'] not in taken]
+            inserted = {}
+            if rows:
+                db.session.execute(insert(Device), rows)
+                inserted = dict(db.session.execute(select(Device.serial, Device.id)
+                                                   .where(Device.serial.in_([row['serial'] for row in rows]))).all())
+        existing.extend(serial for serial in chunk if serial not in inserted)
+        new_ids.extend(inserted.values())
+
+    if new_ids:
+        # INSERT ở mức Core không đi qua sự kiện flush của ORM
+        search_service.reindex_devices(new_ids)
+        stats_service.bump_version()
+    return len(new_ids), existing, repeated
+
+
+def device_names(device_ids):
+    """Tên của các thiết bị (một truy vấn), dùng để báo lỗi."""
+    if not device_ids:
+        return []
+    return db.session.execute(select(Device.name).where(Device.id.in_(list(device_ids))).order_by(Device.name)).scalars().all()
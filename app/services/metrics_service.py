@@ -0,0 +1,383 @@
+# app/services/metrics_service.py
+
+import atexit
+import glob
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+import click
+from flask import g, request, has_request_context, current_app, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Cận trên (giây) của các bucket histogram thời gian, và của histogram số câu SQL mỗi request
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Số liệu của tiến trình (worker) hiện tại; mỗi worker ghi bản chụp ra METRICS_DIR, /admin/metrics cộng tất cả
+_lock = threading.Lock()
+_endpoints = {}
+_emails = {}
+_slow = deque(maxlen=100)
+_process = None # (pid, thời điểm bắt đầu) của tiến trình đang ghi
+_last_flush = 0.0
+_enabled_dir = None
+
+
+class Histogram:
+    """Histogram tích lũy kiểu Prometheus: đếm theo bucket (không cộng dồn), tổng và số mẫu."""
+
+    def __init__(self, bounds, counts=None, total=0.0, count=0):
+        self.bounds = tuple(bounds)
+        self.counts = list(counts) if counts else [0] * (len(self.bounds) + 1)
+        self.sum, self.count = total, count
+
+    def observe(self, value):
+        index = next((i for i, bound in enumerate(self.bounds) if value <= bound), len(self.bounds))
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """Ước lượng phân vị bằng cận trên của bucket chứa nó (None nếu chưa có mẫu)."""
+        if not self.count:
+            return None
+        target, seen = q * self.count, 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        return {'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+    @classmethod
+    def from_dict(cls, bounds, data):
+        return cls(bounds, data['counts'], data['sum'], data['count'])
+
+
+def _endpoint_entry(endpoint):
+    entry = _endpoints.get(endpoint)
+    if entry is None:
+        entry = _endpoints[endpoint] = {
+            'latency': Histogram(LATENCY_BUCKETS), 'sql_per_request': Histogram(SQL_COUNT_BUCKETS),
+            'sql_seconds': 0.0, 'template_seconds': 0.0, 'status': {}, 'slow': 0, 'max_sql': 0,
+        }
+    return entry
+
+
+def _email_entry(transport):
+    entry = _emails.get(transport)
+    if entry is None:
+        entry = _emails[transport] = {'latency': Histogram(LATENCY_BUCKETS), 'failures': 0}
+    return entry
+
+
+# --- THU THẬP ---
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['metrics_query_start'].pop()
+    if has_request_context():
+        stats = g.get('metrics')
+        if stats is not None:
+            stats['sql_count'] += 1
+            stats['sql_seconds'] += time.perf_counter() - started
+
+
+def _handle_error(exception_context):
+    # Câu lệnh lỗi không gọi after_cursor_execute: bỏ mốc thời gian đã đẩy vào
+    starts = exception_context.connection.info.get('metrics_query_start') if exception_context.connection else None
+    if starts:
+        starts.pop()
+
+
+def _before_render(sender, template, context, **extra):
+    if has_request_context() and g.get('metrics') is not None:
+        g.metrics['template_started'].append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    if has_request_context() and g.get('metrics') is not None and g.metrics['template_started']:
+        g.metrics['template_seconds'] += time.perf_counter() - g.metrics['template_started'].pop()
+
+
+def _start_request():
+    g.metrics = {'started': time.perf_counter(), 'sql_count': 0, 'sql_seconds': 0.0,
+                 'template_seconds': 0.0, 'template_started': []}
+
+
+def _finish_request(response):
+    """Ghi số liệu của request vừa xong (response dạng stream chỉ tính đến lúc tạo response)."""
+    stats = g.pop('metrics', None)
+    if stats is None:
+        return response
+    duration = time.perf_counter() - stats['started']
+    endpoint = request.endpoint or ('static' if request.path.startswith('/static/') else '<không khớp route>')
+    threshold = current_app.config.get('SLOW_REQUEST_THRESHOLD_MS', 500) / 1000
+    with _lock:
+        entry = _endpoint_entry(endpoint)
+        entry['latency'].observe(duration)
+        entry['sql_per_request'].observe(stats['sql_count'])
+        entry['sql_seconds'] += stats['sql_seconds']
+        entry['template_seconds'] += stats['template_seconds']
+        entry['max_sql'] = max(entry['max_sql'], stats['sql_count'])
+        status = str(response.status_code)
+        entry['status'][status] = entry['status'].get(status, 0) + 1
+        if duration >= threshold:
+            entry['slow'] += 1
+            _slow.append({'at': datetime.utcnow().isoformat(timespec='seconds'), 'endpoint': endpoint,
+                          'method': request.method, 'path': request.full_path.rstrip('?'), 'status': response.status_code,
+                          'ms': round(duration * 1000, 1), 'sql_count': stats['sql_count'],
+                          'sql_ms': round(stats['sql_seconds'] * 1000, 1),
+                          'template_ms': round(stats['template_seconds'] * 1000, 1), 'pid': os.getpid()})
+    if duration >= threshold:
+        current_app.logger.warning(
+            f"Request chậm {duration * 1000:.0f}ms: {request.method} {request.full_path.rstrip('?')} -> {response.status_code} "
+            f"({stats['sql_count']} câu SQL {stats['sql_seconds'] * 1000:.0f}ms, template {stats['template_seconds'] * 1000:.0f}ms)")
+    if current_app.config.get('SERVER_TIMING_HEADER'):
+        # Cho DevTools của trình duyệt và công cụ benchmark ('flask benchmark --url ...') đọc được số câu SQL
+        response.headers['Server-Timing'] = (f'app;dur={duration * 1000:.1f}, '
+                                             f'sql;dur={stats["sql_seconds"] * 1000:.1f};desc="{stats["sql_count"]}", '
+                                             f'tpl;dur={stats["template_seconds"] * 1000:.1f}')
+    _maybe_flush(current_app.config.get('METRICS_FLUSH_INTERVAL', 5))
+    return response
+
+
+@contextmanager
+def track_email(transport):
+    """Đo thời gian gửi một email qua `transport` (gồm cả lần gửi lỗi)."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        with _lock:
+            _email_entry(transport)['failures'] += 1
+        raise
+    finally:
+        with _lock:
+            _email_entry(transport)['latency'].observe(time.perf_counter() - started)
+
+
+# --- GỘP GIỮA CÁC WORKER ---
+
+def max_rss_bytes():
+    """Bộ nhớ thường trú cao nhất của tiến trình (None nếu hệ điều hành không hỗ trợ module resource)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024 # Linux tính bằng KB, macOS bằng byte
+
+def snapshot():
+    """Bản chụp số liệu của tiến trình hiện tại (dạng JSON được)."""
+    with _lock:
+        return {
+            'pid': os.getpid(), 'written_at': time.time(),
+            'endpoints': {name: {**{k: v for k, v in entry.items() if k not in ('latency', 'sql_per_request')},
+                                 'status': dict(entry['status']), 'latency': entry['latency'].to_dict(),
+                                 'sql_per_request': entry['sql_per_request'].to_dict()}
+                          for name, entry in _endpoints.items()},
+            'emails': {name: {'failures': entry['failures'], 'latency': entry['latency'].to_dict()}
+                       for name, entry in _emails.items()},
+            'slow': list(_slow), 'max_rss': max_rss_bytes(),
+        }
+
+
+def _snapshot_path():
+    """File bản chụp của tiến trình hiện tại. Tính theo pid lúc ghi (gunicorn --preload fork worker sau create_app);
+    thêm thời điểm khởi động để worker mới được cấp lại pid cũ không ghi đè số liệu của worker đã dừng."""
+    global _process
+    if _enabled_dir is None:
+        return None
+    if _process is None or _process[0] != os.getpid():
+        _process = (os.getpid(), int(time.time()))
+    return os.path.join(_enabled_dir, f'{_process[0]}-{_process[1]}.json')
+
+
+def _flush():
+    path = _snapshot_path()
+    if path is None:
+        return
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def _maybe_flush(interval):
+    global _last_flush
+    now = time.monotonic()
+    if now - _last_flush >= interval:
+        _last_flush = now
+        try:
+            _flush()
+        except OSError as e:
+            current_app.logger.warning(f"Không ghi được số liệu ra {_snapshot_path()}: {e}")
+
+
+def aggregate():
+    """Cộng số liệu của mọi worker: các file bản chụp trong METRICS_DIR (kể cả của worker đã dừng, để bộ đếm
+    không bị giảm) và số liệu mới nhất của tiến trình hiện tại thay cho file của chính nó."""
+    snapshots, own_path = [], _snapshot_path()
+    for path in glob.glob(os.path.join(current_app.config['METRICS_DIR'], '*.json')):
+        if path == own_path:
+            continue
+        try:
+            with open(path, encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue # File đang được ghi dở hoặc vừa bị xóa
+    snapshots.append(snapshot())
+
+    endpoints, emails, slow, max_rss = {}, {}, [], {}
+    for data in snapshots:
+        for name, entry in data['endpoints'].items():
+            total = endpoints.setdefault(name, {'latency': Histogram(LATENCY_BUCKETS), 'sql_per_request': Histogram(SQL_COUNT_BUCKETS),
+                                                'sql_seconds': 0.0, 'template_seconds': 0.0, 'status': {}, 'slow': 0, 'max_sql': 0})
+            total['latency'].merge(Histogram.from_dict(LATENCY_BUCKETS, entry['latency']))
+            total['sql_per_request'].merge(Histogram.from_dict(SQL_COUNT_BUCKETS, entry['sql_per_request']))
+            for key in ('sql_seconds', 'template_seconds', 'slow'):
+                total[key] += entry[key]
+            total['max_sql'] = max(total['max_sql'], entry['max_sql'])
+            for status, count in entry['status'].items():
+                total['status'][status] = total['status'].get(status, 0) + count
+        for name, entry in data['emails'].items():
+            total = emails.setdefault(name, {'latency': Histogram(LATENCY_BUCKETS), 'failures': 0})
+            total['latency'].merge(Histogram.from_dict(LATENCY_BUCKETS, entry['latency']))
+            total['failures'] += entry['failures']
+        slow.extend(data['slow'])
+        if data.get('max_rss'):
+            max_rss[data['pid']] = data['max_rss']
+    slow.sort(key=lambda row: row['at'], reverse=True)
+    return {'endpoints': endpoints, 'emails': emails, 'slow': slow, 'workers': len(snapshots), 'max_rss': max_rss}
+
+
+# --- ĐỊNH DẠNG PROMETHEUS ---
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram_lines(name, labels, histogram):
+    lines, cumulative = [], 0
+    for bound, count in zip(histogram.bounds + (float('inf'),), histogram.counts):
+        cumulative += count
+        le = '+Inf' if bound == float('inf') else repr(float(bound))
+        lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram.sum!r}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+    return lines
+
+
+def prometheus_text(data=None):
+    """Số liệu đã gộp theo định dạng text của Prometheus (text/plain; version=0.0.4)."""
+    data = data or aggregate()
+    out = []
+
+    def header(name, kind, help_text):
+        out.extend([f'# HELP {name} {help_text}', f'# TYPE {name} {kind}'])
+
+    endpoints = sorted(data['endpoints'].items())
+    header('app_request_duration_seconds', 'histogram', 'Request latency by endpoint.')
+    for name, entry in endpoints:
+        out.extend(_histogram_lines('app_request_duration_seconds', f'endpoint="{_label(name)}"', entry['latency']))
+    header('app_requests_total', 'counter', 'Requests by endpoint and status code.')
+    for name, entry in endpoints:
+        for status, count in sorted(entry['status'].items()):
+            out.append(f'app_requests_total{{endpoint="{_label(name)}",status="{status}"}} {count}')
+    header('app_sql_statements_per_request', 'histogram', 'SQL statements issued per request by endpoint.')
+    for name, entry in endpoints:
+        out.extend(_histogram_lines('app_sql_statements_per_request', f'endpoint="{_label(name)}"', entry['sql_per_request']))
+    header('app_sql_seconds_total', 'counter', 'Time spent executing SQL by endpoint.')
+    for name, entry in endpoints:
+        out.append(f'app_sql_seconds_total{{endpoint="{_label(name)}"}} {entry["sql_seconds"]!r}')
+    header('app_template_render_seconds_total', 'counter', 'Time spent rendering templates by endpoint.')
+    for name, entry in endpoints:
+        out.append(f'app_template_render_seconds_total{{endpoint="{_label(name)}"}} {entry["template_seconds"]!r}')
+    header('app_slow_requests_total', 'counter', 'Requests slower than SLOW_REQUEST_THRESHOLD_MS by endpoint.')
+    for name, entry in endpoints:
+        out.append(f'app_slow_requests_total{{endpoint="{_label(name)}"}} {entry["slow"]}')
+    header('app_email_send_seconds', 'histogram', 'Outbound email delivery latency by transport.')
+    for name, entry in sorted(data['emails'].items()):
+        out.extend(_histogram_lines('app_email_send_seconds', f'transport="{_label(name)}"', entry['latency']))
+    header('app_email_failures_total', 'counter', 'Failed outbound email deliveries by transport.')
+    for name, entry in sorted(data['emails'].items()):
+        out.append(f'app_email_failures_total{{transport="{_label(name)}"}} {entry["failures"]}')
+    header('app_process_max_rss_bytes', 'gauge', 'Peak resident memory of each worker process.')
+    for pid, value in sorted(data['max_rss'].items()):
+        out.append(f'app_process_max_rss_bytes{{pid="{pid}"}} {value}')
+    header('app_metrics_workers', 'gauge', 'Worker snapshots included in this scrape.')
+    out.append(f'app_metrics_workers {data["workers"]}')
+    return '\n'.join(out) + '\n'
+
+
+def summary_rows(data):
+    """Các dòng cho trang tóm tắt HTML, sắp theo tổng thời gian xử lý giảm dần."""
+    rows = []
+    for name, entry in data['endpoints'].items():
+        latency, count = entry['latency'], entry['latency'].count
+        rows.append({
+            'endpoint': name, 'count': count, 'total_s': latency.sum,
+            'avg_ms': latency.sum / count * 1000 if count else 0,
+            'p50_ms': (latency.quantile(0.5) or 0) * 1000, 'p95_ms': (latency.quantile(0.95) or 0) * 1000,
+            'avg_sql': entry['sql_per_request'].sum / count if count else 0, 'max_sql': entry['max_sql'],
+            'sql_ms': entry['sql_seconds'] / count * 1000 if count else 0,
+            'template_ms': entry['template_seconds'] / count * 1000 if count else 0,
+            'errors': sum(c for s, c in entry['status'].items() if s.startswith('5')), 'slow': entry['slow'],
+        })
+    return sorted(rows, key=lambda row: row['total_s'], reverse=True)
+
+
+def token_authorized():
+    """Cho phép Prometheus đọc /admin/metrics bằng header 'Authorization: Bearer <METRICS_TOKEN>'."""
+    token = current_app.config.get('METRICS_TOKEN')
+    supplied = request.headers.get('Authorization', '')
+    return bool(token) and supplied.startswith('Bearer ') and hmac.compare_digest(supplied[7:], token)
+
+
+@click.command('metrics-reset')
+def metrics_reset_command():
+    """Xóa các file số liệu của worker trong METRICS_DIR (bộ đếm về 0; Prometheus tự nhận biết reset)."""
+    paths = glob.glob(os.path.join(current_app.config['METRICS_DIR'], '*.json'))
+    for path in paths:
+        os.remove(path)
+    click.echo(f'Đã xóa {len(paths)} file số liệu.')
+
+
+def init_app(app):
+    global _slow, _enabled_dir
+    app.cli.add_command(metrics_reset_command)
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    _slow = deque(_slow, maxlen=app.config.get('SLOW_REQUEST_LOG_SIZE', 100))
+    os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+    if _enabled_dir is None:
+        atexit.register(_flush)
+    _enabled_dir = app.config['METRICS_DIR']
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    # Mở đầu trước và kết thúc sau mọi hook khác (after_request chạy theo thứ tự ngược) để đo cả thời gian của chúng
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+    app.after_request_funcs.setdefault(None, []).insert(0, _finish_request)
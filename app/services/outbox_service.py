@@ -0,0 +1,156 @@
+# app/services/outbox_service.py
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from sqlalchemy import event, select, update, func, or_, and_
+from .. import db
+from ..models import EmailOutbox
+from .email_service import deliver_email
+
+_wakeup = threading.Event()
+_started = False
+_start_lock = threading.Lock()
+
+
+def _backoff(attempts):
+    """Thời gian chờ trước lần thử tiếp theo: base * 2^(n-1), tối đa OUTBOX_BACKOFF_MAX giây."""
+    base = current_app.config.get('OUTBOX_BACKOFF_BASE', 30)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), current_app.config.get('OUTBOX_BACKOFF_MAX', 3600)))
+
+
+def claim_batch(limit):
+    """Nhận tối đa `limit` email đến hạn bằng UPDATE có điều kiện, để nhiều worker chạy song song không gửi trùng.
+
+    Email 'Sending' quá hạn giữ (worker chết giữa chừng) cũng được nhận lại.
+    """
+    now = datetime.utcnow()
+    due = or_(and_(EmailOutbox.status == 'Pending', EmailOutbox.next_attempt_at <= now),
+              and_(EmailOutbox.status == 'Sending', EmailOutbox.locked_until < now))
+    candidates = select(EmailOutbox.id).where(due).order_by(EmailOutbox.next_attempt_at) \
+        .limit(limit).with_for_update(skip_locked=True)
+    lease = now + timedelta(seconds=current_app.config.get('OUTBOX_LEASE_SECONDS', 300))
+    stmt = update(EmailOutbox).where(EmailOutbox.id.in_(candidates.scalar_subquery()), due) \
+        .values(status='Sending', locked_until=lease, attempts=EmailOutbox.attempts + 1)
+    columns = (EmailOutbox.id, EmailOutbox.to_email, EmailOutbox.subject, EmailOutbox.html_content, EmailOutbox.attempts)
+
+    if db.session.get_bind().dialect.update_returning:
+        rows = db.session.execute(stmt.returning(*columns), execution_options={'synchronize_session': False}).all()
+    else:
+        ids = db.session.execute(candidates).scalars().all()
+        db.session.execute(stmt.where(EmailOutbox.id.in_(ids)), execution_options={'synchronize_session': False})
+        rows = db.session.execute(select(*columns).where(EmailOutbox.id.in_(ids), EmailOutbox.locked_until == lease)).all()
+    db.session.commit()
+    return rows
+
+
+def _deliver(app, row):
+    with app.app_context():
+        try:
+            deliver_email(row.to_email, row.subject, row.html_content)
+            return None
+        except Exception as e:
+            return str(e) or e.__class__.__name__
+
+
+def dispatch_batch(limit=None):
+    """Gửi một lô email đến hạn bằng thread pool. Trả về (số đã gửi, số lỗi)."""
+    config = current_app.config
+    rows = claim_batch(limit or config.get('OUTBOX_BATCH_SIZE', 50))
+    if not rows:
+        return 0, 0
+
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(max_workers=config.get('OUTBOX_THREADS', 4)) as pool:
+        errors = list(pool.map(lambda row: _deliver(app, row), rows))
+
+    now, sent, failed = datetime.utcnow(), 0, 0
+    max_attempts = config.get('OUTBOX_MAX_ATTEMPTS', 6)
+    for row, error in zip(rows, errors):
+        if error is None:
+            values = dict(status='Sent', sent_at=now, locked_until=None, last_error=None)
+            sent += 1
+        elif row.attempts >= max_attempts:
+            values = dict(status='Dead', locked_until=None, last_error=error)
+            failed += 1
+        else:
+            values = dict(status='Pending', locked_until=None, last_error=error,
+                          next_attempt_at=now + _backoff(row.attempts))
+            failed += 1
+        db.session.execute(update(EmailOutbox).where(EmailOutbox.id == row.id).values(**values),
+                           execution_options={'synchronize_session': False})
+    db.session.commit()
+    return sent, failed
+
+
+def _run_forever(app):
+    interval = app.config.get('OUTBOX_POLL_INTERVAL', 10)
+    while True:
+        try:
+            with app.app_context():
+                sent, failed = dispatch_batch()
+        except Exception as e:
+            app.logger.exception(f"Lỗi bộ gửi email nền: {e}")
+            sent = failed = 0
+        if not sent and not failed:
+            _wakeup.wait(interval)
+            _wakeup.clear()
+
+
+def start_background_dispatcher(app):
+    """Khởi động thread gửi nền (một lần cho mỗi tiến trình worker)."""
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_run_forever, args=(app,), name='email-outbox', daemon=True).start()
+
+
+def _wake_after_commit(session):
+    if session.in_nested_transaction():
+        return # RELEASE SAVEPOINT, chưa phải commit thật
+    if session.info.pop('outbox_queued', False):
+        _wakeup.set()
+
+
+@click.command('outbox-dispatch')
+@click.option('--loop', is_flag=True, help='Chạy liên tục như một worker riêng.')
+def outbox_dispatch_command(loop):
+    """Gửi các email đang chờ trong email_outbox."""
+    if loop:
+        click.echo('Bộ gửi email đang chạy (Ctrl+C để dừng)...')
+        _run_forever(current_app._get_current_object())
+    total_sent = total_failed = 0
+    while True:
+        sent, failed = dispatch_batch()
+        total_sent, total_failed = total_sent + sent, total_failed + failed
+        if not sent and not failed:
+            break
+    click.echo(f'Đã gửi {total_sent} email, {total_failed} lỗi (sẽ thử lại hoặc chuyển Dead).')
+
+
+@click.command('outbox-status')
+@click.option('--requeue-dead', is_flag=True, help='Đưa các email Dead trở lại hàng đợi.')
+def outbox_status_command(requeue_dead):
+    """Thống kê hàng đợi email theo trạng thái."""
+    if requeue_dead:
+        result = db.session.execute(update(EmailOutbox).where(EmailOutbox.status == 'Dead')
+                                    .values(status='Pending', attempts=0, next_attempt_at=datetime.utcnow()))
+        db.session.commit()
+        click.echo(f'Đã đưa lại {result.rowcount} email vào hàng đợi.')
+    for status, count in db.session.execute(select(EmailOutbox.status, func.count()).group_by(EmailOutbox.status)):
+        click.echo(f'{status}: {count}')
+
+
+def init_app(app):
+    event.listen(db.session, 'after_commit', _wake_after_commit)
+    app.cli.add_command(outbox_dispatch_command)
+    app.cli.add_command(outbox_status_command)
+    if app.config.get('OUTBOX_BACKGROUND'):
+        @app.before_request
+        def ensure_dispatcher_running():
+            # Khởi động trễ tới request đầu tiên để thread nằm trong đúng tiến trình worker (sau fork của gunicorn)
+            start_background_dispatcher(app)
@@ -0,0 +1,118 @@
+# app/services/overdue_service.py
+
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+import click
+from flask import current_app
+from sqlalchemy import select, update, or_, and_
+from .. import db
+from ..models import BorrowList, User, CacheVersion
+from . import stats_service
+from .email_service import send_due_reminder_email, send_overdue_digest_email
+
+# Tên dòng trong cache_version ghi lại lần quét gần nhất (updated_at) để trang admin hiển thị
+SCAN_MARKER = 'overdue_scan'
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def _flag(ids, guard, stamp_column, now, **values):
+    """UPDATE có điều kiện `guard` cho các phiếu `ids`, ghi `now` vào `stamp_column`; trả về id các phiếu thực sự
+    được cập nhật. Nhiều tiến trình cùng quét thì mỗi phiếu chỉ được một tiến trình đánh dấu (và gửi email) một lần.
+    """
+    if not ids:
+        return set()
+    # Tăng version như mọi thay đổi của phiếu: form đang mở thành cũ, khóa cache PDF list-<id>-v<version> đổi
+    stmt = update(BorrowList).where(BorrowList.id.in_(ids), guard) \
+        .values({stamp_column: now, BorrowList.version: BorrowList.version + 1, **values})
+    if db.session.get_bind().dialect.update_returning:
+        return set(db.session.execute(stmt.returning(BorrowList.id),
+                                      execution_options={'synchronize_session': False}).scalars())
+    db.session.execute(stmt, execution_options={'synchronize_session': False})
+    return set(db.session.execute(select(BorrowList.id).where(BorrowList.id.in_(ids), stamp_column == now)).scalars())
+
+
+def scan(today=None):
+    """Đánh dấu phiếu mới quá hạn, tìm phiếu sắp đến hạn và xếp hàng email nhắc gộp theo từng sinh viên.
+
+    Một truy vấn dùng chỉ mục (status, returned_at, return_deadline) lấy cả hai nhóm; mỗi phiếu chỉ được
+    nhắc "sắp đến hạn" một lần và "quá hạn" một lần. Commit và trả về (số phiếu mới quá hạn, số phiếu sắp đến hạn).
+    """
+    today = today or date.today()
+    now = datetime.utcnow()
+    remind_until = today + timedelta(days=current_app.config.get('OVERDUE_REMIND_DAYS', 2))
+    rows = db.session.execute(
+        select(BorrowList.id, BorrowList.user_id, BorrowList.return_deadline, BorrowList.borrowed_at, BorrowList.item_count)
+        .where(BorrowList.status == 'Completed', BorrowList.returned_at.is_(None),
+               BorrowList.return_deadline <= remind_until,
+               or_(and_(BorrowList.return_deadline < today, BorrowList.overdue == False),
+                   and_(BorrowList.return_deadline >= today, BorrowList.due_soon_notified_at.is_(None))))
+        .order_by(BorrowList.return_deadline)).all()
+
+    overdue_ids = _flag([r.id for r in rows if r.return_deadline < today], BorrowList.overdue == False,
+                        BorrowList.overdue_at, now, overdue=True)
+    due_soon_ids = _flag([r.id for r in rows if r.return_deadline >= today], BorrowList.due_soon_notified_at.is_(None),
+                         BorrowList.due_soon_notified_at, now)
+
+    by_user = defaultdict(lambda: ([], []))
+    for row in rows:
+        if row.id in overdue_ids:
+            by_user[row.user_id][0].append(row)
+        elif row.id in due_soon_ids:
+            by_user[row.user_id][1].append(row)
+    users = {u.id: u for u in User.query.filter(User.id.in_(list(by_user)))} if by_user else {}
+    for user_id, (overdue_rows, due_soon_rows) in by_user.items():
+        send_due_reminder_email(users[user_id], overdue_rows, due_soon_rows, today)
+    if overdue_ids:
+        send_overdue_digest_email([(users[r.user_id], r) for r in rows if r.id in overdue_ids], today)
+        stats_service.bump_version(names=(stats_service.INVENTORY,)) # Số phiếu quá hạn trên dashboard đổi
+    stats_service.bump_version(names=(SCAN_MARKER,))
+    db.session.commit()
+    return len(overdue_ids), len(due_soon_ids)
+
+
+def last_scan_at():
+    return db.session.execute(select(CacheVersion.updated_at).where(CacheVersion.name == SCAN_MARKER)).scalar()
+
+
+def _run_forever(app):
+    interval = app.config.get('OVERDUE_SCAN_INTERVAL', 3600)
+    while True:
+        try:
+            with app.app_context():
+                scan()
+        except Exception as e:
+            app.logger.exception(f"Lỗi bộ quét quá hạn: {e}")
+        time.sleep(interval)
+
+
+def start_background_scanner(app):
+    """Khởi động thread quét định kỳ (một lần cho mỗi tiến trình worker; quét trùng giữa các worker vô hại)."""
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_run_forever, args=(app,), name='overdue-scanner', daemon=True).start()
+
+
+@click.command('overdue-scan')
+@click.option('--loop', is_flag=True, help='Chạy liên tục, mỗi OVERDUE_SCAN_INTERVAL giây một lần.')
+def overdue_scan_command(loop):
+    """Đánh dấu phiếu quá hạn và gửi email nhắc (dùng với cron hoặc như một worker riêng)."""
+    if loop:
+        click.echo('Bộ quét quá hạn đang chạy (Ctrl+C để dừng)...')
+        _run_forever(current_app._get_current_object())
+    overdue, due_soon = scan()
+    click.echo(f'{overdue} phiếu mới quá hạn, {due_soon} phiếu sắp đến hạn đã được nhắc.')
+
+
+def init_app(app):
+    app.cli.add_command(overdue_scan_command)
+    if app.config.get('OVERDUE_SCAN_BACKGROUND'):
+        @app.before_request
+        def ensure_scanner_running():
+            start_background_scanner(app)
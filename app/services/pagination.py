@@ -0,0 +1,114 @@
+# app/services/pagination.py
+
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import tuple_, DateTime, select, func
+from .. import db
+
+
+class KeysetPage:
+    """Một trang kết quả phân trang theo khóa (keyset), kèm con trỏ trang trước/sau."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(values):
+    """Mã hóa bộ giá trị khóa thành chuỗi an toàn cho URL."""
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Giải mã con trỏ. Trả về None nếu con trỏ không hợp lệ."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw.decode('utf-8'))
+        if not isinstance(values, list) or len(values) != len(columns):
+            return None
+        return [datetime.fromisoformat(v) if isinstance(col.type, DateTime) and v is not None else v
+                for v, col in zip(values, columns)]
+    except (ValueError, TypeError):
+        return None
+
+
+def keyset_paginate(query, columns, per_page, after=None, before=None, descending=False):
+    """Phân trang `query` theo bộ cột `columns` (cột cuối phải là khóa duy nhất, vd. id).
+
+    Thay cho OFFSET: mỗi trang chỉ là một lần quét chỉ mục từ vị trí con trỏ,
+    nên trang thứ N tốn chi phí như trang đầu tiên.
+    """
+    return keyset_paginate_chain([(query, columns)], per_page, after=after, before=before, descending=descending)
+
+
+def keyset_paginate_chain(sources, per_page, after=None, before=None, descending=False):
+    """Như keyset_paginate nhưng trên nhiều nguồn nối tiếp [(query, columns), ...], vd. bảng nóng rồi bảng lưu trữ.
+
+    Mọi dòng của nguồn trước phải đứng trước mọi dòng của nguồn sau theo thứ tự sắp xếp; nguồn sau
+    chỉ được truy vấn khi trang hiện tại chạy quá hết nguồn trước.
+    """
+    after_values = decode_cursor(after, sources[0][1])
+    before_values = decode_cursor(before, sources[0][1])
+    backwards = before_values is not None and after_values is None
+
+    rows = []
+    for query, columns in (reversed(sources) if backwards else sources):
+        key = tuple_(*columns)
+        if backwards:
+            query = query.filter(key > tuple_(*before_values) if descending else key < tuple_(*before_values))
+            order = [c.asc() if descending else c.desc() for c in columns]
+        else:
+            if after_values is not None:
+                query = query.filter(key < tuple_(*after_values) if descending else key > tuple_(*after_values))
+            order = [c.desc() if descending else c.asc() for c in columns]
+        rows += query.order_by(*order).limit(per_page + 1 - len(rows)).all()
+        if len(rows) > per_page:
+            break
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    keys = [c.key for c in sources[0][1]]
+
+    def cursor_of(row):
+        return encode_cursor([getattr(row, k) for k in keys])
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if backwards:
+            next_cursor = cursor_of(rows[-1])
+            prev_cursor = cursor_of(rows[0]) if has_more else None
+        else:
+            next_cursor = cursor_of(rows[-1]) if has_more else None
+            prev_cursor = cursor_of(rows[0]) if after_values is not None else None
+    return KeysetPage(rows, next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+
+# --- WATERMARK THEO ID CHO CÁC BẢNG CHỈ THÊM ---
+
+def lagged_upper_id(last_id, upper_at, *models):
+    """Mốc id trên: id lớn nhất, nhưng dừng ngay trước dòng đầu tiên (sau watermark) tạo từ `upper_at` trở đi.
+
+    id được cấp lúc INSERT chứ không phải lúc commit: giao dịch CSDL còn dở có thể commit một id nhỏ hơn id đã thấy,
+    nên lấy thẳng max(id) làm watermark sẽ bỏ sót dòng đó mãi mãi. Dòng tạo trước `upper_at` coi như đã commit.
+    """
+    newest = max(db.session.execute(select(func.max(m.id))).scalar() or 0 for m in models)
+    recent = [db.session.execute(select(func.min(m.id)).where(m.id > (last_id or 0), m.created_at >= upper_at)).scalar()
+              for m in models]
+    return min([newest] + [first - 1 for first in recent if first is not None])
@@ -0,0 +1,169 @@
+# app/services/pdf_service.py
+
+import glob
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from flask import current_app, render_template
+from sqlalchemy import select, or_, and_
+from sqlalchemy.orm import joinedload
+from .. import db
+from ..models import BorrowList, ListItem, Transaction
+
+# Danh sách có phiếu in: đã gửi trở đi (phiếu Pending còn đang sửa, Cancelled không cần in)
+PRINTABLE_STATUSES = ('Submitted', 'Ready', 'Completed')
+
+_pool = None
+_pool_lock = threading.Lock()
+_in_flight = {}   # cache key -> Future, để nhiều request cùng một phiếu chỉ render một lần
+
+
+class PdfPending(Exception):
+    """PDF đang được render trong process pool, chưa xong trong thời gian chờ."""
+
+
+class PdfFailed(Exception):
+    """Render PDF thất bại (lỗi WeasyPrint hoặc tiến trình con chết); chi tiết đã ghi log."""
+
+
+def _render_to_file(html, base_url, path):
+    """Chạy trong tiến trình con: WeasyPrint tốn CPU nên không chạy trong worker web.
+
+    Ghi ra file tạm rồi đổi tên để worker khác không đọc phải file dở.
+    """
+    from weasyprint import HTML
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    HTML(string=html, base_url=base_url).write_pdf(tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn thay vì fork: tiến trình web có thread nền (outbox, import), fork có thể kẹt khóa
+            _pool = ProcessPoolExecutor(max_workers=current_app.config.get('PDF_WORKERS', 2),
+                                        mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _discard_pool(pool):
+    """Bỏ pool đã hỏng (tiến trình con chết): pool hỏng không nhận việc nữa, lần sau tạo pool mới."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _cache_path(key):
+    directory = current_app.config['PDF_CACHE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f'{key}.pdf')
+
+
+def _remove_stale(prefix, keep):
+    """Xóa các bản cache cũ của cùng một phiếu (phiên bản trước)."""
+    for path in glob.glob(os.path.join(current_app.config['PDF_CACHE_DIR'], f'{prefix}*.pdf')):
+        if path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def render_cached(key, template, stale_prefix=None, **context):
+    """Trả về đường dẫn file PDF cho `key`, render bằng process pool nếu chưa có trong cache.
+
+    Jinja render ngay trong request (nhanh), chỉ phần HTML -> PDF chạy ở tiến trình con.
+    Chờ tối đa PDF_RENDER_WAIT giây; quá thời gian thì ném PdfPending, request sau sẽ lấy được từ cache.
+    """
+    path = _cache_path(key)
+    if os.path.exists(path):
+        return path
+    with _pool_lock:
+        future = _in_flight.get(key)
+    pool = _get_pool()
+    try:
+        if future is None:
+            html = render_template(template, **context)
+            # base_url = thư mục app để url(static/fonts/...) trong template trỏ tới font trên đĩa, không tải từ CDN
+            future = pool.submit(_render_to_file, html, current_app.root_path + os.sep, path)
+            with _pool_lock:
+                future = _in_flight.setdefault(key, future)
+            future.add_done_callback(lambda _: _in_flight.pop(key, None))
+        future.result(timeout=current_app.config.get('PDF_RENDER_WAIT', 10))
+    except FutureTimeout:
+        raise PdfPending(key)
+    except BrokenProcessPool as e:
+        current_app.logger.exception(f"Process pool PDF bị hỏng khi render {key}: {e}")
+        _discard_pool(pool)
+        raise PdfFailed(key) from e
+    except Exception as e:
+        current_app.logger.exception(f"Lỗi render PDF {key}: {e}")
+        raise PdfFailed(key) from e
+    if stale_prefix:
+        _remove_stale(stale_prefix, path)
+    return path
+
+
+def _items_by_list(list_ids):
+    """Món của nhiều phiếu trong một truy vấn (kèm thiết bị)."""
+    items = {list_id: [] for list_id in list_ids}
+    rows = db.session.execute(select(ListItem).options(joinedload(ListItem.device))
+                              .where(ListItem.list_id.in_(list_ids)).order_by(ListItem.id)).scalars()
+    for item in rows:
+        items[item.list_id].append(item)
+    return items
+
+
+def borrow_list_pdf(borrow_list):
+    """Phiếu mượn của một BorrowList. Khóa cache = id + version (version tăng ở mọi lần sửa phiếu,
+    kể cả đổi trạng thái và thêm/bớt món), nên phiếu đổi là có bản PDF mới."""
+    key = f'list-{borrow_list.id}-v{borrow_list.version}'
+    return render_cached(key, 'pdf_borrow_list_template.html', stale_prefix=f'list-{borrow_list.id}-v',
+                         lists=[borrow_list], items=_items_by_list([borrow_list.id]), generated_at=datetime.utcnow())
+
+
+def lists_for_day(day):
+    """Các phiếu cần in trong ngày: đã giao trong ngày, hoặc chưa giao và hẹn mượn vào ngày đó."""
+    start = datetime.combine(day, datetime.min.time())
+    return BorrowList.query.options(joinedload(BorrowList.user)).filter(
+        BorrowList.status.in_(PRINTABLE_STATUSES),
+        or_(and_(BorrowList.borrowed_at >= start, BorrowList.borrowed_at < start + timedelta(days=1)),
+            and_(BorrowList.borrowed_at.is_(None), BorrowList.expected_borrow_date == day)),
+    ).order_by(BorrowList.id).all()
+
+
+def daily_pdf(day, lists=None):
+    """Gộp mọi phiếu của một ngày thành một tài liệu (mỗi phiếu một trang) bằng một lần render.
+
+    Khóa cache gồm (id, version) của từng phiếu nên chỉ render lại khi có phiếu thay đổi. Trả về None nếu không có phiếu.
+    """
+    lists = lists_for_day(day) if lists is None else lists
+    if not lists:
+        return None
+    stamp = hashlib.sha1(','.join(f'{l.id}:{l.version}' for l in lists).encode()).hexdigest()[:16]
+    return render_cached(f'day-{day.isoformat()}-{stamp}', 'pdf_borrow_list_template.html',
+                         stale_prefix=f'day-{day.isoformat()}-', lists=lists,
+                         items=_items_by_list([l.id for l in lists]), generated_at=datetime.utcnow())
+
+
+def transaction_batch(transaction):
+    """Các giao dịch cùng một thao tác hàng loạt: cùng người, cùng loại, cùng thời điểm ghi."""
+    return Transaction.query.options(joinedload(Transaction.device)).filter_by(
+        user_id=transaction.user_id, transaction_type=transaction.transaction_type,
+        created_at=transaction.created_at).order_by(Transaction.id).all()
+
+
+def transaction_batch_pdf(transaction):
+    """Phiếu mượn/trả hàng loạt. Giao dịch không bao giờ bị sửa nên khóa = khoảng id của lô."""
+    transactions = transaction_batch(transaction)
+    key = f'batch-{transactions[0].id}-{transactions[-1].id}'
+    return render_cached(key, 'pdf_batch_template.html', transactions=transactions,
+                         type=transaction.transaction_type, user=transaction.user)
@@ -0,0 +1,307 @@
+# app/services/profiler_service.py
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import shutil
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from flask import g, request, has_request_context, current_app
+from flask_login import current_user
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Bật profile cho một request: thêm ?_profile=<token> hoặc header X-Profile: <token> (token ký bằng SECRET_KEY,
+# tạo ở trang admin); admin đã đăng nhập có thể dùng ?_profile=1. Chế độ: ?_profile_mode=sample / X-Profile-Mode.
+QUERY_FLAG, HEADER = '_profile', 'X-Profile'
+MODE_FLAG, MODE_HEADER = '_profile_mode', 'X-Profile-Mode'
+MODES = ('cprofile', 'sample')
+MAX_SQL_STATEMENTS = 2000
+FILES = {'cprofile': 'profile.prof', 'sample': 'stacks.txt', 'sql': 'sql.json', 'meta': 'meta.json'}
+
+# Chỉ một request được profile tại một thời điểm; `_active` cho hook SQL thoát ngay khi không profile
+_capture_lock = threading.Lock()
+_active = 0
+
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='request-profile')
+
+
+def make_token(user_id):
+    """Token cho phép profile request, hết hạn sau PROFILE_TOKEN_MAX_AGE giây."""
+    return _serializer().dumps({'u': user_id})
+
+
+def _authorized(value):
+    if value == '1':
+        return current_user.is_authenticated and current_user.is_admin
+    try:
+        _serializer().loads(value, max_age=current_app.config.get('PROFILE_TOKEN_MAX_AGE', 3600))
+        return True
+    except BadSignature:
+        return False
+
+
+class _Sampler:
+    """Lấy mẫu call stack của một thread mỗi `interval` giây; kết quả dạng 'collapsed stacks' (flamegraph.pl, speedscope)."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id, self.interval = thread_id, interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+# --- HOOK REQUEST ---
+
+def _start_profile():
+    value = request.args.get(QUERY_FLAG) or request.headers.get(HEADER)
+    if not value or not _authorized(value):
+        return
+    if not _capture_lock.acquire(blocking=False):
+        current_app.logger.info(f"Bỏ qua profile {request.path}: đang có request khác được profile")
+        return
+    global _active
+    _active += 1
+    mode = request.args.get(MODE_FLAG) or request.headers.get(MODE_HEADER) or 'cprofile'
+    mode = mode if mode in MODES else 'cprofile'
+    state = {'mode': mode, 'sql': [], 'started': time.perf_counter(), 'created_at': datetime.utcnow()}
+    if mode == 'sample':
+        state['sampler'] = _Sampler(threading.get_ident(), current_app.config.get('PROFILE_SAMPLE_INTERVAL_MS', 5) / 1000)
+        state['sampler'].start()
+    else:
+        state['profiler'] = cProfile.Profile()
+        state['profiler'].enable()
+    g.profile = state
+
+
+def _stop_profile(status_code):
+    """Dừng profile (nếu request này đang được profile), lưu kết quả và trả về id."""
+    global _active
+    state = g.pop('profile', None)
+    if state is None:
+        return None
+    try:
+        if 'profiler' in state:
+            state['profiler'].disable()
+        else:
+            state['sampler'].stop()
+        return _save(state, status_code, (time.perf_counter() - state['started']) * 1000)
+    finally:
+        _active -= 1
+        _capture_lock.release()
+
+
+def _finish_profile(response):
+    profile_id = _stop_profile(response.status_code)
+    if profile_id:
+        response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+def _teardown_profile(exc):
+    # Exception không được xử lý (after_request không chạy): vẫn dừng profile và lưu lại
+    if exc is not None and g.get('profile') is not None:
+        _stop_profile(500)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active and has_request_context() and g.get('profile') is not None:
+        conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not _active or not has_request_context():
+        return
+    state = g.get('profile')
+    starts = conn.info.get('profile_query_start')
+    if state is None or not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if len(state['sql']) < MAX_SQL_STATEMENTS:
+        state['sql'].append({'statement': statement, 'parameters': repr(parameters)[:500],
+                             'ms': round(elapsed * 1000, 3), 'executemany': executemany})
+
+
+# --- LƯU TRỮ ---
+
+def _profile_dir(profile_id=None):
+    root = current_app.config['PROFILE_DIR']
+    return os.path.join(root, profile_id) if profile_id else root
+
+
+def _save(state, status_code, duration_ms):
+    created_at = state['created_at']
+    profile_id = f"{created_at:%Y%m%d-%H%M%S-%f}-{os.getpid()}"
+    folder = _profile_dir(profile_id)
+    os.makedirs(folder, exist_ok=True)
+    if 'profiler' in state:
+        state['profiler'].dump_stats(os.path.join(folder, FILES['cprofile']))
+    else:
+        with open(os.path.join(folder, FILES['sample']), 'w', encoding='utf-8') as f:
+            f.writelines(f'{stack} {count}\n' for stack, count in state['sampler'].stacks.most_common())
+    with open(os.path.join(folder, FILES['sql']), 'w', encoding='utf-8') as f:
+        json.dump(state['sql'], f, ensure_ascii=False)
+    # Không lưu token vào đường dẫn (token còn dùng được đến khi hết hạn)
+    query = '&'.join(f'{k}={v}' for k, v in request.args.items(multi=True) if k != QUERY_FLAG)
+    meta = {'id': profile_id, 'mode': state['mode'], 'method': request.method, 'path': request.path + (f'?{query}' if query else ''),
+            'endpoint': request.endpoint, 'status': status_code, 'duration_ms': round(duration_ms, 1),
+            'sql_count': len(state['sql']), 'sql_ms': round(sum(q['ms'] for q in state['sql']), 1),
+            'created_at': created_at.isoformat(timespec='seconds'),
+            'user': current_user.username if current_user.is_authenticated else None}
+    # meta.json ghi sau cùng: thư mục chưa có meta là bản đang ghi dở, list_profiles bỏ qua
+    with open(os.path.join(folder, FILES['meta']), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    _prune(current_app.config.get('PROFILE_KEEP', 50))
+    current_app.logger.info(f"Đã lưu profile {profile_id} cho {meta['method']} {meta['path']} ({meta['duration_ms']}ms)")
+    return profile_id
+
+
+def _prune(keep):
+    for profile in list_profiles()[keep:]:
+        shutil.rmtree(_profile_dir(profile['id']), ignore_errors=True)
+
+
+def list_profiles():
+    """Các profile đã lưu, mới nhất trước."""
+    root = _profile_dir()
+    profiles = []
+    for name in sorted(os.listdir(root), reverse=True) if os.path.isdir(root) else []:
+        try:
+            with open(os.path.join(root, name, FILES['meta']), encoding='utf-8') as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+
+def load(profile_id):
+    """(meta, danh sách SQL) của một profile; None nếu không tồn tại."""
+    folder = _profile_dir(os.path.basename(profile_id))
+    try:
+        with open(os.path.join(folder, FILES['meta']), encoding='utf-8') as f:
+            meta = json.load(f)
+        with open(os.path.join(folder, FILES['sql']), encoding='utf-8') as f:
+            return meta, json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def file_path(profile_id, kind):
+    return os.path.join(_profile_dir(os.path.basename(profile_id)), FILES[kind])
+
+
+def stats_text(profile_id, limit=60):
+    """Bảng pstats (sắp theo thời gian tích lũy) của một profile cProfile."""
+    out = io.StringIO()
+    stats = pstats.Stats(file_path(profile_id, 'cprofile'), stream=out)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+def collapsed_stacks(profile_id):
+    """Call stack dạng collapsed ('a;b;c số_mẫu'). Với cProfile thì dựng gần đúng từ đồ thị caller/callee."""
+    meta, _ = load(profile_id)
+    if meta['mode'] == 'sample':
+        stacks = Counter()
+        with open(file_path(profile_id, 'sample'), encoding='utf-8') as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                stacks[stack] += int(count)
+        return stacks
+    return _stacks_from_pstats(pstats.Stats(file_path(profile_id, 'cprofile')))
+
+
+def _stacks_from_pstats(stats, max_depth=40):
+    """Phân bổ thời gian riêng (tottime, micro giây) của mỗi hàm xuống các nhánh gọi theo tỉ lệ thời gian tích lũy.
+
+    cProfile chỉ lưu cặp caller -> callee nên flame graph này là gần đúng (hàm được gọi từ nhiều nơi bị chia theo tỉ lệ).
+    """
+    def label(func):
+        filename, line, name = func
+        return f'{name} ({os.path.basename(filename)}:{line})'
+
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (_, _, _, cumtime) in callers.items():
+            callees.setdefault(caller, []).append((func, cumtime))
+    roots = [func for func, (_, _, _, _, callers) in stats.stats.items() if not callers]
+    stacks = Counter()
+
+    def walk(func, path, share, depth):
+        _, _, tottime, cumtime, _ = stats.stats[func]
+        path = path + [label(func)]
+        own = int(tottime * share * 1e6)
+        if own:
+            stacks[';'.join(path)] += own
+        if depth >= max_depth or cumtime * share < 1e-5: # Nhánh dưới 10 micro giây không đáng vẽ
+            return
+        for callee, callee_cum in callees.get(func, ()):
+            if callee not in stats.stats or label(callee) in path:
+                continue # Bỏ đệ quy để không lặp vô hạn
+            walk(callee, path, share * callee_cum / stats.stats[callee][3] if stats.stats[callee][3] else 0, depth + 1)
+
+    for root in roots:
+        walk(root, [], 1.0, 0)
+    return stacks
+
+
+def flame_rows(stacks, min_fraction=0.002):
+    """Các ô của flame graph (depth, left %, width %, name, samples) dựng từ collapsed stacks; bỏ ô quá hẹp."""
+    tree = {'children': {}, 'value': 0}
+    for stack, count in stacks.items():
+        node = tree
+        node['value'] += count
+        for name in stack.split(';'):
+            node = node['children'].setdefault(name, {'children': {}, 'value': 0})
+            node['value'] += count
+    total = tree['value'] or 1
+    rows = []
+
+    def walk(node, depth, left):
+        for name, child in sorted(node['children'].items(), key=lambda item: -item[1]['value']):
+            width = child['value'] / total
+            if width >= min_fraction:
+                rows.append({'depth': depth, 'left': left * 100, 'width': width * 100, 'name': name, 'samples': child['value']})
+                walk(child, depth + 1, left)
+            left += width
+
+    walk(tree, 0, 0.0)
+    return rows
+
+
+def init_app(app):
+    if not app.config.get('PROFILER_ENABLED', True):
+        return
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    # Bắt đầu trước và dừng sau mọi hook khác; khi không bật chỉ tốn một lần tra query string/header
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_profile)
+    app.after_request_funcs.setdefault(None, []).insert(0, _finish_profile)
+    app.teardown_request(_teardown_profile)
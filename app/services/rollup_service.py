@@ -0,0 +1,216 @@
+# app/services/rollup_service.py
+
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from sqlalchemy import select, union_all, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from .. import db
+from ..models import Transaction, TransactionArchive, BorrowList, ListItem, Device, DailyRollup, RollupState
+from . import stats_service
+from .pagination import lagged_upper_id
+
+# Bộ đếm phiên bản (cache_version) để cache của dashboard đổi khi rollup được cập nhật
+ROLLUP = 'rollup'
+# Ngày tính theo giờ Việt Nam, giống filter localtime (format_to_local_time)
+LOCAL_OFFSET = timedelta(hours=7)
+UNKNOWN = 'N/A'
+CHUNK_SIZE = 5000
+METRICS = ('borrows', 'returns', 'reservations', 'overdue', 'lead_time_seconds', 'lead_time_count')
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def _local_day(value):
+    return (value + LOCAL_OFFSET).date()
+
+
+def _key(value, category, location):
+    return _local_day(value), category or UNKNOWN, location or UNKNOWN
+
+
+def _stream(stmt):
+    result = db.session.execute(stmt.execution_options(yield_per=CHUNK_SIZE))
+    for rows in result.partitions():
+        yield from rows
+
+
+# --- CÁC NGUỒN ---
+# Mỗi nguồn nhận (watermark cũ, mốc trên) và cộng số liệu vào `deltas`; nguồn theo id dùng mốc id có độ trễ,
+# nguồn theo thời điểm dùng mốc thời gian (cả hai trừ ROLLUP_LAG_SECONDS để chờ các giao dịch CSDL đang dở commit).
+
+def _transactions(last_id, upper_id, deltas):
+    """Mượn/Trả: đọc cả bảng nóng và bảng lưu trữ (giữ nguyên id) theo khoảng id."""
+    def part(model):
+        return select(model.created_at, model.transaction_type, Device.category, Device.location) \
+            .outerjoin(Device, model.device_id == Device.id) \
+            .where(model.id > (last_id or 0), model.id <= upper_id, model.created_at.isnot(None))
+    for created_at, transaction_type, category, location in _stream(union_all(part(Transaction), part(TransactionArchive))):
+        deltas[_key(created_at, category, location)]['borrows' if transaction_type == 'Mượn' else 'returns'] += 1
+
+
+def _reservations(last_id, upper_id, deltas):
+    """Thiết bị được đưa vào giỏ (ListItem mới). Dữ liệu cũ chưa có created_at thì lấy ngày tạo phiếu."""
+    stmt = select(func.coalesce(ListItem.created_at, BorrowList.created_at), Device.category, Device.location) \
+        .join(BorrowList, ListItem.list_id == BorrowList.id).outerjoin(Device, ListItem.device_id == Device.id) \
+        .where(ListItem.id > (last_id or 0), ListItem.id <= upper_id)
+    for created_at, category, location in _stream(stmt):
+        if created_at is not None:
+            deltas[_key(created_at, category, location)]['reservations'] += 1
+
+
+def _list_items_between(column, last_at, upper_at):
+    stmt = select(column, BorrowList.created_at, Device.category, Device.location) \
+        .select_from(ListItem).join(BorrowList, ListItem.list_id == BorrowList.id) \
+        .outerjoin(Device, ListItem.device_id == Device.id).where(column <= upper_at)
+    return _stream(stmt.where(column > last_at) if last_at else stmt.where(column.isnot(None)))
+
+
+def _deliveries(last_at, upper_at, deltas):
+    """Thời gian chờ từ lúc tạo phiếu đến lúc nhận đồ, tính cho từng thiết bị trong phiếu, theo ngày nhận."""
+    for borrowed_at, created_at, category, location in _list_items_between(BorrowList.borrowed_at, last_at, upper_at):
+        if created_at is not None:
+            entry = deltas[_key(borrowed_at, category, location)]
+            entry['lead_time_seconds'] += max((borrowed_at - created_at).total_seconds(), 0)
+            entry['lead_time_count'] += 1
+
+
+def _overdue(last_at, upper_at, deltas):
+    """Thiết bị thuộc các phiếu bị bộ quét quá hạn đánh dấu, theo ngày đánh dấu."""
+    for overdue_at, _, category, location in _list_items_between(BorrowList.overdue_at, last_at, upper_at):
+        deltas[_key(overdue_at, category, location)]['overdue'] += 1
+
+
+# (tên nguồn, hàm, hàm lấy mốc trên theo id từ (watermark, mốc thời gian); None = nguồn theo thời điểm)
+SOURCES = (
+    ('transaction', _transactions, lambda last_id, upper_at: lagged_upper_id(last_id, upper_at, Transaction, TransactionArchive)),
+    ('list_item', _reservations, lambda last_id, upper_at: lagged_upper_id(last_id, upper_at, ListItem)),
+    ('delivery', _deliveries, None),
+    ('overdue', _overdue, None),
+)
+
+
+def _apply(deltas):
+    """Cộng `deltas` vào daily_rollup: một SELECT cho các ngày bị ảnh hưởng, rồi sửa/thêm dòng."""
+    days = {key[0] for key in deltas}
+    existing = {(r.day, r.category, r.location): r
+                for r in DailyRollup.query.filter(DailyRollup.day.in_(days))} if days else {}
+    for key, values in deltas.items():
+        row = existing.get(key)
+        if row is None:
+            row = DailyRollup(day=key[0], category=key[1], location=key[2], **{m: 0 for m in METRICS})
+            db.session.add(row)
+        for metric, amount in values.items():
+            setattr(row, metric, getattr(row, metric) + amount)
+
+
+def update_rollups():
+    """Cập nhật rollup từ các dòng mới kể từ watermark của từng nguồn, trong MỘT giao dịch CSDL (số liệu và
+    watermark cùng commit). Tiến trình khác vừa cập nhật trước thì bỏ lượt này. Trả về số ô (ngày x danh mục x vị trí) đã đổi.
+    """
+    now = datetime.utcnow()
+    upper_at = now - timedelta(seconds=current_app.config.get('ROLLUP_LAG_SECONDS', 60))
+    states = {s.name: s for s in RollupState.query}
+    deltas = defaultdict(lambda: defaultdict(float))
+    for name, collect, upper_id_of in SOURCES:
+        state = states.get(name) or RollupState(name=name)
+        if name not in states:
+            db.session.add(state)
+        if upper_id_of is not None:
+            upper_id = upper_id_of(state.last_id, upper_at)
+            if upper_id > (state.last_id or 0):
+                collect(state.last_id, upper_id, deltas)
+                state.last_id = upper_id
+        elif state.last_at is None or upper_at > state.last_at:
+            collect(state.last_at, upper_at, deltas)
+            state.last_at = upper_at
+        state.updated_at = now
+    _apply({key: {m: (v if m == 'lead_time_seconds' else int(v)) for m, v in values.items()}
+            for key, values in deltas.items()})
+    if deltas:
+        stats_service.bump_version(names=(ROLLUP,))
+    try:
+        db.session.commit()
+    except (StaleDataError, IntegrityError):
+        db.session.rollback() # Watermark đã bị tiến trình khác đẩy lên (hoặc tạo trước): phần này đã được cộng ở đó
+        return 0
+    return len(deltas)
+
+
+def last_updated_at():
+    return db.session.execute(select(func.max(RollupState.updated_at))).scalar()
+
+
+def trends(days=30, category=None):
+    """Chuỗi số liệu theo ngày và tổng theo danh mục cho biểu đồ dashboard, đọc từ daily_rollup (bảng nhỏ)."""
+    def compute():
+        start = _local_day(datetime.utcnow()) - timedelta(days=days - 1)
+        sums = [func.sum(getattr(DailyRollup, m)) for m in METRICS]
+        stmt = select(DailyRollup.day, *sums).where(DailyRollup.day >= start).group_by(DailyRollup.day)
+        if category:
+            stmt = stmt.where(DailyRollup.category == category)
+        by_day = {row[0]: row[1:] for row in db.session.execute(stmt)}
+        labels = [start + timedelta(days=i) for i in range(days)]
+        series = {m: [float(by_day[d][i] or 0) if d in by_day else 0 for d in labels] for i, m in enumerate(METRICS)}
+
+        by_category = db.session.execute(
+            select(DailyRollup.category, *sums).where(DailyRollup.day >= start)
+            .group_by(DailyRollup.category).order_by(func.sum(DailyRollup.borrows).desc())).all()
+        return {
+            'labels': [d.strftime('%d-%m') for d in labels],
+            'borrows': series['borrows'], 'returns': series['returns'],
+            'reservations': series['reservations'], 'overdue': series['overdue'],
+            'categories': [row[0] for row in by_category],
+            'category_borrows': [int(row[1] or 0) for row in by_category],
+            # Thời gian chờ trung bình (giờ) theo danh mục
+            'category_lead_hours': [round(row[5] / row[6] / 3600, 1) if row[6] else 0 for row in by_category],
+        }
+    return stats_service.cached(f'trends:{days}:{category}', compute, name=ROLLUP)
+
+
+def _run_forever(app):
+    interval = app.config.get('ROLLUP_INTERVAL', 900)
+    while True:
+        try:
+            with app.app_context():
+                update_rollups()
+        except Exception as e:
+            app.logger.exception(f"Lỗi cập nhật rollup: {e}")
+        time.sleep(interval)
+
+
+def start_background_updater(app):
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_run_forever, args=(app,), name='rollup-updater', daemon=True).start()
+
+
+@click.command('rollup-update')
+@click.option('--loop', is_flag=True, help='Chạy liên tục, mỗi ROLLUP_INTERVAL giây một lần.')
+@click.option('--rebuild', is_flag=True, help='Xóa rollup và watermark rồi tính lại từ đầu.')
+def rollup_update_command(loop, rebuild):
+    """Cập nhật bảng daily_rollup từ các giao dịch/phiếu mượn mới (dùng với cron hoặc như một worker riêng)."""
+    if rebuild:
+        DailyRollup.query.delete()
+        RollupState.query.delete()
+        db.session.commit()
+    if loop:
+        click.echo('Bộ cập nhật rollup đang chạy (Ctrl+C để dừng)...')
+        _run_forever(current_app._get_current_object())
+    click.echo(f'Đã cập nhật {update_rollups()} ô số liệu theo ngày.')
+
+
+def init_app(app):
+    app.cli.add_command(rollup_update_command)
+    if app.config.get('ROLLUP_BACKGROUND'):
+        @app.before_request
+        def ensure_rollup_updater_running():
+            start_background_updater(app)
@@ -0,0 +1,293 @@
+# app/services/schema_service.py
+
+from datetime import date, datetime, timedelta
+import click
+from sqlalchemy import text, MetaData, Table, Column, Index, ForeignKey, Integer, String, Text, DateTime, Date, Float
+from .. import db
+from ..models import Device, Transaction, BorrowList, ListItem, TransactionArchive, DailyRollup
+from . import stats_service
+
+# --- MIGRATION CÓ ĐÁNH SỐ PHIÊN BẢN ---
+# Mỗi migration là (phiên bản, mô tả, danh sách bước). Một bước là câu SQL dùng cú pháp
+# chung cho SQLite và PostgreSQL, hoặc một hàm nhận kết nối (vd. create_table() tạo bảng mới bằng
+# DDL của SQLAlchemy để kiểu cột/khóa tự tăng đúng với từng CSDL).
+# KHÔNG sửa migration đã phát hành, hãy thêm bản mới.
+# Migration mô tả CSDL đúng như lúc được viết: KHÔNG tham chiếu model hiện tại, vì model đổi về sau
+# sẽ làm migration cũ chạy khác đi (vd. tạo sẵn cột mà migration sau mới ALTER thêm).
+
+
+def create_table(name, *columns):
+    """Bước migration tạo bảng `name` từ định nghĩa cột/chỉ mục chép cứng trong migration."""
+    metadata = MetaData()
+    # Bảng mà khóa ngoại trỏ tới: chỉ khai báo cột id để dựng DDL, không bao giờ được tạo ở đây
+    Table('user', metadata, Column('id', Integer, primary_key=True))
+    Table('device', metadata, Column('id', Integer, primary_key=True))
+    table = Table(name, metadata, *columns)
+    return lambda conn: table.create(conn, checkfirst=True)
+
+
+MIGRATIONS = [
+    (1, 'Chỉ mục cho các truy vấn nóng', [
+        'CREATE INDEX IF NOT EXISTS ix_device_name_id ON device (name, id)',
+        'CREATE INDEX IF NOT EXISTS ix_device_category_name_id ON device (category, name, id)',
+        'CREATE INDEX IF NOT EXISTS ix_device_status ON device (status)',
+        'CREATE INDEX IF NOT EXISTS ix_transaction_device_created ON "transaction" (device_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS ix_transaction_user_created ON "transaction" (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS ix_transaction_created_at ON "transaction" (created_at)',
+        'CREATE INDEX IF NOT EXISTS ix_borrow_list_user_status ON borrow_list (user_id, status)',
+        'CREATE INDEX IF NOT EXISTS ix_borrow_list_status_returned_deadline ON borrow_list (status, returned_at, return_deadline)',
+        'CREATE INDEX IF NOT EXISTS ix_list_item_list_id ON list_item (list_id)',
+        'CREATE INDEX IF NOT EXISTS ix_list_item_device_id ON list_item (device_id)',
+    ]),
+    (2, 'Bảng cache_version cho cache thống kê', [
+        'CREATE TABLE IF NOT EXISTS cache_version (name VARCHAR(50) PRIMARY KEY, version INTEGER NOT NULL, updated_at TIMESTAMP)',
+    ]),
+    (3, 'Bộ đếm borrow_list.item_count', [
+        'ALTER TABLE borrow_list ADD COLUMN item_count INTEGER NOT NULL DEFAULT 0',
+        'UPDATE borrow_list SET item_count = (SELECT COUNT(*) FROM list_item WHERE list_item.list_id = borrow_list.id)',
+    ]),
+    (4, 'Cột version cho khóa lạc quan', [
+        'ALTER TABLE device ADD COLUMN version INTEGER NOT NULL DEFAULT 1',
+        'ALTER TABLE borrow_list ADD COLUMN version INTEGER NOT NULL DEFAULT 1',
+    ]),
+    (5, 'Bảng email_outbox', [
+        create_table('email_outbox',
+                     Column('id', Integer, primary_key=True),
+                     Column('to_email', String(120), nullable=False),
+                     Column('subject', String(255), nullable=False),
+                     Column('html_content', Text, nullable=False),
+                     Column('dedup_key', String(120), unique=True, nullable=True),
+                     Column('status', String(20), nullable=False),
+                     Column('attempts', Integer, nullable=False),
+                     Column('next_attempt_at', DateTime, nullable=False),
+                     Column('locked_until', DateTime, nullable=True),
+                     Column('last_error', Text),
+                     Column('created_at', DateTime),
+                     Column('sent_at', DateTime, nullable=True),
+                     Index('ix_email_outbox_status_next_attempt', 'status', 'next_attempt_at')),
+    ]),
+    (6, 'Bảng import_job', [
+        create_table('import_job',
+                     Column('id', Integer, primary_key=True),
+                     Column('filename', String(255), nullable=False),
+                     Column('stored_path', String(500), nullable=False),
+                     Column('status', String(20), nullable=False),
+                     Column('created_by_id', Integer, ForeignKey('user.id'), nullable=False),
+                     Column('total_rows', Integer, nullable=True),
+                     Column('rows_processed', Integer, nullable=False),
+                     Column('added_count', Integer, nullable=False),
+                     Column('duplicate_count', Integer, nullable=False),
+                     Column('invalid_count', Integer, nullable=False),
+                     Column('result_json', Text),
+                     Column('error', Text),
+                     Column('locked_until', DateTime, nullable=True),
+                     Column('created_at', DateTime),
+                     Column('started_at', DateTime, nullable=True),
+                     Column('finished_at', DateTime, nullable=True),
+                     Index('ix_import_job_status_created', 'status', 'created_at')),
+    ]),
+    (7, 'Bảng image_asset (ảnh lưu theo mã băm, đếm tham chiếu)', [
+        create_table('image_asset',
+                     Column('id', Integer, primary_key=True),
+                     Column('content_hash', String(64), unique=True, nullable=False),
+                     Column('refcount', Integer, nullable=False),
+                     Column('width', Integer),
+                     Column('height', Integer),
+                     Column('created_at', DateTime)),
+    ]),
+    (8, 'Cờ quá hạn tính sẵn cho borrow_list', [
+        'ALTER TABLE borrow_list ADD COLUMN overdue BOOLEAN NOT NULL DEFAULT false',
+        'ALTER TABLE borrow_list ADD COLUMN overdue_at TIMESTAMP',
+        'ALTER TABLE borrow_list ADD COLUMN due_soon_notified_at TIMESTAMP',
+        # is_overdue đọc cờ này: đánh dấu sẵn các phiếu đã quá hạn (không gửi lại email nhắc cho chúng)
+        "UPDATE borrow_list SET overdue = true, overdue_at = CURRENT_TIMESTAMP "
+        "WHERE status = 'Completed' AND returned_at IS NULL AND return_deadline < CURRENT_DATE",
+    ]),
+    (9, 'Chỉ mục (…, created_at, id) cho phân trang keyset lịch sử giao dịch', [
+        'CREATE INDEX IF NOT EXISTS ix_transaction_device_created_id ON "transaction" (device_id, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_transaction_user_created_id ON "transaction" (user_id, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_transaction_created_id ON "transaction" (created_at, id)',
+        'DROP INDEX IF EXISTS ix_transaction_device_created',
+        'DROP INDEX IF EXISTS ix_transaction_user_created',
+        'DROP INDEX IF EXISTS ix_transaction_created_at',
+    ]),
+    (10, 'Bảng transaction_archive và device_history_summary (lưu trữ giao dịch cũ, số lần/người mượn gần nhất)', [
+        create_table('transaction_archive',
+                     Column('id', Integer, primary_key=True, autoincrement=False),
+                     Column('device_id', Integer, ForeignKey('device.id'), nullable=False),
+                     Column('user_id', Integer, ForeignKey('user.id'), nullable=False),
+                     Column('transaction_type', String(20), nullable=False),
+                     Column('notes', Text),
+                     Column('created_at', DateTime),
+                     Index('ix_transaction_archive_device_created_id', 'device_id', 'created_at', 'id'),
+                     Index('ix_transaction_archive_user_created_id', 'user_id', 'created_at', 'id'),
+                     Index('ix_transaction_archive_created_id', 'created_at', 'id')),
+        create_table('device_history_summary',
+                     Column('device_id', Integer, ForeignKey('device.id'), primary_key=True),
+                     Column('archived_count', Integer, nullable=False),
+                     Column('archived_borrow_count', Integer, nullable=False),
+                     Column('borrow_count', Integer, nullable=False, server_default='0'),
+                     Column('last_borrower_id', Integer, ForeignKey('user.id'), nullable=True),
+                     Column('last_borrowed_at', DateTime, nullable=True),
+                     Column('archived_until', DateTime, nullable=True)),
+        # Chưa có gì được lưu trữ: tóm tắt chỉ cần đếm các giao dịch Mượn đang có
+        'INSERT INTO device_history_summary (device_id, archived_count, archived_borrow_count, borrow_count) '
+        'SELECT device_id, 0, 0, COUNT(*) FROM "transaction" WHERE transaction_type = \'Mượn\' GROUP BY device_id',
+        'UPDATE device_history_summary SET '
+        'last_borrower_id = (SELECT t.user_id FROM "transaction" t WHERE t.device_id = device_history_summary.device_id '
+        'AND t.transaction_type = \'Mượn\' ORDER BY t.created_at DESC, t.id DESC LIMIT 1), '
+        'last_borrowed_at = (SELECT MAX(t.created_at) FROM "transaction" t WHERE t.device_id = device_history_summary.device_id '
+        'AND t.transaction_type = \'Mượn\')',
+    ]),
+    (11, 'Bảng daily_rollup/rollup_state và list_item.created_at cho số liệu theo ngày', [
+        'ALTER TABLE list_item ADD COLUMN created_at TIMESTAMP',
+        'CREATE INDEX IF NOT EXISTS ix_borrow_list_borrowed_at ON borrow_list (borrowed_at)',
+        'CREATE INDEX IF NOT EXISTS ix_borrow_list_overdue_at ON borrow_list (overdue_at)',
+        create_table('daily_rollup',
+                     Column('day', Date, primary_key=True),
+                     Column('category', String(50), primary_key=True),
+                     Column('location', String(100), primary_key=True),
+                     Column('borrows', Integer, nullable=False),
+                     Column('returns', Integer, nullable=False),
+                     Column('reservations', Integer, nullable=False),
+                     Column('overdue', Integer, nullable=False),
+                     Column('lead_time_seconds', Float, nullable=False),
+                     Column('lead_time_count', Integer, nullable=False)),
+        create_table('rollup_state',
+                     Column('name', String(50), primary_key=True),
+                     Column('last_id', Integer, nullable=True),
+                     Column('last_at', DateTime, nullable=True),
+                     Column('updated_at', DateTime, nullable=True),
+                     Column('version', Integer, nullable=False)),
+    ]),
+]
+
+VERSION_TABLE = 'schema_version'
+
+
+def head_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def _ensure_version_table(conn):
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} ("
+                      f"version INTEGER PRIMARY KEY, description VARCHAR(200), applied_at TIMESTAMP)"))
+
+
+def current_version(conn):
+    _ensure_version_table(conn)
+    return conn.execute(text(f"SELECT COALESCE(MAX(version), 0) FROM {VERSION_TABLE}")).scalar()
+
+
+def _record(conn, version, description):
+    conn.execute(text(f"INSERT INTO {VERSION_TABLE} (version, description, applied_at) VALUES (:v, :d, :t)"),
+                 {'v': version, 'd': description, 't': datetime.utcnow()})
+
+
+def upgrade():
+    """Áp dụng các migration chưa chạy, mỗi migration trong một giao dịch riêng. Trả về danh sách phiên bản đã áp dụng."""
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        with db.engine.begin() as conn:
+            if version <= current_version(conn):
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(text(statement))
+            _record(conn, version, description)
+        applied.append(version)
+    return applied
+
+
+def stamp_head():
+    """Đánh dấu CSDL vừa tạo bằng db.create_all() là đã ở phiên bản mới nhất."""
+    with db.engine.begin() as conn:
+        done = current_version(conn)
+        for version, description, _ in MIGRATIONS:
+            if version > done:
+                _record(conn, version, description)
+
+
+# --- KIỂM TRA KẾ HOẠCH TRUY VẤN (EXPLAIN) ---
+
+def hot_queries():
+    """Truy vấn chính của từng route nóng (query ORM hoặc câu SELECT), dựng giống hệt trong code route."""
+    today = date.today()
+    return {
+        'device.devices (danh mục)': Device.query.order_by(Device.name, Device.id).limit(50),
+        'device.devices (tab danh mục)': Device.query.filter_by(category='Dụng cụ').order_by(Device.name, Device.id).limit(50),
+        'device.device_detail (lịch sử)': Transaction.query.filter_by(device_id=1)
+            .order_by(Transaction.created_at.desc(), Transaction.id.desc()).limit(21),
+        'admin.user_detail (lịch sử)': Transaction.query.filter_by(user_id=1)
+            .order_by(Transaction.created_at.desc(), Transaction.id.desc()).limit(21),
+        'admin.transactions': Transaction.query.order_by(Transaction.created_at.desc(), Transaction.id.desc()).limit(21),
+        'lịch sử lưu trữ (thiết bị)': TransactionArchive.query.filter_by(device_id=1)
+            .order_by(TransactionArchive.created_at.desc(), TransactionArchive.id.desc()).limit(21),
+        'main.index (giao dịch gần đây)': Transaction.query.order_by(Transaction.created_at.desc()).limit(20),
+        'main.index (thống kê trạng thái)': stats_service.device_status_counts_select(),
+        'giỏ hàng (context processor)': BorrowList.query.filter_by(user_id=1, status='Pending'),
+        'admin.requests_list': BorrowList.query.filter_by(status='Submitted').order_by(BorrowList.created_at.asc()),
+        'admin.overdue_list': BorrowList.query.filter(BorrowList.status == 'Completed', BorrowList.returned_at == None,
+                                                      BorrowList.overdue == True),
+        'bộ quét quá hạn': BorrowList.query.filter(BorrowList.status == 'Completed', BorrowList.returned_at == None,
+                                                   BorrowList.return_deadline < today + timedelta(days=3)),
+        'số món trong phiếu': ListItem.query.filter_by(list_id=1),
+        'rollup (phiếu nhận đồ mới)': BorrowList.query.filter(BorrowList.borrowed_at > datetime(2000, 1, 1)),
+        'rollup (phiếu mới quá hạn)': BorrowList.query.filter(BorrowList.overdue_at > datetime(2000, 1, 1)),
+        'rollup (đặt mượn mới)': ListItem.query.filter(ListItem.id > 1),
+        'admin.dashboard (biểu đồ)': DailyRollup.query.filter(DailyRollup.day >= today),
+    }
+
+
+def explain(conn, query):
+    """Trả về (các dòng kế hoạch, có dùng chỉ mục hay không) cho một query ORM hoặc câu SELECT Core."""
+    compiled = getattr(query, 'statement', query).compile(dialect=conn.dialect)
+    params = compiled.construct_params()
+    if conn.dialect.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    if conn.dialect.name == 'sqlite':
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).all()
+        plan = [row[-1] for row in rows]
+        uses_index = any('USING INDEX' in p or 'USING COVERING INDEX' in p or 'USING INTEGER PRIMARY KEY' in p for p in plan)
+    else:
+        # Bảng nhỏ thì PostgreSQL thích Seq Scan; tắt nó để kiểm tra chỉ mục CÓ dùng được không
+        conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        rows = conn.exec_driver_sql(f"EXPLAIN {compiled}", params).all()
+        plan = [row[0] for row in rows]
+        uses_index = any('Index' in p for p in plan)
+    return plan, uses_index
+
+
+@click.command('db-upgrade')
+def db_upgrade_command():
+    """Áp dụng các migration còn thiếu."""
+    applied = upgrade()
+    if applied:
+        click.echo(f"Đã áp dụng migration: {', '.join(map(str, applied))}.")
+    else:
+        click.echo(f"CSDL đã ở phiên bản mới nhất ({head_version()}).")
+
+
+@click.command('check-indexes')
+@click.option('--verbose', is_flag=True, help='In đầy đủ kế hoạch truy vấn.')
+def check_indexes_command(verbose):
+    """Chạy EXPLAIN cho truy vấn chính của từng route và xác nhận có dùng chỉ mục."""
+    failures = 0
+    with db.engine.connect() as conn:
+        for label, query in hot_queries().items():
+            plan, uses_index = explain(conn, query)
+            failures += not uses_index
+            click.echo(f"[{'OK' if uses_index else 'THIẾU CHỈ MỤC'}] {label}")
+            if verbose or not uses_index:
+                for line in plan:
+                    click.echo(f"    {line}")
+        conn.rollback()
+    if failures:
+        raise click.ClickException(f"{failures} truy vấn không dùng chỉ mục. Hãy chạy 'flask db-upgrade'.")
+
+
+def init_app(app):
+    app.cli.add_command(db_upgrade_command)
+    app.cli.add_command(check_indexes_command)
@@ -0,0 +1,300 @@
+# app/services/search_service.py
+
+import threading
+import time
+import unicodedata
+import click
+from flask import current_app
+from sqlalchemy import event, inspect, text, column
+from sqlalchemy.orm import attributes
+from .. import db
+from ..models import Device
+
+# Chỉ tạo lại chỉ mục khi tên hoặc serial thay đổi
+INDEXED_FIELDS = ('name', 'serial')
+# session.info: thay đổi chờ commit của backend không giao dịch (device_id -> nội dung, None = xóa)
+PENDING = 'search_pending'
+
+
+def normalize_text(value):
+    """Chuẩn hóa chuỗi để tìm kiếm không dấu: 'Thiết bị Điện' -> 'thiet bi dien'."""
+    if not value:
+        return ''
+    value = str(value).replace('đ', 'd').replace('Đ', 'D')
+    decomposed = unicodedata.normalize('NFD', value)
+    stripped = ''.join(ch for ch in decomposed if unicodedata.category(ch) != 'Mn')
+    return ' '.join(stripped.lower().split())
+
+
+def document_for(name, serial):
+    return f"{normalize_text(name)} {normalize_text(serial)}"
+
+
+def _trigrams(value):
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+class SqliteFtsBackend:
+    """SQLite FTS5 với tokenizer trigram: tìm chuỗi con dùng chỉ mục thay vì quét bảng."""
+    name = 'fts5'
+    table = 'device_fts'
+
+    def ensure_schema(self, conn):
+        created = not inspect(conn).has_table(self.table)
+        conn.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5(body, tokenize='trigram')"))
+        return created
+
+    def upsert(self, conn, rows):
+        if not rows:
+            return
+        self.delete(conn, [device_id for device_id, _ in rows])
+        conn.execute(text(f"INSERT INTO {self.table} (rowid, body) VALUES (:id, :body)"),
+                     [{'id': device_id, 'body': body} for device_id, body in rows])
+
+    def delete(self, conn, device_ids):
+        if device_ids:
+            conn.execute(text(f"DELETE FROM {self.table} WHERE rowid = :id"), [{'id': i} for i in device_ids])
+
+    def clear(self, conn):
+        conn.execute(text(f"DELETE FROM {self.table}"))
+
+    def match(self, term):
+        if len(term) >= 3:
+            phrase = '"' + term.replace('"', '""') + '"'
+            sql = text(f"SELECT rowid FROM {self.table} WHERE {self.table} MATCH :q").bindparams(q=phrase)
+        else:
+            sql = text(f"SELECT rowid FROM {self.table} WHERE body LIKE :q").bindparams(q=f"%{term}%")
+        return sql.columns(column('rowid'))
+
+
+class PostgresTrigramBackend:
+    """PostgreSQL: bảng phụ với chỉ mục GIN pg_trgm, hỗ trợ LIKE '%x%' bằng chỉ mục."""
+    name = 'pg_trgm'
+    table = 'device_search'
+
+    def ensure_schema(self, conn):
+        created = not inspect(conn).has_table(self.table)
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                          f"device_id INTEGER PRIMARY KEY, body TEXT NOT NULL)"))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{self.table}_body_trgm ON {self.table} USING gin (body gin_trgm_ops)"))
+        return created
+
+    def upsert(self, conn, rows):
+        if rows:
+            conn.execute(text(f"INSERT INTO {self.table} (device_id, body) VALUES (:id, :body) "
+                              f"ON CONFLICT (device_id) DO UPDATE SET body = EXCLUDED.body"),
+                         [{'id': device_id, 'body': body} for device_id, body in rows])
+
+    def delete(self, conn, device_ids):
+        if device_ids:
+            conn.execute(text(f"DELETE FROM {self.table} WHERE device_id = ANY(:ids)"), {'ids': list(device_ids)})
+
+    def clear(self, conn):
+        conn.execute(text(f"TRUNCATE {self.table}"))
+
+    def match(self, term):
+        escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return text(f"SELECT device_id FROM {self.table} WHERE body LIKE :q").bindparams(q=f"%{escaped}%").columns(column('device_id'))
+
+
+class MemoryIndexBackend:
+    """Dự phòng: chỉ mục ngược trigram trong bộ nhớ tiến trình, tự dựng lại sau SEARCH_INDEX_TTL giây.
+
+    Không nằm trong giao dịch CSDL: thay đổi từ session chỉ được ghi vào đây sau khi commit (xem _write).
+    """
+    name = 'memory'
+    transactional = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = {}
+        self._postings = {}
+        self._built_at = None
+
+    def ensure_schema(self, conn):
+        return False
+
+    def _add(self, device_id, body):
+        self._docs[device_id] = body
+        for gram in _trigrams(body):
+            self._postings.setdefault(gram, set()).add(device_id)
+
+    def _remove(self, device_id):
+        body = self._docs.pop(device_id, None)
+        if body is not None:
+            for gram in _trigrams(body):
+                self._postings.get(gram, set()).discard(device_id)
+
+    def upsert(self, conn, rows):
+        with self._lock:
+            for device_id, body in rows:
+                self._remove(device_id)
+                self._add(device_id, body)
+
+    def delete(self, conn, device_ids):
+        with self._lock:
+            for device_id in device_ids:
+                self._remove(device_id)
+
+    def clear(self, conn):
+        with self._lock:
+            self._docs, self._postings = {}, {}
+        self._built_at = time.monotonic()
+
+    def invalidate(self):
+        self._built_at = None
+
+    def _refresh_if_stale(self):
+        ttl = current_app.config.get('SEARCH_INDEX_TTL', 60)
+        if self._built_at is None or time.monotonic() - self._built_at > ttl:
+            rebuild_index()
+
+    def match(self, term):
+        self._refresh_if_stale()
+        with self._lock:
+            grams = _trigrams(term)
+            if grams:
+                candidates = set.intersection(*(self._postings.get(g, set()) for g in grams))
+            else:
+                candidates = self._docs.keys()
+            return [i for i in candidates if term in self._docs.get(i, '')]
+
+
+_backends = {}
+
+
+def _with_connection(conn, fn):
+    """Chạy fn trên kết nối cho sẵn (cùng giao dịch với session) hoặc trên một giao dịch riêng."""
+    if conn is not None:
+        return fn(conn)
+    with db.engine.begin() as own_conn:
+        return fn(own_conn)
+
+
+def get_backend(conn=None):
+    """Chọn backend theo cấu hình SEARCH_BACKEND ('auto', 'fts5', 'pg_trgm', 'memory') và loại CSDL."""
+    engine = db.engine
+    backend = _backends.get(engine)
+    if backend is not None:
+        return backend
+
+    choice = current_app.config.get('SEARCH_BACKEND', 'auto')
+    if choice == 'auto':
+        choice = {'sqlite': 'fts5', 'postgresql': 'pg_trgm'}.get(engine.dialect.name, 'memory')
+    backend = {'fts5': SqliteFtsBackend, 'pg_trgm': PostgresTrigramBackend}.get(choice, MemoryIndexBackend)()
+
+    def setup(c):
+        # SAVEPOINT để lỗi DDL không làm hỏng giao dịch đang mở của session
+        with c.begin_nested():
+            return backend.ensure_schema(c)
+
+    try:
+        needs_build = _with_connection(conn, setup)
+    except Exception as e:
+        # Ví dụ: SQLite không biên dịch FTS5, hoặc không có quyền tạo extension pg_trgm
+        current_app.logger.warning(f"Không dùng được backend tìm kiếm '{backend.name}' ({e}), chuyển sang chỉ mục bộ nhớ.")
+        backend, needs_build = MemoryIndexBackend(), False
+
+    _backends[engine] = backend
+    if needs_build:
+        rebuild_index(conn)
+    return backend
+
+
+def rebuild_index(conn=None, batch_size=1000):
+    """Dựng lại toàn bộ chỉ mục tìm kiếm từ bảng device (đọc theo lô)."""
+    backend = get_backend(conn)
+
+    def build(c):
+        backend.clear(c)
+        last_id, total = 0, 0
+        while True:
+            rows = c.execute(db.select(Device.id, Device.name, Device.serial)
+                             .where(Device.id > last_id).order_by(Device.id).limit(batch_size)).all()
+            if not rows:
+                break
+            backend.upsert(c, [(r.id, document_for(r.name, r.serial)) for r in rows])
+            last_id, total = rows[-1].id, total + len(rows)
+        return total
+
+    return _with_connection(conn, build)
+
+
+def reindex_devices(device_ids):
+    """Cập nhật chỉ mục cho các thiết bị được ghi bằng câu lệnh hàng loạt (bỏ qua sự kiện ORM)."""
+    if not device_ids:
+        return
+    conn = db.session.connection()
+    rows = conn.execute(db.select(Device.id, Device.name, Device.serial).where(Device.id.in_(list(device_ids)))).all()
+    _write(db.session, conn, [(r.id, document_for(r.name, r.serial)) for r in rows], [])
+
+
+def _write(session, conn, rows, removed):
+    """Ghi thay đổi chỉ mục của session: backend trong CSDL ghi ngay trên kết nối của giao dịch (rollback cùng nhau);
+    chỉ mục bộ nhớ thì gom lại đến khi commit, để rollback không để lại bản ghi ma."""
+    backend = get_backend(conn)
+    if getattr(backend, 'transactional', True):
+        backend.delete(conn, removed)
+        backend.upsert(conn, rows)
+        return
+    pending = session.info.setdefault(PENDING, {})
+    pending.update((device_id, None) for device_id in removed)
+    pending.update(rows)
+
+
+def search_filter(term):
+    """Trả về điều kiện lọc Device theo một từ khóa (không phân biệt hoa thường và dấu)."""
+    normalized = normalize_text(term)
+    if not normalized:
+        return Device.id.isnot(None)
+    return Device.id.in_(get_backend().match(normalized))
+
+
+def _sync_after_flush(session, flush_context):
+    """Đồng bộ chỉ mục trong cùng giao dịch với thay đổi của Device."""
+    changed, removed = [], []
+    for obj in session.new:
+        if isinstance(obj, Device):
+            changed.append(obj)
+    for obj in session.dirty:
+        if isinstance(obj, Device) and any(attributes.get_history(obj, f).has_changes() for f in INDEXED_FIELDS):
+            changed.append(obj)
+    for obj in session.deleted:
+        if isinstance(obj, Device):
+            removed.append(obj.id)
+    if not changed and not removed:
+        return
+
+    _write(session, session.connection(), [(d.id, document_for(d.name, d.serial)) for d in changed], removed)
+
+
+def _apply_after_commit(session):
+    pending = session.info.pop(PENDING, None)
+    if not pending:
+        return
+    backend = get_backend()
+    backend.delete(None, [device_id for device_id, body in pending.items() if body is None])
+    backend.upsert(None, [(device_id, body) for device_id, body in pending.items() if body is not None])
+
+
+def _discard_after_rollback(session, previous_transaction):
+    if not session.info.pop(PENDING, None):
+        return
+    if previous_transaction.nested:
+        # Chỉ rollback một SAVEPOINT: không tách được phần nào thuộc về nó, dựng lại chỉ mục ở lần tìm sau
+        get_backend().invalidate()
+
+
+@click.command('search-reindex')
+def search_reindex_command():
+    """Dựng lại chỉ mục tìm kiếm thiết bị."""
+    total = rebuild_index()
+    click.echo(f"Đã lập chỉ mục {total} thiết bị (backend: {get_backend().name}).")
+
+
+def init_app(app):
+    event.listen(db.session, 'after_flush', _sync_after_flush)
+    event.listen(db.session, 'after_commit', _apply_after_commit)
+    event.listen(db.session, 'after_soft_rollback', _discard_after_rollback)
+    app.cli.add_command(search_reindex_command)
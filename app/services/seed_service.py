@@ -0,0 +1,244 @@
+# app/services/seed_service.py
+
+import random
+import time
+from datetime import datetime, timedelta
+import click
+from sqlalchemy import select, insert, func, text
+from werkzeug.security import generate_password_hash
+from .. import db
+from ..models import User, Device, Transaction, BorrowList, ListItem
+from . import search_service, stats_service, archive_service
+
+# Mật khẩu chung của mọi tài khoản sinh ra (băm một lần, dùng lại cho tất cả)
+SEED_PASSWORD = 'seed123'
+SERIAL_PREFIX = 'SEED-'
+BORROW_TYPE, RETURN_TYPE = 'Mượn', 'Trả'
+LOAN_DAYS = 30
+
+CATALOG = {
+    'Dụng cụ': ['Kìm cắt', 'Tua vít bộ', 'Thước kẹp', 'Mỏ hàn', 'Khoan cầm tay', 'Cờ lê', 'Đồng hồ vạn năng'],
+    'Thiết bị điện': ['Máy chiếu', 'Loa kéo', 'Micro không dây', 'Máy tính xách tay', 'Máy ảnh', 'Bộ nguồn DC', 'Máy hiện sóng'],
+    'Vật tư': ['Dây điện', 'Băng keo', 'Pin AA', 'Ốc vít', 'Giấy in A4', 'Bo mạch thử', 'Ống co nhiệt'],
+    'Other': ['Bàn gấp', 'Ghế nhựa', 'Bảng trắng', 'Lều bạt', 'Xe đẩy'],
+}
+LOCATIONS = ['Kho chính', 'Kho phụ', 'Phòng thí nghiệm 1', 'Phòng thí nghiệm 2', 'Xưởng thực hành', 'Phòng đa năng']
+UNITS = {'Vật tư': 'Hộp'}
+FAMILY_NAMES = ['Nguyễn', 'Trần', 'Lê', 'Phạm', 'Hoàng', 'Huỳnh', 'Phan', 'Vũ', 'Võ', 'Đặng', 'Bùi', 'Đỗ']
+GIVEN_NAMES = ['An', 'Bình', 'Châu', 'Dũng', 'Giang', 'Hà', 'Hải', 'Hùng', 'Khánh', 'Lan', 'Linh', 'Minh', 'Nam',
+               'Ngọc', 'Phúc', 'Quân', 'Sơn', 'Thảo', 'Trang', 'Tuấn', 'Vy', 'Yến']
+
+# Tỉ lệ trạng thái phiếu mượn; phiếu còn lại (chưa gửi) là Pending, tối đa một phiếu mỗi người
+LIST_MIX = (('returned', 0.6), ('cancelled', 0.15), ('borrowed', 0.1), ('Submitted', 0.06), ('Ready', 0.04))
+MAINTENANCE_SHARE = 0.02
+# Phần thiết bị tối đa nằm trong phiếu đang hoạt động; phiếu vượt quá được sinh thành phiếu đã trả
+ACTIVE_DEVICE_SHARE = 0.3
+
+
+def _chunks(rows, size):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def _next_id(model):
+    return (db.session.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+def _insert(model, rows, batch_size):
+    """Chèn bằng Core theo lô (executemany), không tạo đối tượng ORM."""
+    for chunk in _chunks(rows, batch_size):
+        db.session.execute(insert(model), chunk)
+    if rows and 'id' in rows[0]:
+        _sync_sequence(model)
+
+
+def _sync_sequence(model):
+    """Chèn với id tự đặt không làm chạy sequence của PostgreSQL: đẩy sequence lên MAX(id), nếu không
+    lần INSERT thường kế tiếp sẽ cấp lại id đã dùng. SQLite tự lấy MAX(id)+1 nên không cần."""
+    bind = db.session.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+    table = bind.dialect.identifier_preparer.format_table(model.__table__)
+    db.session.execute(text(f"SELECT setval(pg_get_serial_sequence(:table, 'id'), (SELECT MAX(id) FROM {table}))"),
+                       {'table': table})
+
+
+def _spread(rng, start, end):
+    return start + timedelta(seconds=rng.uniform(0, max((end - start).total_seconds(), 0)))
+
+
+def make_users(rng, count, now, years):
+    first = _next_id(User)
+    password_hash = generate_password_hash(SEED_PASSWORD)
+    rows = []
+    for user_id in range(first, first + count):
+        rows.append({
+            'id': user_id, 'username': f'seed{user_id}', 'email': f'seed{user_id}@example.com',
+            'full_name': f'{rng.choice(FAMILY_NAMES)} {rng.choice(GIVEN_NAMES)}', 'student_id': f'SEED{user_id:07}',
+            'class_name': f'K{rng.randint(60, 69)}-{rng.randint(1, 8)}', 'password_hash': password_hash,
+            'is_admin': False, 'created_at': _spread(rng, now - timedelta(days=365 * years), now),
+        })
+    return rows
+
+
+def make_devices(rng, count, now, years):
+    first = _next_id(Device)
+    categories = list(CATALOG)
+    rows = []
+    for device_id in range(first, first + count):
+        category = rng.choice(categories)
+        rows.append({
+            'id': device_id, 'name': f'{rng.choice(CATALOG[category])} {rng.randint(1, 50):02}',
+            'serial': f'{SERIAL_PREFIX}{device_id:07}', 'category': category, 'unit': UNITS.get(category, 'Cái'),
+            'location': rng.choice(LOCATIONS), 'status': 'Available', 'version': 1,
+            'created_at': _spread(rng, now - timedelta(days=365 * years), now - timedelta(days=365 * years - 30)),
+        })
+    return rows
+
+
+def make_lists(rng, count, users, devices, now, years):
+    """Phiếu mượn ở mọi trạng thái. Thiết bị của phiếu đang hoạt động (chưa trả / chờ giao / trong giỏ) lấy không lặp,
+    để trạng thái thiết bị khớp với phiếu. Trả về (phiếu, món, {device_id: (trạng thái, user_id, borrowed_at)})."""
+    first_list, first_item = _next_id(BorrowList), _next_id(ListItem)
+    history_start = now - timedelta(days=365 * years)
+    all_ids = [d['id'] for d in devices]
+    pool = rng.sample(all_ids, int(len(all_ids) * ACTIVE_DEVICE_SHARE))
+    kinds = [kind for kind, share in LIST_MIX for _ in range(round(count * share))]
+    kinds += ['Pending'] * min(max(count - len(kinds), 0), len(users))
+    rng.shuffle(kinds)
+    pending_users = iter(rng.sample(users, min(kinds.count('Pending'), len(users))))
+
+    lists, items, held = [], [], {}
+    for list_id, kind in enumerate(kinds, start=first_list):
+        active = kind in ('borrowed', 'Submitted', 'Ready', 'Pending')
+        if active and not pool:
+            kind, active = 'returned', False
+        size = rng.randint(1, 5)
+        if active:
+            device_ids = [pool.pop() for _ in range(min(size, len(pool)))]
+        else:
+            device_ids = rng.sample(all_ids, min(size, len(all_ids)))
+        user_id = next(pending_users) if kind == 'Pending' else rng.choice(users)
+        row = {'id': list_id, 'user_id': user_id, 'item_count': len(device_ids), 'version': 1, 'overdue': False,
+               'expected_borrow_date': None, 'borrowed_at': None, 'return_deadline': None, 'returned_at': None,
+               'overdue_at': None}
+        if kind in ('returned', 'cancelled'):
+            row['created_at'] = _spread(rng, history_start, now - timedelta(days=3))
+        elif kind == 'borrowed':
+            # Phiếu chưa trả mượn trong 60 ngày gần đây: khoảng một nửa đã quá hạn 30 ngày
+            row['created_at'] = _spread(rng, now - timedelta(days=60), now - timedelta(days=1))
+        else:
+            row['created_at'] = _spread(rng, now - timedelta(days=7), now)
+        if kind in ('returned', 'borrowed'):
+            row['status'] = 'Completed'
+            row['borrowed_at'] = min(row['created_at'] + timedelta(hours=rng.uniform(1, 72)), now)
+            row['return_deadline'] = (row['borrowed_at'] + timedelta(days=LOAN_DAYS)).date()
+            row['expected_borrow_date'] = row['borrowed_at'].date()
+            if kind == 'returned':
+                row['returned_at'] = min(row['borrowed_at'] + timedelta(days=rng.uniform(1, LOAN_DAYS + 10)), now)
+            elif row['return_deadline'] < now.date():
+                row['overdue'] = True
+                row['overdue_at'] = datetime.combine(row['return_deadline'] + timedelta(days=1), datetime.min.time())
+        elif kind == 'cancelled':
+            row['status'] = 'Cancelled'
+        else:
+            row['status'] = kind
+            if kind != 'Pending':
+                row['expected_borrow_date'] = (row['created_at'] + timedelta(days=rng.randint(1, 7))).date()
+        lists.append(row)
+        for device_id in device_ids:
+            items.append({'id': first_item + len(items), 'list_id': list_id, 'device_id': device_id,
+                          'created_at': row['created_at']})
+            if active:
+                held[device_id] = ('Borrowed' if kind == 'borrowed' else 'Reserved', user_id, row['borrowed_at'])
+    return lists, items, held
+
+
+def make_transactions(rng, count, users, devices, held, now, years):
+    """Lịch sử Mượn/Trả xen kẽ theo từng thiết bị, rải đều trong `years` năm.
+
+    Độ phổ biến lệch (vài thiết bị được mượn rất nhiều) để báo cáo tỉ lệ sử dụng có cả máy nhàn rỗi lẫn quá tải.
+    Thiết bị đang bị mượn kết thúc bằng một lượt Mượn đúng lúc giao phiếu; lịch sử trước đó nằm trước thời điểm ấy.
+    """
+    start = now - timedelta(days=365 * years)
+    weights = [rng.paretovariate(1.5) for _ in devices]
+    pairs = [0] * len(devices)
+    for index in rng.choices(range(len(devices)), weights=weights, k=count // 2):
+        pairs[index] += 1
+    rows = []
+    for device, n in zip(devices, pairs):
+        status, holder, borrowed_at = held.get(device['id'], (None, None, None))
+        end = borrowed_at if status == 'Borrowed' else now
+        times = sorted(_spread(rng, start, end) for _ in range(2 * n))
+        for i in range(0, len(times), 2):
+            user_id = rng.choice(users)
+            rows.append({'device_id': device['id'], 'user_id': user_id, 'transaction_type': BORROW_TYPE, 'created_at': times[i]})
+            rows.append({'device_id': device['id'], 'user_id': user_id, 'transaction_type': RETURN_TYPE, 'created_at': times[i + 1]})
+        if status == 'Borrowed':
+            rows.append({'device_id': device['id'], 'user_id': holder, 'transaction_type': BORROW_TYPE,
+                         'created_at': borrowed_at, 'notes': 'Giao theo phiếu'})
+    rows.sort(key=lambda row: row['created_at']) # id tăng theo thời gian như dữ liệu thật
+    for row in rows:
+        row.setdefault('notes', None)
+    return rows
+
+
+def seed(users=500, devices=5000, lists=20000, transactions=200000, years=3, seed=42, batch_size=5000, echo=None):
+    """Sinh dữ liệu giả lập với khối lượng tùy chọn (thêm vào dữ liệu sẵn có) và commit. Trả về số dòng theo bảng."""
+    echo = echo or (lambda message: None)
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    started = time.monotonic()
+
+    user_rows = make_users(rng, users, now, years)
+    device_rows = make_devices(rng, devices, now, years)
+    user_ids = [row['id'] for row in user_rows] or [u for u in db.session.execute(select(User.id)).scalars()]
+    if not user_ids or not device_rows:
+        raise click.UsageError('Cần ít nhất một người dùng và một thiết bị để sinh phiếu mượn/giao dịch.')
+    list_rows, item_rows, held = make_lists(rng, lists, user_ids, device_rows, now, years)
+    transaction_rows = make_transactions(rng, transactions, user_ids, device_rows, held, now, years)
+    for row in device_rows:
+        status, holder, _ = held.get(row['id'], (None, None, None))
+        if status:
+            row['status'] = status
+            row['borrower_id'] = holder if status == 'Borrowed' else None
+        else:
+            row['status'] = 'Maintenance' if rng.random() < MAINTENANCE_SHARE else 'Available'
+            row['borrower_id'] = None
+    echo(f'Đã sinh dữ liệu trong bộ nhớ ({time.monotonic() - started:.1f}s), đang ghi...')
+
+    for model, rows in ((User, user_rows), (Device, device_rows), (BorrowList, list_rows),
+                        (ListItem, item_rows), (Transaction, transaction_rows)):
+        _insert(model, rows, batch_size)
+        echo(f'  {model.__tablename__}: {len(rows)} dòng')
+    # Chèn bằng Core bỏ qua sự kiện ORM: tự cộng tóm tắt lịch sử, dựng chỉ mục tìm kiếm và đổi phiên bản cache
+    archive_service.record_borrows(db.session.connection(), [(row['device_id'], row['user_id'], row['created_at'])
+                                                             for row in transaction_rows if row['transaction_type'] == BORROW_TYPE])
+    stats_service.bump_version()
+    db.session.commit()
+    search_service.rebuild_index()
+    db.session.commit()
+    echo(f'Hoàn tất sau {time.monotonic() - started:.1f}s.')
+    return {'users': len(user_rows), 'devices': len(device_rows), 'borrow_lists': len(list_rows),
+            'list_items': len(item_rows), 'transactions': len(transaction_rows)}
+
+
+@click.command('seed-data')
+@click.option('--users', type=int, default=500, show_default=True)
+@click.option('--devices', type=int, default=5000, show_default=True)
+@click.option('--lists', type=int, default=20000, show_default=True, help='Số phiếu mượn (mọi trạng thái).')
+@click.option('--transactions', type=int, default=200000, show_default=True, help='Số giao dịch Mượn/Trả lịch sử.')
+@click.option('--years', type=int, default=3, show_default=True, help='Lịch sử trải dài bao nhiêu năm.')
+@click.option('--seed', 'seed_value', type=int, default=42, show_default=True, help='Hạt giống ngẫu nhiên (cùng giá trị cho cùng dữ liệu).')
+@click.option('--batch-size', type=int, default=5000, show_default=True)
+def seed_data_command(users, devices, lists, transactions, years, seed_value, batch_size):
+    """Sinh dữ liệu giả lập để thử tải. Dữ liệu được THÊM vào CSDL hiện tại; chạy 'flask init-db' trước nếu cần CSDL sạch.
+
+    Mọi tài khoản sinh ra có mật khẩu 'seed123'; serial thiết bị có tiền tố SEED-.
+    """
+    counts = seed(users, devices, lists, transactions, years, seed_value, batch_size, echo=click.echo)
+    click.echo(', '.join(f'{count} {name}' for name, count in counts.items()))
+
+
+def init_app(app):
+    app.cli.add_command(seed_data_command)
@@ -0,0 +1,73 @@
+# app/services/state_machine.py
+
+# --- MÁY TRẠNG THÁI TẬP TRUNG ---
+# Mọi thay đổi Device.status / BorrowList.status đều được kiểm tra ở đây
+# (qua @validates trong models và trong các lệnh UPDATE hàng loạt).
+
+from sqlalchemy.orm.exc import StaleDataError
+
+DEVICE_TRANSITIONS = {
+    'Available': {'Reserved', 'Borrowed', 'Maintenance'},
+    'Reserved': {'Available', 'Borrowed'},          # bỏ khỏi giỏ / hủy phiếu, hoặc giao đồ
+    'Borrowed': {'Available'},                      # trả đồ
+    'Maintenance': {'Available'},
+}
+
+BORROW_LIST_TRANSITIONS = {
+    'Pending': {'Submitted'},
+    'Submitted': {'Ready', 'Cancelled'},
+    'Ready': {'Completed', 'Cancelled'},
+    'Completed': set(),
+    'Cancelled': set(),
+}
+
+MACHINES = {'Device': DEVICE_TRANSITIONS, 'BorrowList': BORROW_LIST_TRANSITIONS}
+
+# Chuyển trạng thái chỉ được đi qua luồng giỏ/phiếu mượn (luồng đó xử lý cả ListItem của thiết bị), không được
+# chọn tay ở form sửa thiết bị: đặt hay bỏ "Reserved" ở đó sẽ làm giỏ của sinh viên lệch với thiết bị
+WORKFLOW_ONLY = {'Device': {('Available', 'Reserved'), ('Reserved', 'Available'), ('Reserved', 'Borrowed')}}
+
+
+class InvalidTransition(ValueError):
+    """Chuyển trạng thái không hợp lệ theo máy trạng thái."""
+
+    def __init__(self, entity, current, target):
+        self.entity, self.current, self.target = entity, current, target
+        super().__init__(f'{entity}: không thể chuyển từ "{current}" sang "{target}".')
+
+
+def can_transition(entity, current, target):
+    if current is None or current == target:
+        return True
+    return target in MACHINES[entity].get(current, set())
+
+
+def check_transition(entity, current, target):
+    """Trả về `target` nếu hợp lệ, nếu không thì ném InvalidTransition."""
+    if target not in MACHINES[entity]:
+        raise InvalidTransition(entity, current, target)
+    if not can_transition(entity, current, target):
+        raise InvalidTransition(entity, current, target)
+    return target
+
+
+def allowed_targets(entity, current):
+    """Các trạng thái có thể chọn từ trạng thái hiện tại (gồm cả chính nó), dùng cho form chỉnh sửa."""
+    manual = {target for target in MACHINES[entity].get(current, set())
+              if (current, target) not in WORKFLOW_ONLY.get(entity, set())}
+    return {current} | manual
+
+
+# --- KHÓA LẠC QUAN CHO FORM ---
+
+def check_version(obj, submitted):
+    """So phiên bản mà form đã hiển thị (trường ẩn `version`) với phiên bản hiện tại của `obj`.
+
+    version_id_col chỉ bảo vệ đọc-sửa-ghi trong cùng một request: hai admin cùng mở một form thì người lưu sau
+    ghi đè người trước mà không hay biết. Lệch phiên bản thì ném StaleDataError (app báo xung đột và rollback).
+    Request không gửi trường này (không đến từ form) thì bỏ qua.
+    """
+    if submitted is None or submitted == '':
+        return
+    if str(submitted) != str(obj.version):
+        raise StaleDataError(f'{type(obj).__name__} #{obj.id}: form ở phiên bản {submitted}, CSDL đang là {obj.version}.')
@@ -0,0 +1,165 @@
+# app/services/stats_service.py
+
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import event, func, select, update, insert
+from sqlalchemy.orm import attributes
+from .. import db
+from ..models import User, Device, Transaction, TransactionArchive, BorrowList, ListItem, CacheVersion
+
+# Tên bộ đếm phiên bản của dữ liệu kho (thiết bị + phiếu mượn)
+INVENTORY = 'inventory'
+# Bộ đếm cho ETag của trang danh mục/chi tiết thiết bị: đổi khi bất kỳ dữ liệu nào hiển thị ở đó thay đổi
+CATALOG = 'catalog'
+CATALOG_MODELS = (Device, Transaction, User, BorrowList, ListItem)
+
+# Các trường mà khi đổi thì thống kê phải tính lại
+TRACKED_FIELDS = {Device: ('status',), BorrowList: ('status', 'returned_at', 'return_deadline', 'overdue')}
+# Khóa trong session.info: các bộ đếm cần tăng khi giao dịch hiện tại commit
+PENDING_BUMPS = 'pending_version_bumps'
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def current_version(name=INVENTORY):
+    """Đọc bộ đếm phiên bản (một lần tra khóa chính)."""
+    return db.session.execute(select(CacheVersion.version).where(CacheVersion.name == name)).scalar() or 0
+
+
+def bump_version(conn=None, names=(INVENTORY, CATALOG)):
+    """Tăng các bộ đếm để mọi worker bỏ cache cũ khi giao dịch commit.
+
+    Mặc định tăng cả hai: các thao tác hàng loạt ở mức Core luôn đổi cả thống kê lẫn danh mục.
+    Không truyền `conn` thì chỉ ghi nhận vào db.session và tăng một lần ngay trước COMMIT (_bump_before_commit):
+    mọi request đều ghi vào vài dòng cache_version, nên khóa dòng chỉ nên giữ trong khoảnh khắc cuối giao dịch.
+    """
+    if conn is None:
+        db.session.info.setdefault(PENDING_BUMPS, set()).update(names)
+        return
+    _apply_bumps(conn, names)
+
+
+def _apply_bumps(conn, names):
+    now = datetime.utcnow()
+    for name in sorted(names): # Thứ tự cố định để hai giao dịch không khóa chéo nhau
+        result = conn.execute(update(CacheVersion).where(CacheVersion.name == name)
+                              .values(version=CacheVersion.version + 1, updated_at=now))
+        if result.rowcount == 0:
+            conn.execute(insert(CacheVersion).values(name=name, version=1, updated_at=now))
+
+
+def cached(key, compute, name=INVENTORY):
+    """Trả về giá trị cache nếu phiên bản chưa đổi và chưa quá STATS_CACHE_TTL giây, nếu không thì tính lại."""
+    version = current_version(name)
+    now = time.monotonic()
+    with _lock:
+        entry = _cache.get(key)
+        if entry and entry[0] == version and entry[1] > now:
+            return entry[2]
+    value = compute()
+    with _lock:
+        # Khóa theo từng thiết bị/người dùng có thể rất nhiều: bỏ mục cũ nhất khi đầy
+        while len(_cache) >= current_app.config.get('STATS_CACHE_MAX_ENTRIES', 1000) and key not in _cache:
+            _cache.pop(next(iter(_cache)))
+        _cache[key] = (version, now + current_app.config.get('STATS_CACHE_TTL', 30), value)
+    return value
+
+
+def transaction_count(device_id=None, user_id=None):
+    """Tổng số giao dịch (của một thiết bị/người dùng, gồm cả phần đã lưu trữ) cho các trang lịch sử,
+    cache theo phiên bản CATALOG (tăng khi có giao dịch mới) thay vì COUNT(*) ở mỗi lần chuyển trang."""
+    def count(model):
+        stmt = select(func.count()).select_from(model)
+        if device_id is not None:
+            stmt = stmt.where(model.device_id == device_id)
+        if user_id is not None:
+            stmt = stmt.where(model.user_id == user_id)
+        return stmt.scalar_subquery()
+    return cached(f'transaction_count:{device_id}:{user_id}',
+                  lambda: db.session.execute(select(count(Transaction) + count(TransactionArchive))).scalar(), name=CATALOG)
+
+
+def device_status_counts_select():
+    """Câu GROUP BY status của thống kê trang chủ (check-indexes kiểm tra kế hoạch của đúng câu này)."""
+    return select(Device.status, func.count()).group_by(Device.status)
+
+
+def _device_status_counts():
+    rows = db.session.execute(device_status_counts_select()).all()
+    return {status: count for status, count in rows}
+
+
+def inventory_stats():
+    """Thống kê thiết bị cho trang chủ: một câu GROUP BY status thay cho bốn câu COUNT(*)."""
+    def compute():
+        counts = _device_status_counts()
+        return {
+            'total_devices': sum(counts.values()),
+            'available_devices': counts.get('Available', 0),
+            'borrowed_devices': counts.get('Borrowed', 0),
+            'reserved_devices': counts.get('Reserved', 0),
+        }
+    return cached('inventory_stats', compute)
+
+
+def dashboard_stats():
+    """Thống kê cho admin dashboard: gộp các COUNT vào một câu SELECT với truy vấn con."""
+    def compute():
+        row = db.session.execute(select(
+            select(func.count()).select_from(User).scalar_subquery().label('users'),
+            select(func.count()).select_from(Device).scalar_subquery().label('devices'),
+            (select(func.count()).select_from(Transaction).scalar_subquery()
+             + select(func.count()).select_from(TransactionArchive).scalar_subquery()).label('transactions'),
+            select(func.count()).select_from(BorrowList).where(BorrowList.status == 'Submitted')
+                .scalar_subquery().label('pending_requests'),
+            select(func.count()).select_from(BorrowList).where(
+                BorrowList.status == 'Completed',
+                BorrowList.returned_at == None,
+                BorrowList.overdue == True
+            ).scalar_subquery().label('overdue_count'),
+        )).one()
+        return dict(row._mapping)
+    return cached('dashboard_stats', compute)
+
+
+def _has_tracked_change(obj):
+    fields = TRACKED_FIELDS.get(type(obj))
+    return fields is not None and any(attributes.get_history(obj, f).has_changes() for f in fields)
+
+
+def _bump_after_flush(session, flush_context):
+    """Tự tăng phiên bản: INVENTORY khi thiết bị/phiếu mượn/người dùng được thêm, xóa hoặc đổi trạng thái;
+    CATALOG khi bất kỳ dòng nào hiển thị trên trang thiết bị thay đổi."""
+    tracked = tuple(TRACKED_FIELDS) + (User,)
+    names = []
+    if (any(isinstance(o, tracked) for o in session.new)
+            or any(isinstance(o, tracked) for o in session.deleted)
+            or any(_has_tracked_change(o) for o in session.dirty)):
+        names.append(INVENTORY)
+    if (any(isinstance(o, CATALOG_MODELS) for o in session.new)
+            or any(isinstance(o, CATALOG_MODELS) for o in session.deleted)
+            or any(isinstance(o, CATALOG_MODELS) and session.is_modified(o) for o in session.dirty)):
+        names.append(CATALOG)
+    if names:
+        session.info.setdefault(PENDING_BUMPS, set()).update(names)
+
+
+def _bump_before_commit(session):
+    """Tăng mỗi bộ đếm đã ghi nhận đúng một lần cho cả giao dịch, dù có bao nhiêu lần flush."""
+    session.flush() # before_commit chạy trước lần flush cuối của commit: flush trước để ghi nhận đủ thay đổi
+    names = session.info.pop(PENDING_BUMPS, None)
+    if names:
+        _apply_bumps(session.connection(), names)
+
+
+def _discard_after_rollback(session):
+    session.info.pop(PENDING_BUMPS, None)
+
+
+def init_app(app):
+    event.listen(db.session, 'after_flush', _bump_after_flush)
+    event.listen(db.session, 'before_commit', _bump_before_commit)
+    event.listen(db.session, 'after_rollback', _discard_after_rollback)
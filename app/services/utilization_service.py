@@ -0,0 +1,194 @@
+# app/services/utilization_service.py
+
+from datetime import datetime, timedelta
+import click
+from sqlalchemy import select, union_all, case, or_, cast, String
+from .. import db
+from ..models import Device, Transaction, TransactionArchive, BorrowList, ListItem
+from . import stats_service
+
+BORROW_TYPE = 'Mượn'
+# Phiếu đã gửi yêu cầu (tính vào nhu cầu) và phiếu đang chờ giao đồ (hàng đợi)
+REQUESTED_STATUSES = ('Submitted', 'Ready', 'Completed')
+QUEUED_STATUSES = ('Submitted', 'Ready')
+# Ngưỡng phân loại thiết bị theo tỉ lệ thời gian đang được mượn trong kỳ
+IDLE_BELOW = 0.05
+BUSY_ABOVE = 0.8
+IDLE, NORMAL, OVERSUBSCRIBED = 'Nhàn rỗi', 'Bình thường', 'Quá tải'
+
+DEVICE_COLUMNS = ['device_id', 'name', 'serial', 'category', 'location', 'status', 'loans', 'busy_hours',
+                  'utilization', 'median_loan_hours', 'requests', 'queued', 'median_wait_hours', 'class']
+CATEGORY_COLUMNS = ['category', 'devices', 'loans', 'busy_hours', 'utilization', 'median_loan_hours', 'requests',
+                    'queued', 'median_wait_hours', 'idle', 'oversubscribed']
+
+
+def _text(column):
+    """Đọc cột ngày giờ dưới dạng chuỗi ISO: pandas đổi cả cột một lần, nhanh hơn nhiều so với để SQLAlchemy
+    dựng từng đối tượng datetime (với SQLite mỗi dòng phải phân tích chuỗi bằng Python)."""
+    return cast(column, String).label(column.key)
+
+
+def _frame(stmt, dates=()):
+    """Đọc kết quả truy vấn thành DataFrame một lần (không tạo đối tượng ORM); cột ngày giờ đổi sang datetime64."""
+    import pandas as pd
+    frame = pd.read_sql_query(stmt, db.session.connection())
+    for column in dates:
+        frame[column] = pd.to_datetime(frame[column], format='ISO8601')
+    return frame
+
+
+def _events(start, end):
+    """Sự kiện Mượn/Trả trong kỳ (bảng nóng + bảng lưu trữ), sắp theo (thiết bị, thời điểm, id)."""
+    def part(model):
+        return select(model.id, model.device_id, case((model.transaction_type == BORROW_TYPE, 1), else_=0).label('is_borrow'),
+                      _text(model.created_at)).where(model.created_at >= start, model.created_at <= end)
+    events = _frame(union_all(part(Transaction), part(TransactionArchive)), dates=('created_at',))
+    return events.sort_values(['device_id', 'created_at', 'id'], kind='stable', ignore_index=True)
+
+
+def pair_loans(events, start, end, borrowed_device_ids=()):
+    """Ghép sự kiện thành các lượt mượn [start, end) bằng phép dịch mảng, không lặp theo từng dòng.
+
+    - Mượn có sự kiện kế tiếp (cùng thiết bị) là Trả: lượt mượn đủ, biết thời lượng.
+    - Mượn là sự kiện cuối của thiết bị: đang mượn, tính đến `end`.
+    - Trả là sự kiện đầu của thiết bị trong kỳ: mượn từ trước kỳ, tính từ `start`.
+    - Thiết bị không có sự kiện nào trong kỳ mà đang Borrowed (`borrowed_device_ids`): bận cả kỳ.
+    Mượn nối tiếp Mượn (dữ liệu lệch) không tạo lượt mượn. Trả về DataFrame (device_id, start, end, complete).
+    """
+    import numpy as np
+    import pandas as pd
+    device = events['device_id'].to_numpy()
+    borrow = events['is_borrow'].to_numpy().astype(bool)
+    at = events['created_at'].to_numpy()
+    same_next = np.zeros(len(events), dtype=bool)
+    same_next[:-1] = device[1:] == device[:-1]
+    same_prev = np.zeros(len(events), dtype=bool)
+    same_prev[1:] = same_next[:-1]
+    next_at = np.roll(at, -1)
+    next_is_return = np.roll(~borrow, -1)
+
+    closed = borrow & same_next & next_is_return
+    still_open = borrow & ~same_next
+    carried = ~borrow & ~same_prev
+    idle_borrowed = np.setdiff1d(np.asarray(list(borrowed_device_ids), dtype=device.dtype), device)
+    start, end = np.datetime64(start, 'us'), np.datetime64(end, 'us')
+    return pd.DataFrame({
+        'device_id': np.concatenate([device[closed], device[still_open], device[carried], idle_borrowed]),
+        'start': np.concatenate([at[closed], at[still_open], np.full(carried.sum(), start),
+                                 np.full(len(idle_borrowed), start)]).astype('datetime64[us]'),
+        'end': np.concatenate([next_at[closed], np.full(still_open.sum(), end), at[carried],
+                               np.full(len(idle_borrowed), end)]).astype('datetime64[us]'),
+        'complete': np.concatenate([np.ones(closed.sum(), dtype=bool),
+                                    np.zeros(still_open.sum() + carried.sum() + len(idle_borrowed), dtype=bool)]),
+    })
+
+
+def _requests(start):
+    """Thiết bị trong các phiếu đã gửi từ `start` và các phiếu đang chờ giao (bất kể ngày tạo)."""
+    events = _frame(
+        select(ListItem.device_id, BorrowList.status, _text(BorrowList.created_at), _text(BorrowList.borrowed_at))
+        .join(BorrowList, ListItem.list_id == BorrowList.id)
+        .where(BorrowList.status.in_(REQUESTED_STATUSES),
+               or_(BorrowList.created_at >= start, BorrowList.status.in_(QUEUED_STATUSES))),
+        dates=('created_at', 'borrowed_at'))
+    events['requested'] = events['created_at'] >= start
+    events['queued'] = events['status'].isin(QUEUED_STATUSES)
+    # Thời gian chờ từ lúc gửi phiếu đến lúc nhận đồ, chỉ với phiếu đã giao
+    events['wait_hours'] = (events['borrowed_at'] - events['created_at']).dt.total_seconds() / 3600
+    return events
+
+
+def build_report(days=90, now=None):
+    """Tỉ lệ sử dụng, thời lượng mượn trung vị và nhu cầu hàng đợi theo thiết bị và theo danh mục trong `days` ngày gần nhất.
+
+    Mỗi bảng được đọc bằng một truy vấn (3 truy vấn tổng cộng), mọi phép ghép/gộp chạy trên mảng NumPy/pandas.
+    Trả về dict gồm 'devices' và 'categories' (DataFrame) cùng khoảng thời gian và các số tổng.
+    """
+    import numpy as np
+    end = now or datetime.utcnow()
+    start = end - timedelta(days=days)
+    window_hours = days * 24
+
+    devices = _frame(select(Device.id.label('device_id'), Device.name, Device.serial, Device.category,
+                            Device.location, Device.status))
+    devices[['category', 'location']] = devices[['category', 'location']].fillna('N/A')
+    events = _events(start, end)
+    loans = pair_loans(events, start, end, devices.loc[devices['status'] == 'Borrowed', 'device_id'])
+    loans['hours'] = (loans['end'] - loans['start']).dt.total_seconds() / 3600
+    requests = _requests(start)
+
+    by_device = devices.set_index('device_id')
+    by_device['loans'] = events[events['is_borrow'] == 1].groupby('device_id').size()
+    by_device['busy_hours'] = loans.groupby('device_id')['hours'].sum()
+    by_device['median_loan_hours'] = loans[loans['complete']].groupby('device_id')['hours'].median()
+    grouped_requests = requests.groupby('device_id')
+    by_device['requests'] = grouped_requests['requested'].sum()
+    by_device['queued'] = grouped_requests['queued'].sum()
+    by_device['median_wait_hours'] = grouped_requests['wait_hours'].median()
+    counts = ['loans', 'busy_hours', 'requests', 'queued']
+    by_device[counts] = by_device[counts].fillna(0)
+    by_device[['loans', 'requests', 'queued']] = by_device[['loans', 'requests', 'queued']].astype(int)
+    by_device['utilization'] = (by_device['busy_hours'] / window_hours).clip(0, 1)
+    # Quá tải: bận gần hết kỳ, hoặc có người đang chờ một thiết bị đang bị mượn
+    by_device['class'] = np.select(
+        [(by_device['utilization'] >= BUSY_ABOVE) | ((by_device['queued'] > 0) & (by_device['status'] == 'Borrowed')),
+         (by_device['utilization'] < IDLE_BELOW) & (by_device['requests'] == 0)],
+        [OVERSUBSCRIBED, IDLE], default=NORMAL)
+    device_table = by_device.reset_index()[DEVICE_COLUMNS].sort_values(['utilization', 'requests'], ascending=False,
+                                                                         ignore_index=True)
+
+    category_of = by_device['category']
+    grouped = device_table.groupby('category')
+    categories = grouped.agg(devices=('device_id', 'size'), loans=('loans', 'sum'), busy_hours=('busy_hours', 'sum'),
+                             requests=('requests', 'sum'), queued=('queued', 'sum'))
+    categories['utilization'] = categories['busy_hours'] / (categories['devices'] * window_hours)
+    categories['median_loan_hours'] = loans[loans['complete']].assign(category=lambda f: f['device_id'].map(category_of)) \
+        .groupby('category')['hours'].median()
+    categories['median_wait_hours'] = requests.assign(category=requests['device_id'].map(category_of)) \
+        .groupby('category')['wait_hours'].median()
+    classes = device_table.groupby(['category', 'class']).size().unstack(fill_value=0)
+    categories['idle'] = classes.get(IDLE, 0)
+    categories['oversubscribed'] = classes.get(OVERSUBSCRIBED, 0)
+    category_table = categories.fillna({'idle': 0, 'oversubscribed': 0}).astype({'idle': int, 'oversubscribed': int}) \
+        .reset_index()[CATEGORY_COLUMNS].sort_values('utilization', ascending=False, ignore_index=True)
+
+    return {
+        'start': start, 'end': end, 'days': days,
+        'devices': device_table, 'categories': category_table,
+        'totals': {
+            'devices': len(device_table), 'events': len(events), 'loans': int(device_table['loans'].sum()),
+            'utilization': float(device_table['busy_hours'].sum() / (window_hours * len(device_table))) if len(device_table) else 0.0,
+            'median_loan_hours': float(loans.loc[loans['complete'], 'hours'].median()) if loans['complete'].any() else None,
+            'idle': int((device_table['class'] == IDLE).sum()),
+            'oversubscribed': int((device_table['class'] == OVERSUBSCRIBED).sum()),
+        },
+    }
+
+
+def report(days=90):
+    """build_report có cache: tính lại khi danh mục/giao dịch đổi (bộ đếm CATALOG) hoặc hết STATS_CACHE_TTL."""
+    return stats_service.cached(f'utilization:{days}', lambda: build_report(days), name=stats_service.CATALOG)
+
+
+@click.command('utilization-report')
+@click.option('--days', type=int, default=90, show_default=True, help='Số ngày gần nhất cần tính.')
+@click.option('--by', 'by', type=click.Choice(['category', 'device']), default='category', show_default=True)
+@click.option('--top', type=int, default=20, show_default=True, help='Số dòng in ra (0 = tất cả).')
+@click.option('--csv', 'csv_path', type=click.Path(dir_okay=False), help='Ghi toàn bộ bảng ra file CSV.')
+def utilization_report_command(days, by, top, csv_path):
+    """In báo cáo tỉ lệ sử dụng thiết bị, thời lượng mượn và nhu cầu hàng đợi."""
+    started = datetime.utcnow()
+    result = build_report(days)
+    table = result['categories' if by == 'category' else 'devices']
+    if csv_path:
+        table.to_csv(csv_path, index=False, float_format='%.3f')
+        click.echo(f'Đã ghi {len(table)} dòng vào {csv_path}.')
+    totals = result['totals']
+    click.echo(f"{totals['events']} giao dịch, {totals['devices']} thiết bị, tỉ lệ sử dụng {totals['utilization']:.1%}, "
+               f"{totals['idle']} nhàn rỗi, {totals['oversubscribed']} quá tải "
+               f"({(datetime.utcnow() - started).total_seconds():.2f}s).")
+    click.echo(table.head(top or len(table)).to_string(index=False, float_format=lambda v: f'{v:.2f}'))
+
+
+def init_app(app):
+    app.cli.add_command(utilization_report_command)
@@ -12,6 +12,38 @@ class Config:
     UPLOAD_FOLDER = os.path.join(basedir, 'app/static/uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+    DEVICES_PER_PAGE = int(os.environ.get('DEVICES_PER_PAGE') or 50)
+    # Tìm kiếm thiết bị: 'auto' chọn FTS5 (SQLite) / pg_trgm (PostgreSQL), hoặc 'memory'
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or 'auto'
+    SEARCH_INDEX_TTL = int(os.environ.get('SEARCH_INDEX_TTL') or 60)
+    # Thời gian sống (giây) của cache thống kê trang chủ/dashboard
+    STATS_CACHE_TTL = int(os.environ.get('STATS_CACHE_TTL') or 30)
+    STATS_CACHE_MAX_ENTRIES = int(os.environ.get('STATS_CACHE_MAX_ENTRIES') or 1000)
+    # Số giao dịch mỗi trang ở các dòng thời gian (chi tiết thiết bị, chi tiết người dùng, admin)
+    TRANSACTIONS_PER_PAGE = int(os.environ.get('TRANSACTIONS_PER_PAGE') or 20)
+    # Giao dịch cũ hơn số ngày này được 'flask archive-transactions' chuyển sang bảng transaction_archive
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS') or 365)
+    ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE') or 5000)
+    # Số dòng mỗi lô khi nhập thiết bị từ file Excel/CSV
+    IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE') or 1000)
+    # Hàng đợi nhập file (import_job): file upload được lưu tạm ở đây rồi xử lý nền
+    IMPORT_STAGING_DIR = os.environ.get('IMPORT_STAGING_DIR') or os.path.join(basedir, 'import_staging')
+    IMPORT_BACKGROUND = os.environ.get('IMPORT_BACKGROUND', 'true').lower() in ['true', 'on', '1']
+    IMPORT_POLL_INTERVAL = int(os.environ.get('IMPORT_POLL_INTERVAL') or 5)
+    IMPORT_LEASE_SECONDS = int(os.environ.get('IMPORT_LEASE_SECONDS') or 600)
+    # Xuất dữ liệu dạng cột (Parquet/Feather) cho phân tích
+    ANALYTICS_EXPORT_DIR = os.environ.get('ANALYTICS_EXPORT_DIR') or os.path.join(basedir, 'analytics_export')
+    ANALYTICS_EXPORT_FORMAT = os.environ.get('ANALYTICS_EXPORT_FORMAT') or 'parquet'
+    # Chỉ xuất các giao dịch tạo trước ít nhất ngần này giây (chờ các giao dịch CSDL đang dở commit)
+    ANALYTICS_EXPORT_LAG_SECONDS = int(os.environ.get('ANALYTICS_EXPORT_LAG_SECONDS') or 60)
+    # Nén gzip các response HTML/CSV/JSON từ kích thước này (byte) và thời gian cache ảnh tải lên (giây)
+    HTTP_GZIP_MIN_SIZE = int(os.environ.get('HTTP_GZIP_MIN_SIZE') or 1024)
+    HTTP_GZIP_LEVEL = int(os.environ.get('HTTP_GZIP_LEVEL') or 6)
+    UPLOAD_CACHE_MAX_AGE = int(os.environ.get('UPLOAD_CACHE_MAX_AGE') or 31536000)
+    # Phiếu PDF: render trong process pool riêng, cache trên đĩa; chờ tối đa PDF_RENDER_WAIT giây trong request
+    PDF_CACHE_DIR = os.environ.get('PDF_CACHE_DIR') or os.path.join(basedir, 'pdf_cache')
+    PDF_WORKERS = int(os.environ.get('PDF_WORKERS') or 2)
+    PDF_RENDER_WAIT = float(os.environ.get('PDF_RENDER_WAIT') or 10)
 
     MAIL_SERVER = os.environ.get('MAIL_SERVER') or 'smtp.gmail.com'
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 587)
@@ -20,6 +52,47 @@ class Config:
     MAIL_PASSWORD = os.environ.get('EMAIL_PASS')
     MAIL_DEFAULT_SENDER = os.environ.get('EMAIL_USER')
     HOST_EMAIL = os.environ.get('HOST_EMAIL')
+    # Kênh gửi email: 'sendgrid', 'smtp' (Flask-Mail) hoặc 'file' (ghi ra MAIL_FILE_DIR để thử offline)
+    MAIL_TRANSPORT = os.environ.get('MAIL_TRANSPORT') or 'sendgrid'
+    MAIL_FILE_DIR = os.environ.get('MAIL_FILE_DIR') or os.path.join(basedir, 'mail_outbox')
+
+    # Hàng đợi email (email_outbox) và bộ gửi nền
+    OUTBOX_BACKGROUND = os.environ.get('OUTBOX_BACKGROUND', 'true').lower() in ['true', 'on', '1']
+    OUTBOX_POLL_INTERVAL = int(os.environ.get('OUTBOX_POLL_INTERVAL') or 10)
+    OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE') or 50)
+    OUTBOX_THREADS = int(os.environ.get('OUTBOX_THREADS') or 4)
+    OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS') or 6)
+    OUTBOX_BACKOFF_BASE = int(os.environ.get('OUTBOX_BACKOFF_BASE') or 30)
+    OUTBOX_BACKOFF_MAX = int(os.environ.get('OUTBOX_BACKOFF_MAX') or 3600)
+    OUTBOX_LEASE_SECONDS = int(os.environ.get('OUTBOX_LEASE_SECONDS') or 300)
+
+    # Bộ quét quá hạn: đánh dấu phiếu quá hạn và nhắc trước hạn OVERDUE_REMIND_DAYS ngày
+    OVERDUE_SCAN_BACKGROUND = os.environ.get('OVERDUE_SCAN_BACKGROUND', 'true').lower() in ['true', 'on', '1']
+    OVERDUE_SCAN_INTERVAL = int(os.environ.get('OVERDUE_SCAN_INTERVAL') or 3600)
+    OVERDUE_REMIND_DAYS = int(os.environ.get('OVERDUE_REMIND_DAYS') or 2)
+
+    # Rollup số liệu theo ngày cho biểu đồ dashboard; chỉ đọc dữ liệu cũ hơn ROLLUP_LAG_SECONDS giây
+    ROLLUP_BACKGROUND = os.environ.get('ROLLUP_BACKGROUND', 'true').lower() in ['true', 'on', '1']
+    ROLLUP_INTERVAL = int(os.environ.get('ROLLUP_INTERVAL') or 900)
+    ROLLUP_LAG_SECONDS = int(os.environ.get('ROLLUP_LAG_SECONDS') or 60)
+
+    # Số liệu hiệu năng theo request: mỗi worker ghi bản chụp vào METRICS_DIR mỗi METRICS_FLUSH_INTERVAL giây,
+    # /admin/metrics cộng lại. Prometheus đọc bằng header 'Authorization: Bearer <METRICS_TOKEN>'
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ['true', 'on', '1']
+    METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(basedir, 'metrics')
+    METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL') or 5)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # Request chậm hơn ngưỡng này (ms) được ghi log cảnh báo và giữ lại SLOW_REQUEST_LOG_SIZE request gần nhất
+    SLOW_REQUEST_THRESHOLD_MS = int(os.environ.get('SLOW_REQUEST_THRESHOLD_MS') or 500)
+    SLOW_REQUEST_LOG_SIZE = int(os.environ.get('SLOW_REQUEST_LOG_SIZE') or 100)
+    # Thêm header Server-Timing (thời gian xử lý, số câu SQL) vào mọi response; bật khi chạy benchmark
+    SERVER_TIMING_HEADER = os.environ.get('SERVER_TIMING_HEADER', 'false').lower() in ['true', 'on', '1']
+    # Profile theo yêu cầu cho một request (?_profile=<token>): lưu PROFILE_KEEP bản mới nhất trong PROFILE_DIR
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', 'true').lower() in ['true', 'on', '1']
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(basedir, 'profiles')
+    PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP') or 50)
+    PROFILE_TOKEN_MAX_AGE = int(os.environ.get('PROFILE_TOKEN_MAX_AGE') or 3600)
+    PROFILE_SAMPLE_INTERVAL_MS = int(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS') or 5)
 
 class DevelopmentConfig(Config):
     """Cấu hình cho môi trường phát triển (máy tính cá nhân)."""
@@ -1,6 +1,7 @@
 import os
 from app import create_app, db
 from app.models import User
+from app.services import search_service, schema_service
 
 # Đọc biến môi trường FLASK_CONFIG để chọn đúng CSDL
 config_name = os.getenv('FLASK_CONFIG') or 'default'
@@ -12,6 +13,7 @@ with app.app_context():
     db.drop_all()
     print("Đã xóa các bảng cũ (nếu có).")
     db.create_all()
+    schema_service.stamp_head()
     print("Đã tạo thành công tất cả các bảng mới.")
 
     if not User.query.filter_by(username='admin').first():
@@ -27,4 +29,5 @@ with app.app_context():
         print("Đã thêm tài khoản user mẫu.")
 
     db.session.commit()
+    search_service.rebuild_index()
     print("\n🎉 Khởi tạo cơ sở dữ liệu và tạo tài khoản mẫu thành công!")
@@ -2,6 +2,7 @@ import os
 import click
 from app import create_app, db
 from app.models import User
+from app.services import search_service, schema_service
 
 # Đọc biến môi trường để quyết định cấu hình
 config_name = os.getenv('FLASK_CONFIG') or 'default'
@@ -16,6 +17,8 @@ def init_db_command():
     
     db.drop_all()
     db.create_all()
+    # create_all đã tạo đủ chỉ mục theo models, đánh dấu là phiên bản mới nhất
+    schema_service.stamp_head()
 
     # Tạo tài khoản admin
     admin = User(
@@ -33,6 +36,8 @@ def init_db_command():
     db.session.add(user)
 
     db.session.commit()
+    # Bảng chỉ mục tìm kiếm không nằm trong metadata nên cần dựng lại riêng
+    search_service.rebuild_index()
     click.echo('🎉 Khởi tạo cơ sở dữ liệu và tạo tài khoản mẫu thành công!')
 
 